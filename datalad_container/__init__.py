@@ -43,13 +43,36 @@ command_suite = (
             'containers-run',
             'containers_run',
 
-        )
+        ),
+        (
+            'datalad_container.containers_store',
+            'ContainersStore',
+            'containers-store',
+            'containers_store',
+        ),
+        (
+            'datalad_container.containers_warm',
+            'ContainersWarm',
+            'containers-warm',
+            'containers_warm',
+        ),
+        (
+            'datalad_container.containers_prefetch',
+            'ContainersPrefetch',
+            'containers-prefetch',
+            'containers_prefetch',
+        ),
     ]
 )
 
 from os.path import join as opj
 
-from datalad.support.constraints import EnsureStr
+from datalad.support.constraints import (
+    EnsureChoice,
+    EnsureInt,
+    EnsureNone,
+    EnsureStr,
+)
 from datalad.support.extensions import register_config
 
 register_config(
@@ -61,6 +84,109 @@ register_config(
     dialog='question',
     scope='dataset',
 )
+register_config(
+    'datalad.containers.store',
+    'Container image store',
+    description='directory of a host-wide store of container images, '
+    'shared by all datasets on this host. Images are taken from this store '
+    'instead of being downloaded, and are placed into datasets via '
+    'hardlinks, if possible. Disabled if not set',
+    type=EnsureStr() | EnsureNone(),
+    default=None,
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.timings',
+    'Report timings of containerized runs',
+    description="whether to log a summary of the time spent in the "
+    "individual phases of a 'containers-run' ('summary'), and to "
+    "additionally store these timings in the run record ('record')",
+    type=EnsureChoice('none', 'summary', 'record'),
+    default='none',
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.warm',
+    'Pre-warm container images',
+    description="whether to bring the image and extra inputs of a "
+    "container into the page cache before a 'containers-run' execution, "
+    "by advising the kernel to read them ahead ('fadvise'), or by reading "
+    "them sequentially ('read')",
+    type=EnsureChoice('none', 'fadvise', 'read'),
+    default='none',
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.overlay-create',
+    'Command to create writable overlays',
+    description="command to create the writable overlay images of "
+    "containers with an overlay size, with the placeholders '{size}' "
+    "(in MiB) and '{path}'. If not set, 'apptainer overlay create' (or "
+    "'singularity overlay create') is used",
+    type=EnsureStr() | EnsureNone(),
+    default=None,
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.build-cache',
+    'Build cache of Apptainer/Singularity',
+    description="directory of the cache used when building images from "
+    "'docker://' URLs, shared by all datasets that configure it. With the "
+    "value 'dataset', a cache in the .git directory of each dataset is "
+    "used. If not set, the cache of the user's environment is used",
+    type=EnsureStr() | EnsureNone(),
+    default=None,
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.build-cache-size',
+    'Size limit of the build cache',
+    description="size in MiB the build cache is reduced to after a build, "
+    "by removing the files that were not used for the longest time",
+    type=EnsureInt(),
+    default=10240,
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.download-jobs',
+    'Concurrent requests per image download',
+    description="number of concurrent HTTP range requests used to "
+    "download a large container image from a server that supports them. "
+    "Interrupted downloads are resumed. With a value below 2, images are "
+    "downloaded by git-annex in a single stream",
+    type=EnsureInt(),
+    default=4,
+    dialog='question',
+    scope='global',
+)
+register_config(
+    'datalad.containers.server-socket',
+    'Socket of the containers-run server',
+    description="location of the unix socket of a 'containers-run --serve' "
+    "server. If not set, the socket is placed at "
+    "'.git/datalad/containers/run.sock' of the served dataset",
+    type=EnsureStr() | EnsureNone(),
+    default=None,
+    dialog='question',
+    scope='dataset',
+)
+register_config(
+    'datalad.containers.server-jobs',
+    'Concurrency limit of the containers-run server',
+    description="maximum number of commands executed concurrently by a "
+    "'containers-run --serve' server. If not set, the number of CPUs is "
+    "used",
+    type=EnsureInt() | EnsureNone(),
+    default=None,
+    dialog='question',
+    scope='global',
+)
 
 from . import _version
 
@@ -17,10 +17,11 @@ import os.path as op
 import subprocess as sp
 import sys
 import tarfile
-import tempfile
 
 from datalad.utils import on_windows
 
+from datalad_container.input_streaming import STATUS_ENVVAR
+
 lgr = logging.getLogger("datalad.containers.adapters.docker")
 
 # Note: A dockerpy dependency probably isn't worth it in the current
@@ -32,9 +33,66 @@ lgr = logging.getLogger("datalad.containers.adapters.docker")
 # be documented somewhere.
 
 
+def _is_within_directory(directory, target):
+    abs_directory = op.abspath(directory)
+    abs_target = op.abspath(target)
+    return op.commonpath([abs_directory, abs_target]) == abs_directory
+
+
+def _check_member(member, path):
+    """Raise if extracting a tar member would affect anything outside `path`
+    """
+    target = op.join(path, member.name)
+    if not _is_within_directory(path, target):
+        raise ValueError(
+            "Attempted path traversal in tar file: {}".format(member.name))
+    if member.issym() or member.islnk():
+        # docker save links identical layers to each other
+        link_target = op.join(
+            op.dirname(target) if member.issym() else path,
+            member.linkname)
+        if not _is_within_directory(path, link_target):
+            raise ValueError(
+                "Link to outside of the tar file: {} -> {}".format(
+                    member.name, member.linkname))
+    elif not (member.isfile() or member.isdir()):
+        raise ValueError(
+            "Unsupported type of tar file member: {}".format(member.name))
+
+
+def extract_stream(stream, path):
+    """Extract a tar archive from a (non-seekable) stream to a directory.
+
+    The archive is read once, and each member is validated right before it
+    is extracted.
+
+    Parameters
+    ----------
+    stream : file object
+        Binary stream of an uncompressed tar archive, e.g., a pipe.
+    path : str
+        An empty or nonexistent directory to extract the archive to.
+    """
+    if not op.exists(path):
+        lgr.debug("Creating new directory at %s", path)
+        os.makedirs(path)
+    elif os.listdir(path):
+        raise OSError("Directory {} is not empty".format(path))
+    # the standard library's own safeguards, where available
+    extract_kwargs = dict(filter="data") \
+        if hasattr(tarfile, "data_filter") else {}
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            _check_member(member, path)
+            tar.extract(member, path, **extract_kwargs)
+
+
 def save(image, path):
     """Save and extract a docker image to a directory.
 
+    The output of `docker save` is extracted while it is produced, without
+    an intermediate copy of the archive.
+
     Parameters
     ----------
     image : str
@@ -42,41 +100,33 @@ def save(image, path):
     path : str
         A directory to extract the image to.
     """
-    # Use a temporary file because docker save (or actually tar underneath)
-    # complains that stdout needs to be redirected if we use Popen and PIPE.
     if ":" not in image:
         image = f"{image}:latest"
-    with tempfile.NamedTemporaryFile() as stream:
-        # Windows can't write to an already opened file
-        stream.close()
-        sp.check_call(["docker", "save", "-o", stream.name, image])
-        with tarfile.open(stream.name, mode="r:") as tar:
-            if not op.exists(path):
-                lgr.debug("Creating new directory at %s", path)
-                os.makedirs(path)
-            elif os.listdir(path):
-                raise OSError("Directory {} is not empty".format(path))
-            def is_within_directory(directory, target):
-
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-
-                return prefix == abs_directory
-
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-
-                tar.extractall(path, members, numeric_owner=numeric_owner)
-
-
-            safe_extract(tar, path=path)
-            lgr.info("Saved %s to %s", image, path)
+    cmd = ["docker", "save", image]
+    p = sp.Popen(cmd, stdout=sp.PIPE)
+    try:
+        extract_stream(p.stdout, path)
+        # drain what the archive does not account for (e.g., end-of-archive
+        # padding), such that docker does not fail writing to a closed pipe
+        while p.stdout.read(1024 * 1024):
+            pass
+    except tarfile.ReadError as e:
+        # no (complete) archive, most likely because docker failed
+        p.stdout.close()
+        return_code = p.wait()
+        if return_code:
+            raise sp.CalledProcessError(return_code, cmd) from e
+        raise
+    except BaseException:
+        p.kill()
+        p.stdout.close()
+        p.wait()
+        raise
+    p.stdout.close()
+    return_code = p.wait()
+    if return_code:
+        raise sp.CalledProcessError(return_code, cmd)
+    lgr.info("Saved %s to %s", image, path)
 
 
 def _list_images():
@@ -172,6 +222,13 @@ def cli_run(namespace):
         # permissions.
         prefix.extend(["-u", "{}:{}".format(os.getuid(), os.getgid())])
 
+    status_file = os.environ.get(STATUS_ENVVAR)
+    if status_file:
+        # The input status file of a run that obtains its inputs while the
+        # command executes is outside of the mounted working directory.
+        prefix.extend(["-v", "{0}:{0}:ro".format(status_file),
+                       "-e", STATUS_ENVVAR])
+
     if sys.stdin.isatty():
         prefix.append("--tty")
     prefix.append(image_id)
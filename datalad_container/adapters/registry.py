@@ -0,0 +1,352 @@
+"""Pull Docker images from a registry without a Docker daemon.
+
+The manifest, the config, and the layers of an image are fetched via the
+Docker Registry HTTP API V2 (also implemented by OCI registries). Blobs are
+downloaded in parallel, and verified against their digests while they are
+received. Layers are decompressed on the fly, and additionally verified
+against the uncompressed digests ("diff IDs") in the image config.
+
+The image is written in the layout of `docker save`, i.e., as expected by
+`datalad_container.adapters.docker.get_image` and `load`::
+
+    manifest.json
+    <config digest>.json
+    <diff ID>/layer.tar
+
+Only anonymous access is supported, including the token authentication that
+registries like Docker Hub use for public images.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import platform as _platform
+import re
+import shutil
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+lgr = logging.getLogger("datalad.containers.adapters.registry")
+
+DOCKER_HUB = "registry-1.docker.io"
+
+_MANIFEST_TYPES = (
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+)
+_INDEX_TYPES = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+)
+# Docker's names of the architectures reported by platform.machine()
+_ARCHITECTURES = {
+    "x86_64": "amd64",
+    "AMD64": "amd64",
+    "aarch64": "arm64",
+    "armv7l": "arm",
+    "i686": "386",
+}
+_CHUNK_SIZE = 1024 * 1024
+# decompress gzip rather than zlib streams
+_GZIP = zlib.MAX_WBITS | 16
+
+
+class RegistryError(RuntimeError):
+    """An image could not be obtained from a registry"""
+
+
+def parse_reference(reference):
+    """Split a Docker image reference into its components.
+
+    Parameters
+    ----------
+    reference : str
+        For example, "busybox", "busybox:1.36",
+        "quay.io/biocontainers/samtools:1.17--h00cdaf9_0", or
+        "busybox@sha256:...".
+
+    Returns
+    -------
+    dict
+        With the keys 'registry', 'repository', 'tag' (or None), 'digest'
+        (or None), and 'name', the reference without tag and digest.
+    """
+    name, _, digest = reference.partition("@")
+    tag = None
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+    if not tag and not digest:
+        tag = "latest"
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+    else:
+        registry, repository = DOCKER_HUB, name
+        if "/" not in repository:
+            repository = "library/" + repository
+    if registry == "docker.io":
+        registry = DOCKER_HUB
+    return dict(registry=registry, repository=repository, tag=tag,
+                digest=digest or None, name=name)
+
+
+def get_platform():
+    """Return the platform of this machine, e.g. "linux/amd64"."""
+    machine = _platform.machine()
+    return "linux/" + _ARCHITECTURES.get(machine, machine.lower())
+
+
+class _Gunzip:
+    """Decompress a (multi-member) gzip stream chunk by chunk"""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(_GZIP)
+
+    def __call__(self, data):
+        out = []
+        while data:
+            if self._decompressor.eof:
+                self._decompressor = zlib.decompressobj(_GZIP)
+            out.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+        return b"".join(out)
+
+
+class RegistryClient:
+    """Anonymous client for one repository of a registry.
+
+    The client can be used by multiple threads, each with its own HTTP
+    session. They share the token, which is renewed when it expires.
+
+    Parameters
+    ----------
+    registry : str
+        Host (and port) of the registry. Plain HTTP is used for "localhost"
+        and loopback addresses, HTTPS otherwise.
+    repository : str
+        For example, "library/busybox".
+    """
+
+    def __init__(self, registry, repository):
+        host = registry.rsplit(":", 1)[0]
+        scheme = "http" if host == "localhost" or host.startswith("127.") \
+            else "https"
+        self.base_url = "{}://{}/v2/{}".format(scheme, registry, repository)
+        self.repository = repository
+        self._local = threading.local()
+        self._token = None
+        self._token_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The HTTP session of the calling thread"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        return session
+
+    def _authenticate(self, challenge):
+        # e.g. 'Bearer realm="https://auth.docker.io/token",service="..."'
+        if not challenge.lower().startswith("bearer "):
+            raise RegistryError(
+                "Unsupported authentication: {}".format(challenge))
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            raise RegistryError(
+                "No realm in authentication challenge: {}".format(challenge))
+        params.setdefault("scope",
+                          "repository:{}:pull".format(self.repository))
+        r = self.session.get(realm, params=params, timeout=60)
+        if r.status_code != 200:
+            raise RegistryError(
+                "Could not obtain a token from {} ({})".format(
+                    realm, r.status_code))
+        self._token = r.json().get("token") or r.json().get("access_token")
+
+    def _get(self, path, headers=None, **kwargs):
+        url = "{}/{}".format(self.base_url, path)
+        for attempt in range(2):
+            token = self._token
+            # requests drops the header on redirects to other hosts, e.g., a
+            # storage backend serving the blobs
+            r = self.session.get(
+                url, timeout=60,
+                headers=dict(headers or {}, Authorization="Bearer " + token)
+                if token else headers,
+                **kwargs)
+            if r.status_code != 401 or attempt:
+                break
+            # no token yet, or an expired one
+            r.close()
+            with self._token_lock:
+                # unless another thread renewed it already
+                if self._token == token:
+                    self._authenticate(r.headers.get("WWW-Authenticate", ""))
+        if r.status_code != 200:
+            r.close()
+            raise RegistryError(
+                "Failed to get {}: {} {}".format(url, r.status_code,
+                                                 r.reason))
+        return r
+
+    def get_manifest(self, reference):
+        """Return the manifest for a tag or digest, and its digest.
+
+        The manifest may be an index of manifests for multiple platforms.
+        """
+        r = self._get("manifests/" + reference,
+                      headers={"Accept": ", ".join(_MANIFEST_TYPES)})
+        digest = "sha256:" + hashlib.sha256(r.content).hexdigest()
+        if reference.startswith("sha256:") and digest != reference:
+            raise RegistryError(
+                "Manifest digest mismatch: {} != {}".format(digest,
+                                                            reference))
+        manifest = r.json()
+        manifest.setdefault("mediaType", r.headers.get("Content-Type"))
+        return manifest, digest
+
+    def get_image_manifest(self, reference, platform=None):
+        """Like `get_manifest`, but resolve an index for `platform`.
+
+        Parameters
+        ----------
+        platform : str, optional
+            "os/architecture[/variant]", by default the one of this machine.
+        """
+        manifest, digest = self.get_manifest(reference)
+        if manifest.get("mediaType") not in _INDEX_TYPES:
+            return manifest, digest
+        os_, _, arch = (platform or get_platform()).partition("/")
+        arch, _, variant = arch.partition("/")
+        for candidate in manifest.get("manifests", []):
+            p = candidate.get("platform", {})
+            if p.get("os") == os_ and p.get("architecture") == arch \
+                    and (not variant or p.get("variant") == variant):
+                return self.get_manifest(candidate["digest"])
+        raise RegistryError(
+            "No image for platform {}/{} in {}".format(
+                os_, arch if not variant else arch + "/" + variant,
+                reference))
+
+    def fetch_blob(self, digest, path, gzipped=False, diff_id=None):
+        """Download a blob to `path`, verifying it while it is received.
+
+        Parameters
+        ----------
+        digest : str
+            Digest of the blob.
+        gzipped : bool, optional
+            Whether to decompress the blob.
+        diff_id : str, optional
+            Digest of the decompressed content.
+        """
+        blob_hash = hashlib.sha256()
+        content_hash = hashlib.sha256()
+        decompress = _Gunzip() if gzipped else None
+        partial = path + ".partial"
+        with self._get("blobs/" + digest, stream=True) as r, \
+                open(partial, "wb") as f:
+            for data in r.iter_content(_CHUNK_SIZE):
+                blob_hash.update(data)
+                if decompress:
+                    data = decompress(data)
+                content_hash.update(data)
+                f.write(data)
+        for expected, h in ((digest, blob_hash), (diff_id, content_hash)):
+            if expected and expected != "sha256:" + h.hexdigest():
+                os.unlink(partial)
+                raise RegistryError(
+                    "Digest mismatch for blob {}: sha256:{} != {}".format(
+                        digest, h.hexdigest(), expected))
+        os.replace(partial, path)
+
+
+def pull(reference, path, platform=None, jobs=4):
+    """Pull an image from its registry to a directory.
+
+    Parameters
+    ----------
+    reference : str
+        Docker image reference, e.g. "busybox:latest".
+    path : str
+        An empty or nonexistent directory to write the image to. It is
+        removed again if the pull fails.
+    platform : str, optional
+        "os/architecture[/variant]" of the image to pull from a
+        multi-platform image, by default the one of this machine.
+    jobs : int, optional
+        Number of blobs to download in parallel.
+
+    Returns
+    -------
+    str
+        The digest of the image manifest.
+    """
+    import requests
+    ref = parse_reference(reference)
+    if not op.exists(path):
+        os.makedirs(path)
+    elif os.listdir(path):
+        raise OSError("Directory {} is not empty".format(path))
+    client = RegistryClient(ref["registry"], ref["repository"])
+    try:
+        manifest, digest = client.get_image_manifest(
+            ref["digest"] or ref["tag"], platform=platform)
+        config_name = manifest["config"]["digest"].split(":", 1)[1] + ".json"
+        client.fetch_blob(manifest["config"]["digest"],
+                          op.join(path, config_name))
+        with open(op.join(path, config_name)) as f:
+            diff_ids = json.load(f)["rootfs"]["diff_ids"]
+        layers = manifest["layers"]
+        if len(layers) != len(diff_ids):
+            raise RegistryError(
+                "Manifest of {} lists {} layers, its config {}".format(
+                    reference, len(layers), len(diff_ids)))
+        names = []
+        downloads = {}
+        for layer, diff_id in zip(layers, diff_ids):
+            media_type = layer.get("mediaType", "")
+            if not media_type.endswith(("gzip", ".tar")):
+                raise RegistryError(
+                    "Unsupported layer type: {}".format(media_type))
+            name = op.join(diff_id.split(":", 1)[1], "layer.tar")
+            names.append(name)
+            # identical layers are stored once, like `docker save` does
+            downloads[name] = (layer["digest"], media_type.endswith("gzip"),
+                               diff_id)
+        for name in downloads:
+            os.makedirs(op.join(path, op.dirname(name)), exist_ok=True)
+        lgr.info("Pulling %i layer(s) of %s", len(downloads), reference)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(client.fetch_blob, blob, op.join(path, name),
+                                gzipped, diff_id)
+                for name, (blob, gzipped, diff_id) in downloads.items()]
+            for future in futures:
+                future.result()
+        # written last, marks the image as complete
+        with open(op.join(path, "manifest.json"), "w") as f:
+            json.dump(
+                [{"Config": config_name,
+                  "RepoTags": ["{}:{}".format(ref["name"], ref["tag"])]
+                  if ref["tag"] else None,
+                  "Layers": names}],
+                f)
+    except requests.RequestException as e:
+        shutil.rmtree(path, ignore_errors=True)
+        raise RegistryError(
+            "Failed to pull {}: {}".format(reference, e)) from e
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    lgr.info("Pulled %s (%s) to %s", reference, digest, path)
+    return digest
@@ -1,10 +1,15 @@
+import io
 import json
+import os
 import os.path as op
 import sys
+import tarfile
+from argparse import Namespace
 from shutil import (
     unpack_archive,
     which,
 )
+from unittest.mock import patch
 
 import pytest
 from datalad.cmd import (
@@ -23,6 +28,7 @@ from datalad.tests.utils_pytest import (
 )
 
 import datalad_container.adapters.docker as da
+from datalad_container.input_streaming import STATUS_ENVVAR
 
 if not which("docker"):
     raise SkipTest("'docker' not found on path")
@@ -54,6 +60,38 @@ def test_docker_save_doesnt_exist(path=None):
         call(["save", image_name, path])
 
 
+def _make_tar(members):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        for name, kind, content in members:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            if kind == tarfile.REGTYPE:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            else:
+                info.linkname = content
+                tar.addfile(info)
+    stream.seek(0)
+    return stream
+
+
+@with_tempfile
+def test_extract_stream(path=None):
+    da.extract_stream(
+        _make_tar([("a/layer.tar", tarfile.REGTYPE, b"layer"),
+                   ("b/layer.tar", tarfile.SYMTYPE, "../a/layer.tar")]),
+        path)
+    with open(op.join(path, "b", "layer.tar")) as f:
+        eq_(f.read(), "layer")
+
+    for member in [("../evil", tarfile.REGTYPE, b"evil"),
+                   ("evil", tarfile.SYMTYPE, "../../evil"),
+                   ("evil", tarfile.CHRTYPE, "")]:
+        with assert_raises(ValueError):
+            da.extract_stream(_make_tar([member]), path + "-bad")
+
+
 class TestAdapterBusyBox(object):
 
     @classmethod
@@ -137,3 +175,17 @@ def test_save_multi_image(tmp_path):
         manifest = json.load(fp)
     assert len(manifest) == 1
     assert manifest[0]["RepoTags"] == ["alpine:latest"]
+
+
+def test_run_input_status(tmp_path):
+    status = str(tmp_path / "status")
+    with patch.object(da, "load", return_value="image-id"), \
+            patch.object(da.sp, "check_call") as check_call, \
+            patch.dict(os.environ, {STATUS_ENVVAR: status}):
+        da.cli_run(Namespace(path=str(tmp_path), repo_tag=None, config=None,
+                             cmd=["ls"]))
+    cmd = check_call.call_args[0][0]
+    # the status file is available at the same path in the container
+    assert_in("{0}:{0}:ro".format(status), cmd)
+    eq_(cmd[cmd.index("-e") + 1], STATUS_ENVVAR)
+    eq_(cmd[-2:], ["image-id", "ls"])
@@ -0,0 +1,235 @@
+import gzip
+import hashlib
+import io
+import json
+import os.path as op
+import tarfile
+import threading
+from contextlib import contextmanager
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+
+from datalad.api import Dataset
+from datalad.tests.utils_pytest import (
+    assert_false,
+    assert_in,
+    assert_raises,
+    assert_result_count,
+    eq_,
+    ok_exists,
+    with_tempfile,
+)
+
+import datalad_container.adapters.docker as da
+from datalad_container.adapters.registry import (
+    DOCKER_HUB,
+    RegistryError,
+    parse_reference,
+    pull,
+)
+
+
+def _digest(content):
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+def _layer(name, content):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    return stream.getvalue()
+
+
+def _make_image(arch):
+    """Return the blobs and the manifest of an image with two layers"""
+    layers = [_layer("arch", arch.encode()), _layer("empty", b"")]
+    blobs = {}
+    for layer in layers:
+        blob = gzip.compress(layer)
+        blobs[_digest(blob)] = blob
+    config = json.dumps({
+        "architecture": arch,
+        "os": "linux",
+        # the empty layer appears twice
+        "rootfs": {"type": "layers",
+                   "diff_ids": [_digest(l) for l in layers + layers[1:]]},
+    }).encode()
+    blobs[_digest(config)] = config
+    manifest = json.dumps({
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+        "config": {"mediaType": "application/vnd.oci.image.config.v1+json",
+                   "digest": _digest(config), "size": len(config)},
+        "layers": [
+            {"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip",
+             "digest": _digest(gzip.compress(l))}
+            for l in layers + layers[1:]],
+    }).encode()
+    return blobs, manifest
+
+
+class _Registry(BaseHTTPRequestHandler):
+    """Stand-in for a registry, requiring a token like Docker Hub"""
+    blobs = {}
+    manifests = {}
+    requests = []
+    token = "secret-0"
+    # whether the token expires on the next request for a blob
+    expire = False
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, content, content_type="application/octet-stream",
+              status=200, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path.startswith("/token?"):
+            self._send(json.dumps({"token": _Registry.token}).encode(),
+                       "application/json")
+            return
+        if "/blobs/" in self.path and _Registry.expire:
+            _Registry.expire = False
+            _Registry.token = "secret-{}".format(
+                int(_Registry.token.split("-")[1]) + 1)
+        if self.headers.get("Authorization") != "Bearer " + _Registry.token:
+            realm = "http://{}:{}/token".format(*self.server.server_address)
+            self._send(b"", status=401, headers=[(
+                "WWW-Authenticate",
+                'Bearer realm="{}",service="test"'.format(realm))])
+            return
+        _, kind, reference = self.path.rsplit("/", 2)
+        if kind == "manifests" and reference in self.manifests:
+            content = self.manifests[reference]
+            self._send(content, json.loads(content)["mediaType"])
+        elif kind == "blobs" and reference in self.blobs:
+            self._send(self.blobs[reference])
+        else:
+            self._send(b"", status=404)
+
+
+@contextmanager
+def _serve_registry():
+    blobs, manifests = {}, {}
+    index = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.index.v1+json",
+        "manifests": []}
+    for arch in ("amd64", "arm64"):
+        image_blobs, manifest = _make_image(arch)
+        blobs.update(image_blobs)
+        manifests[_digest(manifest)] = manifest
+        index["manifests"].append({
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "digest": _digest(manifest),
+            "size": len(manifest),
+            "platform": {"os": "linux", "architecture": arch}})
+    manifests["1.0"] = json.dumps(index).encode()
+    _Registry.blobs = blobs
+    _Registry.manifests = manifests
+    _Registry.requests = []
+    _Registry.token = "secret-0"
+    _Registry.expire = False
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Registry)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "127.0.0.1:{}/test/image".format(httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_parse_reference():
+    eq_(parse_reference("busybox"),
+        dict(registry=DOCKER_HUB, repository="library/busybox",
+             tag="latest", digest=None, name="busybox"))
+    eq_(parse_reference("localhost:5000/a/b:1.0@sha256:abc"),
+        dict(registry="localhost:5000", repository="a/b", tag="1.0",
+             digest="sha256:abc", name="localhost:5000/a/b"))
+    eq_(parse_reference("user/image@sha256:abc"),
+        dict(registry=DOCKER_HUB, repository="user/image", tag=None,
+             digest="sha256:abc", name="user/image"))
+
+
+@with_tempfile
+def test_pull(path=None):
+    with _serve_registry() as name:
+        # the token expires during the pull, and is renewed
+        _Registry.expire = True
+        pull(name + ":1.0", path, platform="linux/arm64")
+        eq_(_Registry.token, "secret-1")
+        with open(op.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        eq_(manifest[0]["RepoTags"], [name + ":1.0"])
+        layers = manifest[0]["Layers"]
+        eq_(len(layers), 3)
+        eq_(layers[1], layers[2])
+        with tarfile.open(op.join(path, layers[0])) as tar:
+            eq_(tar.extractfile("arch").read(), b"arm64")
+        with open(op.join(path, manifest[0]["Config"]), "rb") as f:
+            config = f.read()
+        eq_(json.loads(config)["architecture"], "arm64")
+        eq_(da.get_image(path), hashlib.sha256(config).hexdigest())
+        # the duplicate layer is downloaded once, one blob is requested
+        # again with the renewed token
+        eq_(len([p for p in _Registry.requests if "/blobs/" in p]), 4)
+        eq_(len({p for p in _Registry.requests if "/blobs/" in p}), 3)
+
+        with assert_raises(RegistryError):
+            pull(name + ":1.0", path + "-none", platform="linux/s390x")
+        assert_false(op.exists(path + "-none"))
+
+        # content that does not match its digest is rejected
+        index = json.loads(_Registry.manifests["1.0"])
+        manifest = json.loads(
+            _Registry.manifests[index["manifests"][0]["digest"]])
+        _Registry.blobs[manifest["layers"][0]["digest"]] = \
+            gzip.compress(b"tampered")
+        with assert_raises(RegistryError):
+            pull(name + ":1.0", path + "-bad", platform="linux/amd64")
+        assert_false(op.exists(path + "-bad"))
+
+
+@with_tempfile
+def test_containers_add_dhub(path=None):
+    ds = Dataset(path).create(result_renderer="disabled")
+    with _serve_registry() as name:
+        assert_result_count(
+            ds.containers_add("img", url="dhub://{}:1.0".format(name),
+                              result_renderer="disabled"),
+            1, action="containers_add", status="ok")
+    image = ds.pathobj / ".datalad" / "environments" / "img" / "image"
+    ok_exists(image / "manifest.json")
+    assert_in("datalad_container.adapters.docker run",
+              ds.config.get("datalad.containers.img.cmdexec"))
+
+
+@with_tempfile
+def test_containers_update_dhub(path=None):
+    ds = Dataset(path).create(result_renderer="disabled")
+    with _serve_registry() as name:
+        url = "dhub://{}:1.0".format(name)
+        ds.containers_add("img", url=url, result_renderer="disabled")
+        # a plain add asks the registry for the fingerprint of the tag
+        eq_(ds.config.get("datalad.containers.img.fingerprint"),
+            "{} digest:{}".format(url, _digest(_Registry.manifests["1.0"])))
+        # the tag still points to the same image, which is not pulled again
+        _Registry.requests = []
+        assert_result_count(
+            ds.containers_add("img", url=url, update=True,
+                              result_renderer="disabled"),
+            1, action="containers_add", status="notneeded")
+        eq_([p for p in _Registry.requests if "/blobs/" in p], [])
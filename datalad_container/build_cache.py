@@ -0,0 +1,292 @@
+"""Managed cache of Apptainer/Singularity for building images
+
+Building an image from a 'docker://' URL downloads and converts the layers of
+the Docker image. Apptainer caches the layers in ``APPTAINER_CACHEDIR`` (and
+Singularity in ``SINGULARITY_CACHEDIR``), by default in the home directory of
+the user. If the configuration ``datalad.containers.build-cache`` is set, the
+builds of 'containers-add' use a cache managed by datalad-container instead:
+either a directory shared by all datasets of a host, or one in the ``.git``
+directory of the dataset (value ``dataset``).
+
+Concurrent builds share the cache. Once no build uses it, the entries that
+were not used for the longest time are removed from the cache, until it is no
+larger than ``datalad.containers.build-cache-size`` (in MiB). An entry is an
+image in the OCI blob cache (its manifest, config, and the layers no other
+image uses), or an item of any other cache (e.g., a SIF file pulled from a
+library), such that the cache stays consistent.
+
+Per build, the blobs (layers, configs, manifests) that had to be downloaded
+are reported as cache misses, and the layers of the image that were taken
+from the cache as cache hits.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from datalad.cmd import WitlessRunner
+from datalad.distribution.dataset import Dataset
+from datalad.utils import bytes2human
+from fasteners import InterProcessReaderWriterLock
+
+lgr = logging.getLogger("datalad.containers.build_cache")
+
+BUILD_CACHE_CFG = 'datalad.containers.build-cache'
+BUILD_CACHE_SIZE_CFG = 'datalad.containers.build-cache-size'
+
+# manifests are small, layers are not
+_MAX_MANIFEST_SIZE = 1024 * 1024
+
+
+def get_build_cache(ds: Dataset) -> tuple | None:
+    """Return the location and the size limit (in bytes) of the build cache
+
+    Returns
+    -------
+    tuple or None
+      None, if no managed cache is configured.
+    """
+    location = ds.config.get(BUILD_CACHE_CFG)
+    if not location:
+        return None
+    if location == 'dataset':
+        cache = ds.repo.dot_git / 'datalad' / 'containers' / 'build-cache'
+    else:
+        cache = Path(location).expanduser()
+    size = ds.config.obtain(BUILD_CACHE_SIZE_CFG)
+    return cache, size * 1024 * 1024 if size else None
+
+
+def _get_lock(cache: Path) -> InterProcessReaderWriterLock:
+    return InterProcessReaderWriterLock(str(cache / '.lock'))
+
+
+# builds in this process, by cache, with the lock they share. File locks do
+# not exclude threads of the same process, and releasing one lock on a file
+# would release all of them.
+_active = {}
+_active_lock = threading.Lock()
+
+
+@contextmanager
+def _use(cache: Path):
+    """Mark the cache as in use by a build, for this and other processes"""
+    with _active_lock:
+        count, lock = _active.get(cache, (0, None))
+        if not count:
+            lock = _get_lock(cache)
+            lock.acquire_read_lock()
+        _active[cache] = (count + 1, lock)
+    try:
+        yield
+    finally:
+        with _active_lock:
+            count, lock = _active.pop(cache)
+            if count > 1:
+                _active[cache] = (count - 1, lock)
+            else:
+                lock.release_read_lock()
+
+
+def _list_blobs(cache: Path) -> dict:
+    # the OCI layout of the blob cache of Apptainer and Singularity (3.x)
+    blobdir = cache / 'cache' / 'blob' / 'blobs' / 'sha256'
+    if not blobdir.is_dir():
+        return {}
+    return {'sha256:' + p.name: p for p in blobdir.iterdir()}
+
+
+def _read_manifest(blob: Path) -> dict | None:
+    # the image manifest, if the blob is one
+    if blob.stat().st_size > _MAX_MANIFEST_SIZE:
+        return None
+    try:
+        with blob.open('rb') as f:
+            manifest = json.load(f)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(manifest, dict) \
+            or not isinstance(manifest.get('layers'), list):
+        return None
+    return manifest
+
+
+def _get_layers(blob: Path) -> list:
+    # the layer digests, if the blob is an image manifest
+    manifest = _read_manifest(blob) or {}
+    return [layer.get('digest') for layer in manifest.get('layers') or []
+            if isinstance(layer, dict)]
+
+
+def run_build(cmd: list, cwd: str | None, cache: Path,
+              max_size: int | None = None) -> dict:
+    """Run a build command with the managed cache
+
+    Parameters
+    ----------
+    cmd: list
+      The command, e.g., ``['apptainer', 'build', 'image', 'docker://...']``.
+    cwd: str or None
+      Working directory of the command.
+    cache: Path
+      Location of the cache.
+    max_size: int, optional
+      Size limit of the cache in bytes, enforced after the build.
+
+    Returns
+    -------
+    dict
+      With the number of blobs downloaded ('misses'), their total size
+      ('miss_bytes'), and the number of layers of the image taken from the
+      cache ('hits'). The latter is None, if the image manifest was cached,
+      i.e., the image was built from the cache entirely. With concurrent
+      builds, downloads are attributed to all of them.
+    """
+    cache.mkdir(parents=True, exist_ok=True)
+    env = dict(os.environ,
+               APPTAINER_CACHEDIR=str(cache),
+               SINGULARITY_CACHEDIR=str(cache))
+    with _use(cache):
+        before = _list_blobs(cache)
+        WitlessRunner(env=env).run(cmd, cwd=cwd)
+        after = _list_blobs(cache)
+    new = {d: p for d, p in after.items() if d not in before}
+    layers = [d for p in new.values() for d in _get_layers(p)]
+    report = dict(
+        misses=len(new),
+        miss_bytes=sum(p.stat().st_size for p in new.values()),
+        hits=len([d for d in layers if d in before]) if layers else None,
+    )
+    lgr.info(
+        "Build cache %s: %i blob(s) downloaded (%s), %s layer(s) cached",
+        cache, report['misses'], bytes2human(report['miss_bytes']),
+        'all' if report['hits'] is None else report['hits'])
+    if max_size is not None:
+        evict(cache, max_size)
+    return report
+
+
+def evict(cache: Path, max_size: int) -> list:
+    """Remove the least recently used files until the cache is small enough
+
+    Nothing is removed while the cache is used by a build.
+
+    Returns
+    -------
+    list
+      Paths of the removed files.
+    """
+    # builds of this process wait for the eviction
+    with _active_lock:
+        if cache in _active:
+            lgr.debug("Build cache %s is in use, not evicting", cache)
+            return []
+        lock = _get_lock(cache)
+        if not lock.acquire_write_lock(blocking=False):
+            lgr.debug("Build cache %s is in use, not evicting", cache)
+            return []
+        try:
+            return _evict(cache, max_size)
+        finally:
+            lock.release_write_lock()
+
+
+def _list_entries(cache: Path) -> tuple:
+    """Return the entries of the cache, and the status of their files
+
+    An entry is the list of its files. Files of the blob cache can belong to
+    multiple entries. The manifest of an image comes first, and tells when
+    the image was last used.
+    """
+    root = cache / 'cache'
+    if not root.is_dir():
+        return [], {}
+    entries = []
+    for kind in root.iterdir():
+        if kind.name == 'blob' or not kind.is_dir():
+            continue
+        for item in kind.iterdir():
+            files = [Path(r) / n
+                     for r, _, names in os.walk(item) for n in names] \
+                if item.is_dir() and not item.is_symlink() else [item]
+            if files:
+                entries.append(files)
+    blobs = _list_blobs(cache)
+    # before reading the manifests changes their access time
+    stats = {p: p.lstat() for p in blobs.values()}
+    stats.update((f, f.lstat()) for entry in entries for f in entry)
+    referenced = set()
+    for digest, blob in blobs.items():
+        manifest = _read_manifest(blob)
+        if manifest is None:
+            continue
+        refs = [digest] + [
+            d.get('digest') for d in [manifest.get('config')]
+            + manifest['layers'] if isinstance(d, dict)]
+        refs = [d for d in refs if d in blobs]
+        referenced.update(refs)
+        entries.append([blobs[d] for d in refs])
+    # e.g., left behind by an interrupted build
+    entries.extend([blob] for d, blob in blobs.items()
+                   if d not in referenced)
+    return entries, stats
+
+
+def _update_index(cache: Path):
+    # the index of the OCI layout must not list removed manifests
+    index_path = cache / 'cache' / 'blob' / 'index.json'
+    if not index_path.exists():
+        return
+    with index_path.open() as f:
+        index = json.load(f)
+    blobs = _list_blobs(cache)
+    manifests = [m for m in index.get('manifests') or []
+                 if m.get('digest') in blobs]
+    if manifests == index.get('manifests'):
+        return
+    index['manifests'] = manifests
+    tmp = index_path.with_name(index_path.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path)
+
+
+def _evict(cache: Path, max_size: int) -> list:
+    entries, stats = _list_entries(cache)
+    # the number of entries a file belongs to
+    users = Counter(f for entry in entries for f in entry)
+    total = sum(st.st_size for st in stats.values())
+
+    def last_used(entry):
+        # shared layers do not tell about the use of a particular image
+        files = entry[:1] if entry[0].parent.name == 'sha256' else entry
+        return max(max(stats[f].st_atime, stats[f].st_mtime) for f in files)
+
+    removed = []
+    for entry in sorted(entries, key=last_used):
+        if total <= max_size:
+            break
+        for f in entry:
+            users[f] -= 1
+            if not users[f]:
+                f.unlink()
+                total -= stats[f].st_size
+                removed.append(f)
+    if not removed:
+        return removed
+    _update_index(cache)
+    # directories of removed entries, outside of the blob cache
+    for root, _, _ in os.walk(cache / 'cache', topdown=False):
+        root = Path(root)
+        rel = root.relative_to(cache / 'cache').parts
+        if len(rel) > 1 and rel[0] != 'blob' and not any(root.iterdir()):
+            root.rmdir()
+    lgr.info("Removed %i file(s) from build cache %s",
+             len(removed), cache)
+    return removed
@@ -7,14 +7,17 @@ import logging
 import os
 import os.path as op
 import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import (
     Path,
     PurePosixPath,
 )
-from shutil import copyfile
 
 from datalad.cmd import WitlessRunner
 from datalad.distribution.dataset import (
+    Dataset,
     EnsureDataset,
     datasetmethod,
     require_dataset,
@@ -25,14 +28,41 @@ from datalad.interface.base import (
     eval_results,
 )
 from datalad.interface.results import get_status_dict
+from datalad.support.annexrepo import AnnexRepo
 from datalad.support.constraints import (
+    EnsureInt,
     EnsureNone,
     EnsureStr,
 )
-from datalad.support.exceptions import InsufficientArgumentsError
+from datalad.support.exceptions import (
+    CommandError,
+    DownloadError,
+    InsufficientArgumentsError,
+)
+from datalad.support.network import local_path_from_url
 from datalad.support.param import Parameter
+from datalad.utils import get_dataset_root
 
-from .utils import get_container_configuration
+from .build_cache import (
+    get_build_cache,
+    run_build,
+)
+from .image_download import (
+    DOWNLOAD_JOBS_CFG,
+    download_to_annex,
+)
+from .image_store import (
+    add_to_store,
+    add_url_from_store,
+    link_or_copy,
+    may_hardlink,
+    place_annex_object,
+)
+from .utils import (
+    REGISTRATION_LOCK,
+    get_container_configuration,
+    get_dataset_lock,
+)
 
 lgr = logging.getLogger("datalad.containers.containers_add")
 
@@ -79,6 +109,77 @@ def _guess_call_fmt(ds, name, url):
         return '{python} -m datalad_container.adapters.docker run {img} {cmd}'
 
 
+def _get_fingerprint(url, probe=False):
+    """Determine a fingerprint of the image at `url`, without obtaining it
+
+    The fingerprint changes whenever the image does. It is the annex key of
+    a local annexed file, or the digest pinned in a Docker reference (e.g.,
+    'dhub://busybox@sha256:...'). Only with `probe`, a request is made to
+    the registry of a Docker reference with a tag, for the digest of the
+    image it points to, or to an HTTP(S) server, for the headers of a
+    download. Plain local files have no fingerprint: their file status is
+    specific to a host, and must not be committed.
+
+    Returns
+    -------
+    str or None
+      None, if the fingerprint cannot be determined cheaply.
+    """
+    if url.startswith('file://'):
+        url = local_path_from_url(url)
+    if op.lexists(url):
+        root = get_dataset_root(op.dirname(op.abspath(url)))
+        key = _get_annex_key(Dataset(root).repo, url) if root else None
+        return 'key:{}'.format(key) if key else None
+    if url.startswith(('dhub://', 'docker://')):
+        reference = url.split('://', 1)[1]
+        _, _, digest = reference.partition('@')
+        if digest or not probe:
+            return 'digest:{}'.format(digest) if digest else None
+        import requests
+
+        from .adapters.registry import (
+            RegistryClient,
+            RegistryError,
+            parse_reference,
+        )
+        ref = parse_reference(reference)
+        try:
+            _, digest = RegistryClient(
+                ref['registry'], ref['repository']).get_manifest(ref['tag'])
+        except (RegistryError, requests.RequestException) as e:
+            lgr.debug("Cannot determine fingerprint of %s: %s", url, e)
+            return None
+        return 'digest:{}'.format(digest)
+    if probe and url.startswith(('http://', 'https://')):
+        import requests
+        try:
+            r = requests.head(url, allow_redirects=True, timeout=30)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            lgr.debug("Cannot determine fingerprint of %s: %s", url, e)
+            return None
+        if r.headers.get('ETag'):
+            return 'etag:{}'.format(r.headers['ETag'])
+        if r.headers.get('Last-Modified'):
+            return 'modified:{}:{}'.format(
+                r.headers['Last-Modified'],
+                r.headers.get('Content-Length', ''))
+    return None
+
+
+def _ensure_fingerprint(spec):
+    """Return the fingerprint of the image of `spec`, probing its source
+
+    A fingerprint determined by probing is recorded in `spec`.
+    """
+    if not spec['fingerprint']:
+        fingerprint = _get_fingerprint(spec['imgurl'], probe=True)
+        if fingerprint:
+            spec['fingerprint'] = '{} {}'.format(spec['imgurl'], fingerprint)
+    return spec['fingerprint']
+
+
 def _ensure_datalad_remote(repo):
     """Initialize and enable datalad special remote if it isn't already."""
     dl_remote = None
@@ -101,6 +202,662 @@ def _ensure_datalad_remote(repo):
         repo.enable_remote(dl_remote)
 
 
+# fields of a container in a manifest, see `containers-add --from`
+_MANIFEST_FIELDS = ('name', 'url', 'call_fmt', 'image', 'extra_input',
+                    'overlay_size')
+
+
+def _check_name(name):
+    # prevent madness in the config file
+    if not re.match(r'^[0-9a-zA-Z-]+$', name):
+        raise ValueError(
+            "Container names can only contain alphanumeric characters "
+            "and '-', got: '{}'".format(name))
+
+
+def _load_manifest(path):
+    """Read the specifications of containers from a JSON or YAML file
+
+    The containers are given as a list of objects with the fields in
+    `_MANIFEST_FIELDS`, or as an object mapping names to the other fields.
+    """
+    with open(path) as f:
+        if op.splitext(path)[1].lower() in ('.yml', '.yaml'):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ValueError(
+                    "Reading the YAML manifest {} requires PyYAML"
+                    .format(path)) from e
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [dict(props or {}, name=name)
+                 for name, props in specs.items()]
+    if not isinstance(specs, list) \
+            or not all(isinstance(s, dict) for s in specs):
+        raise ValueError(
+            "The manifest {} does not list containers".format(path))
+    return specs
+
+
+def _get_spec(ds, name, url=None, call_fmt=None, image=None, update=False,
+              extra_input=None, overlay_size=None):
+    """Determine how to add a container, considering its current setup
+
+    Returns
+    -------
+    tuple
+      The specification of the container, with the absolute path of the
+      'image', and None. Or None and a result record, if the container
+      cannot be added as specified.
+    """
+    container_cfg = get_container_configuration(ds, name)
+    if 'image' in container_cfg:
+        if not update:
+            return None, get_status_dict(
+                action="containers_add", ds=ds, logger=lgr,
+                status="impossible",
+                message=("Container named %r already exists. "
+                         "Use --update to reconfigure.",
+                         name))
+
+        if not (url or image or call_fmt or overlay_size):
+            # No updated values were provided. See if an update url is
+            # configured (currently relevant only for Singularity Hub).
+            url = container_cfg.get("updateurl")
+            if not url:
+                return None, get_status_dict(
+                    action="containers_add", ds=ds, logger=lgr,
+                    status="impossible",
+                    message="No values to update specified")
+
+        call_fmt = call_fmt or container_cfg.get("cmdexec")
+        image = image or container_cfg.get("image")
+        overlay_size = overlay_size or container_cfg.get("overlay-size")
+
+    if not image:
+        loc_cfg_var = "datalad.containers.location"
+        container_loc = \
+            ds.config.obtain(
+                loc_cfg_var,
+                # if not False it would actually modify the
+                # dataset config file -- undesirable
+                store=False,
+            )
+        image = op.join(ds.path, container_loc, name, 'image')
+    else:
+        image = op.join(ds.path, image)
+
+    if call_fmt is None:
+        # maybe built in knowledge can help
+        call_fmt = _guess_call_fmt(ds, name, url)
+
+    if call_fmt and '{overlay}' in call_fmt and not overlay_size:
+        return None, get_status_dict(
+            action="containers_add", ds=ds, logger=lgr,
+            status="impossible",
+            message="The call format uses an overlay, but no "
+                    "overlay size is specified")
+
+    # --extra-input sanity check
+    # TODO: might also want to do that for --call-fmt above?
+    extra_input_placeholders = dict(img_dirpath="", img_dspath="")
+    for xi in (extra_input or []):
+        try:
+            xi.format(**extra_input_placeholders)
+        except KeyError as exc:
+            return None, get_status_dict(
+                action="containers_add", ds=ds, logger=lgr,
+                status="error",
+                message=("--extra-input %r contains unknown placeholder %s. "
+                         "Available placeholders: %s",
+                         repr(xi), exc, ', '.join(extra_input_placeholders)))
+
+    imgurl = _resolve_img_url(url) if url else url
+    # the fingerprint is recorded with the URL it is valid for. It is
+    # determined on the initial add, too, such that the first update can
+    # tell whether the image changed.
+    fingerprint = _get_fingerprint(imgurl, probe=True) if url else None
+    if fingerprint:
+        fingerprint = '{} {}'.format(imgurl, fingerprint)
+    return dict(
+        name=name,
+        url=url,
+        imgurl=imgurl,
+        image=image,
+        call_fmt=call_fmt,
+        extra_input=extra_input or [],
+        overlay_size=overlay_size,
+        update=update,
+        was_updated=False,
+        fingerprint=fingerprint,
+        cfg=container_cfg,
+        # annex key of identical content, known before obtaining the image
+        key=None,
+        # report on the use of the build cache
+        build_cache=None,
+        # whether the image is known to be the one at `url` already
+        current=bool(
+            fingerprint and op.lexists(image)
+            and fingerprint == container_cfg.get('fingerprint')),
+    ), None
+
+
+def _find_duplicate(ds, spec):
+    if _needs_image(spec):
+        spec['key'] = _find_registered_duplicate(ds, spec)
+
+
+def _needs_image(spec):
+    return bool(spec['url']) and not spec['current']
+
+
+def _is_unchanged(ds, spec):
+    # an update that neither changed the image nor the configuration
+    return spec['current'] \
+        and get_container_configuration(ds, spec['name']) == spec['cfg']
+
+
+def _remove_outdated_image(ds, spec):
+    """Remove the image of a container that is updated from a URL
+
+    The removal is only staged, and saved together with the new image. The
+    content of the outdated image is kept in the annex.
+
+    Returns
+    -------
+    list
+      The results of the removal.
+    """
+    if not (spec['update'] and op.lexists(spec['image'])):
+        return []
+    spec['was_updated'] = True
+    with get_dataset_lock(ds, REGISTRATION_LOCK):
+        removed = ds.repo.remove([spec['image']], recursive=True, force=True)
+    return [get_status_dict(action="remove", ds=ds,
+                            path=op.join(ds.path, p), status="ok",
+                            logger=lgr)
+            for p in removed]
+
+
+def _is_annexed_url(url):
+    # anything that is not pulled, built, or copied is left to git-annex
+    return not (url.startswith(("dhub://", "docker://")) or op.exists(url))
+
+
+def _build_image(image, url, build_cache=None):
+    """Create an image from a Docker Hub or Singularity URL, or a local file
+
+    Only the file system is modified, so images can be created in parallel.
+
+    Parameters
+    ----------
+    build_cache: tuple, optional
+      Location and size limit of the managed cache for builds from
+      'docker://' URLs, as returned by `get_build_cache()`.
+
+    Returns
+    -------
+    dict or None
+      Report on the use of the build cache, if it was used.
+    """
+    runner = WitlessRunner()
+    if url.startswith("dhub://"):
+        from .adapters import (
+            docker,
+            registry,
+        )
+
+        docker_image = url[len("dhub://"):]
+
+        try:
+            registry.pull(docker_image, image)
+            return None
+        except registry.RegistryError as e:
+            # e.g., an image that requires a login, which docker may have
+            if not shutil.which("docker"):
+                raise
+            lgr.info("Could not pull %s from its registry, "
+                     "trying docker: %s", docker_image, e)
+        lgr.debug(
+            "Running 'docker pull %s and saving image to %s",
+            docker_image, image)
+        runner.run(["docker", "pull", docker_image])
+        docker.save(docker_image, image)
+    elif url.startswith("docker://"):
+        image_dir, image_basename = op.split(image)
+        if not image_basename:
+            raise ValueError("No basename in path {}".format(image))
+        if image_dir:
+            os.makedirs(image_dir, exist_ok=True)
+
+        lgr.info("Building Singularity image for %s "
+                 "(this may take some time)",
+                 url)
+        cmd = ["singularity", "build", image_basename, url]
+        if build_cache:
+            return run_build(cmd, image_dir or None, *build_cache)
+        runner.run(cmd, cwd=image_dir or None)
+    else:
+        image_dir = op.dirname(image)
+        if image_dir:
+            os.makedirs(image_dir, exist_ok=True)
+        # not hardlinked, annexing the image would also make the source
+        # read-only
+        how = link_or_copy(url, image, hardlink=False)
+        lgr.info("Imported local file %s to %s (%s)", url, image, how)
+
+
+def _import_annexed_file(ds, src, image):
+    """Add an annexed local file as an image, under its existing annex key
+
+    The content of `src` is neither read nor hashed, but hardlinked (or
+    reflinked, or copied) into the annex of `ds`, unless it is present there
+    already.
+
+    Returns
+    -------
+    str or None
+      How the content was placed (see `link_or_copy`), or None if `src` is
+      not an annexed file with content, and nothing was done.
+    """
+    repo = ds.repo
+    src_root = get_dataset_root(op.dirname(op.abspath(src)))
+    if not isinstance(repo, AnnexRepo) or not src_root:
+        return None
+    src_repo = Dataset(src_root).repo
+    key = _get_annex_key(src_repo, src, with_content=True)
+    if not key:
+        return None
+    if repo.call_annex_success(['contentlocation', key]):
+        how = 'present'
+    else:
+        try:
+            how = place_annex_object(
+                repo, key,
+                src_repo.pathobj / src_repo.call_annex_oneline(
+                    ['contentlocation', key]),
+                hardlink=may_hardlink(src_repo))
+        except ValueError as e:
+            lgr.debug("Cannot import annexed file %s: %s", src, e)
+            return None
+    _add_by_key(ds, key, image)
+    lgr.info("Imported annexed file %s to %s (%s)", src, image, how)
+    return how
+
+
+def _get_annex_key(repo, path, with_content=False):
+    """Return the annex key of a file, if it is annexed (with content)"""
+    if not isinstance(repo, AnnexRepo):
+        return None
+    info = repo.get_content_annexinfo(
+        paths=[op.abspath(path)], init=None, eval_availability=with_content)
+    props = next(iter(info.values()), {})
+    if with_content and not props.get('has_content'):
+        return None
+    return props.get('key')
+
+
+def _add_by_key(ds, key, image):
+    """Create an annexed file for a key known to the annex of `ds`"""
+    repo = ds.repo
+    os.makedirs(op.dirname(image), exist_ok=True)
+    # the content may be available elsewhere only
+    force = not repo.call_annex_success(['contentlocation', key])
+    with get_dataset_lock(ds, REGISTRATION_LOCK):
+        repo.call_annex(
+            ['fromkey'] + (['--force'] if force else [])
+            + [key, op.relpath(image, repo.path)])
+
+
+def _get_identity(fingerprint):
+    """Return what identifies an image by its recorded fingerprint
+
+    Two images with the same identity are identical: they come from the same
+    URL with the same fingerprint, or have the same content digest or annex
+    key.
+    """
+    if not fingerprint:
+        return None
+    url, fingerprint_ = fingerprint.split(' ', 1)
+    if url.startswith('dhub://'):
+        # an image directory rather than a file
+        return None
+    if fingerprint_.startswith('digest:'):
+        # a digest identifies the content regardless of the URL, but the
+        # image built from it depends on the kind of source
+        return '{} {}'.format(url.split('://', 1)[0], fingerprint_)
+    if fingerprint_.startswith('key:'):
+        return fingerprint_
+    return fingerprint
+
+
+def _find_registered_duplicate(ds, spec):
+    """Return the key of the image of another container that is identical
+
+    Each registered container is identified by the fingerprint recorded with
+    its own URL.
+
+    Returns
+    -------
+    str or None
+    """
+    configs = {
+        name: cfg for name, cfg in get_container_configuration(ds).items()
+        if name != spec['name'] and cfg.get('fingerprint') and 'image' in cfg
+        # an image directory has no single key
+        and not op.isdir(op.join(ds.path, cfg['image']))}
+    if any(cfg['fingerprint'].split(' ', 1)[0] == spec['imgurl']
+           for cfg in configs.values()):
+        # the source is only probed, if an image from the same URL may be
+        # reused
+        _ensure_fingerprint(spec)
+    identity = _get_identity(spec['fingerprint'])
+    if not identity:
+        return None
+    for name, cfg in configs.items():
+        if _get_identity(cfg['fingerprint']) != identity:
+            continue
+        key = _get_annex_key(ds.repo, op.join(ds.path, cfg['image']))
+        if key:
+            lgr.info("Image of container %r is identical to that of %r",
+                     spec['name'], name)
+            return key
+    return None
+
+
+def _add_annexed_urls(ds, specs, jobs=None):
+    """Create annexed images from URLs, downloading them in parallel
+
+    Content known to the image store is taken from there. Large images from
+    HTTP(S) servers that support range requests are downloaded in chunks.
+    All other images are added by a single git-annex process.
+
+    Returns
+    -------
+    dict
+      Mapping of the paths of images that could not be added to a
+      description of the problem.
+    """
+    repo = ds.repo
+    if _HAS_SHUB_DOWNLOADER \
+            and any(s['url'].startswith('shub://') for s in specs):
+        _ensure_datalad_remote(repo)
+
+    pending = [s for s in specs
+               if not add_url_from_store(
+                   ds, s['image'], s['imgurl'],
+                   partial(_ensure_fingerprint, s))]
+    errors = {}
+    download_jobs = ds.config.obtain(DOWNLOAD_JOBS_CFG)
+    for spec in list(pending):
+        if download_jobs < 2 \
+                or not spec['imgurl'].startswith(('http://', 'https://')):
+            continue
+        try:
+            if not download_to_annex(ds, spec['imgurl'], spec['image'],
+                                     jobs=download_jobs):
+                continue
+        except (CommandError, DownloadError) as e:
+            errors[spec['image']] = str(e)
+        pending.remove(spec)
+    if not pending:
+        return errors
+    for spec in pending:
+        lgr.debug('Attempt to obtain container image from: %s',
+                  spec['imgurl'])
+        os.makedirs(op.dirname(spec['image']), exist_ok=True)
+    stdin = ''.join(
+        '{} {}\n'.format(s['imgurl'], op.relpath(s['image'], repo.path))
+        for s in pending).encode()
+    failure = None
+    try:
+        # the files are staged as soon as they are downloaded
+        with get_dataset_lock(ds, REGISTRATION_LOCK):
+            records = repo._call_annex_records(
+                ['addurl', '--with-files', '--batch'], jobs=jobs,
+                stdin=stdin)
+    except CommandError as e:
+        records = e.kwargs.get('stdout_json', [])
+        failure = str(e)
+    errors.update({
+        op.join(repo.path, r['file']):
+            '; '.join(r.get('error-messages') or [])
+            or r.get('note', 'unknown error')
+        for r in records if not r.get('success') and r.get('file')
+    })
+    if failure:
+        for spec in pending:
+            if spec['image'] not in errors \
+                    and not op.lexists(spec['image']):
+                errors[spec['image']] = failure
+    return errors
+
+
+def _configure(ds, spec):
+    """Write the configuration of a container
+
+    The configuration is not reloaded, such that it can be done once for
+    multiple containers.
+    """
+    cfgbasevar = "datalad.containers.{}".format(spec['name'])
+    cfgfingerprintvar = "{}.fingerprint".format(cfgbasevar)
+    if spec['fingerprint']:
+        ds.config.set(cfgfingerprintvar,
+                      spec['fingerprint'], force=True, reload=False)
+    elif ds.config.get(cfgfingerprintvar) is not None:
+        # the one of a previous image must not be mistaken for this one's
+        ds.config.unset(cfgfingerprintvar, reload=False)
+    if spec['imgurl'] != spec['url']:
+        # store originally given URL, as it resolves to something
+        # different and maybe can be used to update the container
+        # at a later point in time
+        ds.config.set("{}.updateurl".format(cfgbasevar), spec['url'],
+                      reload=False)
+    # force store the image, and prevent multiple entries
+    ds.config.set(
+        "{}.image".format(cfgbasevar),
+        # always store a POSIX path, relative to dataset root
+        str(PurePosixPath(Path(spec['image']).relative_to(ds.pathobj))),
+        force=True, reload=False)
+    if spec['call_fmt']:
+        ds.config.set(
+            "{}.cmdexec".format(cfgbasevar),
+            spec['call_fmt'],
+            force=True, reload=False)
+    if spec['overlay_size']:
+        ds.config.set(
+            "{}.overlay-size".format(cfgbasevar),
+            str(spec['overlay_size']),
+            force=True, reload=False)
+
+    # actually setting --extra-input config
+    cfgextravar = "{}.extra-input".format(cfgbasevar)
+    if ds.config.get(cfgextravar) is not None:
+        ds.config.unset(cfgextravar, reload=False)
+    for xi in spec['extra_input']:
+        ds.config.add(cfgextravar, xi, reload=False)
+
+
+def _register(ds, specs, to_save, message):
+    """Configure containers and save the changes
+
+    Concurrent registrations in the same dataset, by other processes, are
+    serialized. Obtaining the images does not need to be.
+
+    Returns
+    -------
+    list
+      The results of the save.
+    """
+    with get_dataset_lock(ds, REGISTRATION_LOCK):
+        # the configuration may have been changed by another process
+        ds.config.reload(force=True)
+        for spec in specs:
+            _configure(ds, spec)
+        ds.config.reload()
+        return list(ds.save(path=to_save, message=message))
+
+
+def _add_from_manifest(ds, manifest, update=False, jobs=None):
+    """Add all containers listed in a manifest, with a single commit"""
+    specs = []
+    problems = []
+    for entry in _load_manifest(manifest):
+        name = entry.get('name')
+        unknown = set(entry).difference(_MANIFEST_FIELDS)
+        problem = None
+        if not isinstance(name, str) or not name:
+            problem = ("Container without a name in %s", manifest)
+        elif unknown:
+            problem = ("Unknown field(s) for container %r: %s",
+                       name, ', '.join(sorted(unknown)))
+        elif any(s['name'] == name for s in specs):
+            problem = ("Container %r is listed more than once", name)
+        else:
+            try:
+                _check_name(name)
+            except ValueError as e:
+                problem = str(e)
+        if problem:
+            problems.append(get_status_dict(
+                action="containers_add", ds=ds, logger=lgr,
+                status="impossible", message=problem))
+            continue
+        extra_input = entry.get('extra_input')
+        spec, res = _get_spec(
+            ds, name,
+            url=entry.get('url'),
+            call_fmt=entry.get('call_fmt'),
+            image=entry.get('image'),
+            update=update,
+            extra_input=[extra_input] if isinstance(extra_input, str)
+            else extra_input,
+            overlay_size=entry.get('overlay_size'))
+        if res:
+            problems.append(res)
+        elif any(s['image'] == spec['image'] for s in specs):
+            problems.append(get_status_dict(
+                action="containers_add", ds=ds, logger=lgr,
+                status="impossible",
+                message=("Image %s of container %r is used by another "
+                         "container", spec['image'], name)))
+        else:
+            specs.append(spec)
+    if problems:
+        # nothing is done, unless all containers can be added
+        for res in problems:
+            yield res
+        return
+
+    for spec in specs:
+        if _needs_image(spec):
+            for r in _remove_outdated_image(ds, spec):
+                yield r
+    # identical images are obtained once
+    pending = []
+    duplicates = []
+    firsts = {}
+    for spec in specs:
+        if not _needs_image(spec):
+            continue
+        _find_duplicate(ds, spec)
+        # without a fingerprint, the same URL gives the same image within
+        # a single call
+        identity = _get_identity(spec['fingerprint']) or (
+            None if spec['imgurl'].startswith('dhub://') else spec['imgurl'])
+        if spec['key']:
+            _add_by_key(ds, spec['key'], spec['image'])
+        elif identity in firsts:
+            duplicates.append((spec, firsts[identity]))
+        else:
+            if identity:
+                firsts[identity] = spec
+            pending.append(spec)
+    annexed = [s for s in pending if _is_annexed_url(s['url'])]
+    built = []
+    for spec in pending:
+        if spec in annexed:
+            continue
+        # annexed local files are imported right away, by their key
+        if op.exists(spec['url']) \
+                and _import_annexed_file(ds, spec['url'], spec['image']):
+            continue
+        built.append(spec)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        build_cache = get_build_cache(ds)
+        futures = [(s, executor.submit(_build_image, s['image'], s['url'],
+                                       build_cache))
+                   for s in built]
+        # downloads by git-annex run alongside the builds
+        errors = _add_annexed_urls(ds, annexed, jobs=jobs or 'auto') \
+            if annexed else {}
+        for spec, future in futures:
+            if future.exception():
+                errors[spec['image']] = str(future.exception())
+            else:
+                spec['build_cache'] = future.result()
+    for spec, first in duplicates:
+        if first['image'] in errors or not op.lexists(first['image']):
+            errors[spec['image']] = 'identical image {} not obtained'.format(
+                first['image'])
+            continue
+        key = _get_annex_key(ds.repo, first['image'])
+        if key:
+            _add_by_key(ds, key, spec['image'])
+        else:
+            # not annexed yet, the copy is annexed under the same key
+            os.makedirs(op.dirname(spec['image']), exist_ok=True)
+            link_or_copy(first['image'], spec['image'], hardlink=False)
+
+    added = []
+    for spec in specs:
+        result = get_status_dict(
+            action="containers_add",
+            path=spec['image'],
+            type="file",
+            logger=lgr,
+        )
+        if spec['build_cache']:
+            result['build_cache'] = spec['build_cache']
+        if spec['image'] in errors:
+            yield dict(result, status="error",
+                       message=('cannot obtain image: %s',
+                                errors[spec['image']]))
+        elif not op.lexists(spec['image']):
+            yield dict(result, status="error",
+                       message=('no image at %s', spec['image']))
+        else:
+            added.append((spec, result))
+    if not added:
+        return
+
+    # store configs and changes
+    to_save = [s['image'] for s, _ in added if _needs_image(s)]
+    to_save.append(op.join(".datalad", "config"))
+    for r in _register(
+            ds, [s for s, _ in added], to_save,
+            message="[DATALAD] Configure {} containerized environments"
+                    "\n\n{}".format(
+                        len(added),
+                        '\n'.join("{} '{}'".format(
+                            "Update" if s['was_updated'] else "Configure",
+                            s['name']) for s, _ in added))):
+        yield r
+    for spec, result in added:
+        if _is_unchanged(ds, spec):
+            yield dict(result, status="notneeded",
+                       message="image is up to date")
+            continue
+        # share the image with other datasets on this host, if configured
+        add_to_store(ds, [spec['image']],
+                     url=spec['imgurl'] if spec in annexed else None,
+                     get_fingerprint=partial(_ensure_fingerprint, spec))
+        yield dict(result, status="ok")
+
+
 @build_doc
 # all commands must be derived from Interface
 class ContainersAdd(Interface):
@@ -124,7 +881,8 @@ class ContainersAdd(Interface):
                 determines the default location of the container image
                 within the dataset.""",
             metavar="NAME",
-            constraints=EnsureStr(),
+            nargs="?",
+            constraints=EnsureStr() | EnsureNone(),
         ),
         url=Parameter(
             args=("-u", "--url"),
@@ -135,8 +893,10 @@ class ContainersAdd(Interface):
             Singularity-based execution will be auto-configured when
             [CMD: --call-fmt CMD][PY: call_fmt PY] is not specified.
             For Docker-based container execution with the URL scheme 'dhub://',
-            the rest of the URL will be interpreted as the argument to
-            'docker pull', the image will be saved to a location
+            the rest of the URL will be interpreted as a Docker image
+            reference (as for 'docker pull'), the image will be pulled from
+            its registry without the need for a Docker daemon (falling back
+            to 'docker pull' if that fails) and saved to a location
             specified by `name`, and the call format will be auto-configured
             to run docker, unless overwritten. The auto-configured call to docker
             run mounts the CWD to '/tmp' and sets the working directory to '/tmp'.""",
@@ -155,6 +915,8 @@ class ContainersAdd(Interface):
             replaced with the desired command. Additional placeholders:
             '{img_dspath}' is relative path to the dataset containing the image,
             '{img_dirpath}' is the directory containing the '{img}'.
+            '{overlay}' is the path to a writable overlay image (see
+            [CMD: --overlay-size CMD][PY: overlay_size PY]).
             '{python}' expands to the path of the Python executable that is
             running the respective DataLad session, for example a
             'datalad containers-run' command.
@@ -188,71 +950,88 @@ class ContainersAdd(Interface):
             constraints=EnsureStr() | EnsureNone(),
 
         ),
+        overlay_size=Parameter(
+            args=("--overlay-size",),
+            doc="""Size in MiB of a writable overlay image that is provided to
+            each execution in this container, via the '{overlay}' placeholder
+            of [CMD: --call-fmt CMD][PY: call_fmt PY] (e.g., "apptainer exec
+            --overlay {overlay} {img} {cmd}"). Concurrent executions are given
+            separate overlays, which are taken from a pool of pre-created
+            ones, and reset after each execution. Hence, changes to an
+            overlay are never persistent. The run record holds the
+            placeholder, an overlay is only allocated for the execution
+            (also of a rerun).""",
+            metavar="MIB",
+            constraints=EnsureInt() | EnsureNone(),
+        ),
         update=Parameter(
             args=("--update",),
             action="store_true",
             doc="""Update the existing container for `name`. If no other
             options are specified, URL will be set to 'updateurl', if
             configured. If a container with `name` does not already exist, this
-            option is ignored."""
-        )
+            option is ignored. The image is not obtained again, if a
+            fingerprint of the image at the URL (from the HTTP headers, the
+            digest of a Docker reference as pinned or reported by its
+            registry, or the annex key of a local file) matches the one
+            recorded when the image was added or last updated."""
+        ),
+        from_file=Parameter(
+            args=("--from",),
+            dest="from_file",
+            doc="""Add all containers listed in this JSON (or, with PyYAML
+            installed, YAML) file, instead of a single one. The file lists
+            objects with the fields 'name', 'url', 'call_fmt', 'image',
+            'extra_input', and 'overlay_size', corresponding to the options
+            of this command, or maps names to objects with the other fields.
+            All entries are validated before any image is obtained, and
+            nothing is done if any of them is invalid. Images are obtained
+            in parallel, and all containers are saved in a single commit.
+            [CMD: --update CMD][PY: `update` PY] applies to all of them.""",
+            metavar="FILE",
+            constraints=EnsureStr() | EnsureNone(),
+        ),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            doc="""Number of images obtained in parallel when adding
+            containers from a manifest. By default, it is derived from the
+            number of CPUs.""",
+            metavar="NJOBS",
+            constraints=EnsureInt() | EnsureNone(),
+        ),
     )
 
     @staticmethod
     @datasetmethod(name='containers_add')
     @eval_results
-    def __call__(name, url=None, dataset=None, call_fmt=None, image=None,
-                 update=False, extra_input=None):
+    def __call__(name=None, url=None, dataset=None, call_fmt=None,
+                 image=None, update=False, extra_input=None,
+                 overlay_size=None, from_file=None, jobs=None):
+        if from_file:
+            if name:
+                raise ValueError(
+                    "A container name cannot be given with a manifest")
+            ds = require_dataset(dataset, check_installed=True,
+                                 purpose='add containers')
+            for r in _add_from_manifest(ds, from_file, update=update,
+                                        jobs=jobs):
+                yield r
+            return
+
         if not name:
             raise InsufficientArgumentsError("`name` argument is required")
 
         ds = require_dataset(dataset, check_installed=True,
                              purpose='add container')
-        runner = WitlessRunner()
-
-        # prevent madness in the config file
-        if not re.match(r'^[0-9a-zA-Z-]+$', name):
-            raise ValueError(
-                "Container names can only contain alphanumeric characters "
-                "and '-', got: '{}'".format(name))
-
-        container_cfg = get_container_configuration(ds, name)
-        if 'image' in container_cfg:
-            if not update:
-                yield get_status_dict(
-                    action="containers_add", ds=ds, logger=lgr,
-                    status="impossible",
-                    message=("Container named %r already exists. "
-                             "Use --update to reconfigure.",
-                             name))
-                return
-
-            if not (url or image or call_fmt):
-                # No updated values were provided. See if an update url is
-                # configured (currently relevant only for Singularity Hub).
-                url = container_cfg.get("updateurl")
-                if not url:
-                    yield get_status_dict(
-                        action="containers_add", ds=ds, logger=lgr,
-                        status="impossible",
-                        message="No values to update specified")
-                    return
-
-            call_fmt = call_fmt or container_cfg.get("cmdexec")
-            image = image or container_cfg.get("image")
-
-        if not image:
-            loc_cfg_var = "datalad.containers.location"
-            container_loc = \
-                ds.config.obtain(
-                    loc_cfg_var,
-                    # if not False it would actually modify the
-                    # dataset config file -- undesirable
-                    store=False,
-                )
-            image = op.join(ds.path, container_loc, name, 'image')
-        else:
-            image = op.join(ds.path, image)
+
+        _check_name(name)
+        spec, res = _get_spec(
+            ds, name, url=url, call_fmt=call_fmt, image=image, update=update,
+            extra_input=extra_input, overlay_size=overlay_size)
+        if res:
+            yield res
+            return
+        image = spec['image']
 
         result = get_status_dict(
             action="containers_add",
@@ -261,64 +1040,26 @@ class ContainersAdd(Interface):
             logger=lgr,
         )
 
-        if call_fmt is None:
-            # maybe built in knowledge can help
-            call_fmt = _guess_call_fmt(ds, name, url)
-
         # collect bits for a final and single save() call
         to_save = []
-        imgurl = url
-        was_updated = False
-        if url:
-            if update and op.lexists(image):
-                was_updated = True
-                # XXX: check=False is used to avoid dropping the image. It
-                # should use drop=False if remove() gets such an option (see
-                # DataLad's gh-2673).
-                for r in ds.remove(image, reckless='availability',
-                                   return_type="generator"):
-                    yield r
-
-            imgurl = _resolve_img_url(url)
-            lgr.debug('Attempt to obtain container image from: %s', imgurl)
-            if url.startswith("dhub://"):
-                from .adapters import docker
-
-                docker_image = url[len("dhub://"):]
-
-                lgr.debug(
-                    "Running 'docker pull %s and saving image to %s",
-                    docker_image, image)
-                runner.run(["docker", "pull", docker_image])
-                docker.save(docker_image, image)
-            elif url.startswith("docker://"):
-                image_dir, image_basename = op.split(image)
-                if not image_basename:
-                    raise ValueError("No basename in path {}".format(image))
-                if image_dir and not op.exists(image_dir):
-                    os.makedirs(image_dir)
-
-                lgr.info("Building Singularity image for %s "
-                         "(this may take some time)",
-                         url)
-                runner.run(["singularity", "build", image_basename, url],
-                           cwd=image_dir or None)
-            elif op.exists(url):
-                lgr.info("Copying local file %s to %s", url, image)
-                image_dir = op.dirname(image)
-                if image_dir and not op.exists(image_dir):
-                    os.makedirs(image_dir)
-                copyfile(url, image)
-            else:
-                if _HAS_SHUB_DOWNLOADER and url.startswith('shub://'):
-                    _ensure_datalad_remote(ds.repo)
-
-                try:
-                    ds.repo.add_url_to_file(image, imgurl)
-                except Exception as e:
+        # URL the image was obtained from via annex, if any
+        annexed_url = None
+        if _needs_image(spec):
+            for r in _remove_outdated_image(ds, spec):
+                yield r
+            _find_duplicate(ds, spec)
+            if spec['key']:
+                _add_by_key(ds, spec['key'], image)
+            elif _is_annexed_url(url):
+                annexed_url = spec['imgurl']
+                for msg in _add_annexed_urls(ds, [spec]).values():
                     result["status"] = "error"
-                    result["message"] = str(e)
+                    result["message"] = msg
                     yield result
+            elif not (op.exists(url)
+                      and _import_annexed_file(ds, url, image)):
+                spec['build_cache'] = _build_image(
+                    image, url, get_build_cache(ds))
             # TODO do we have to take care of making the image executable
             # if --call_fmt is not provided?
             to_save.append(image)
@@ -331,53 +1072,23 @@ class ContainersAdd(Interface):
             yield result
             return
 
-        # store configs
-        cfgbasevar = "datalad.containers.{}".format(name)
-        if imgurl != url:
-            # store originally given URL, as it resolves to something
-            # different and maybe can be used to update the container
-            # at a later point in time
-            ds.config.set("{}.updateurl".format(cfgbasevar), url)
-        # force store the image, and prevent multiple entries
-        ds.config.set(
-            "{}.image".format(cfgbasevar),
-            # always store a POSIX path, relative to dataset root
-            str(PurePosixPath(Path(image).relative_to(ds.pathobj))),
-            force=True)
-        if call_fmt:
-            ds.config.set(
-                "{}.cmdexec".format(cfgbasevar),
-                call_fmt,
-                force=True)
-        # --extra-input sanity check
-        # TODO: might also want to do that for --call-fmt above?
-        extra_input_placeholders = dict(img_dirpath="", img_dspath="")
-        for xi in (extra_input or []):
-            try:
-                xi.format(**extra_input_placeholders)
-            except KeyError as exc:
-                yield get_status_dict(
-                    action="containers_add", ds=ds, logger=lgr,
-                    status="error",
-                    message=("--extra-input %r contains unknown placeholder %s. "
-                             "Available placeholders: %s",
-                             repr(xi), exc, ', '.join(extra_input_placeholders)))
-                return
-
-        # actually setting --extra-input config
-        cfgextravar = "{}.extra-input".format(cfgbasevar)
-        if ds.config.get(cfgextravar) is not None:
-            ds.config.unset(cfgextravar)
-        for xi in (extra_input or []):
-            ds.config.add(cfgextravar, xi)
-
-        # store changes
+        # store configs and changes
         to_save.append(op.join(".datalad", "config"))
-        for r in ds.save(
-                path=to_save,
+        for r in _register(
+                ds, [spec], to_save,
                 message="[DATALAD] {do} containerized environment '{name}'".format(
-                    do="Update" if was_updated else "Configure",
+                    do="Update" if spec['was_updated'] else "Configure",
                     name=name)):
             yield r
+        if _is_unchanged(ds, spec):
+            result["status"] = "notneeded"
+            result["message"] = "image is up to date"
+            yield result
+            return
+        if spec['build_cache']:
+            result["build_cache"] = spec['build_cache']
+        # share the image with other datasets on this host, if configured
+        add_to_store(ds, [image], url=annexed_url,
+                     get_fingerprint=partial(_ensure_fingerprint, spec))
         result["status"] = "ok"
         yield result
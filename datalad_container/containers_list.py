@@ -4,6 +4,7 @@ __docformat__ = 'restructuredtext'
 
 import logging
 import os.path as op
+import time
 
 import datalad.support.ansi_colors as ac
 from datalad.coreapi import subdatasets
@@ -25,6 +26,10 @@ from datalad.support.constraints import EnsureNone
 from datalad.support.param import Parameter
 from datalad.ui import ui
 
+from datalad_container.usage_index import (
+    get_usage,
+    update_usage_index,
+)
 from datalad_container.utils import get_container_configuration
 
 lgr = logging.getLogger("datalad.containers.containers_list")
@@ -56,14 +61,38 @@ class ContainersList(Interface):
             subdatasets that are reported by :command:`datalad subdatasets
             --contains=PATH`). Top-level containers are always reported."""),
         recursive=recursion_flag,
+        usage=Parameter(
+            args=('--usage',),
+            action='store_true',
+            doc="""report how the containers were used in the history of
+            the dataset: the number of containerized runs, the date of the
+            last one, their total run time (as far as recorded), and the
+            commits with their inputs and outputs. The run records are
+            indexed in an SQLite database in the .git directory of the
+            dataset, which is brought up to date with the commits that were
+            added since it was last queried."""),
     )
 
     @staticmethod
     @datasetmethod(name='containers_list')
     @eval_results
-    def __call__(dataset=None, recursive=False, contains=None):
+    def __call__(dataset=None, recursive=False, contains=None, usage=False):
         ds = require_dataset(dataset, check_installed=True,
                              purpose='list containers')
+        if usage:
+            db = update_usage_index(ds)
+            try:
+                for res in ds.containers_list(
+                        recursive=recursive, contains=contains,
+                        return_type='generator', result_renderer='disabled',
+                        on_failure='ignore', result_filter=None,
+                        result_xfm=None):
+                    if res.get('action') == 'containers':
+                        res['usage'] = get_usage(db, name=res['name'])
+                    yield res
+            finally:
+                db.close()
+            return
         refds = ds.path
 
         if recursive:
@@ -110,6 +139,18 @@ class ContainersList(Interface):
             default_result_renderer(res)
         else:
             ui.message(
-                "{name} -> {path}"
+                "{name} -> {path}{usage}"
                 .format(name=ac.color_word(res["name"], ac.MAGENTA),
-                        path=op.relpath(res["path"], res["refds"])))
+                        path=op.relpath(res["path"], res["refds"]),
+                        usage=_format_usage(res.get('usage'))))
+
+
+def _format_usage(usage):
+    if usage is None:
+        return ''
+    if not usage['runs']:
+        return ' [not used]'
+    return ' [{n} run(s), last {last}, {wall_time:.1f}s]'.format(
+        n=usage['runs'],
+        last=time.strftime('%Y-%m-%d', time.localtime(usage['last'])),
+        wall_time=usage['wall_time'])
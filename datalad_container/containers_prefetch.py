@@ -0,0 +1,188 @@
+"""Obtain the container images needed to rerun a range of the history"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import os.path as op
+
+from datalad.distribution.dataset import (
+    Dataset,
+    EnsureDataset,
+    datasetmethod,
+    require_dataset,
+)
+from datalad.interface.base import (
+    Interface,
+    build_doc,
+    eval_results,
+)
+from datalad.interface.common_opts import jobs_opt
+from datalad.interface.results import get_status_dict
+from datalad.support.annexrepo import AnnexRepo
+from datalad.support.constraints import (
+    EnsureNone,
+    EnsureStr,
+)
+from datalad.support.exceptions import CommandError
+from datalad.support.param import Parameter
+
+from datalad_container.image_store import (
+    get_object_path,
+    get_store,
+    place_annex_object,
+)
+from datalad_container.run_history import (
+    get_annex_keys,
+    get_parent_treeish,
+    get_record_paths,
+    iter_run_records,
+)
+
+lgr = logging.getLogger("datalad.containers.containers_prefetch")
+
+
+def _fetch_keys(repo, keys, jobs):
+    """Obtain keys in one git-annex process, in parallel
+
+    Returns
+    -------
+    dict
+      Mapping of keys to git-annex result records. Keys whose content is
+      present already have no record.
+    """
+    stdin = ''.join(k + '\n' for k in keys).encode()
+    try:
+        records = repo._call_annex_records(
+            ['get', '--batch-keys'], jobs=jobs, stdin=stdin)
+    except CommandError as e:
+        records = e.kwargs.get('stdout_json', [])
+    return {r['key']: r for r in records if r.get('key')}
+
+
+@build_doc
+# all commands must be derived from Interface
+class ContainersPrefetch(Interface):
+    # first docstring line is used a short description in the cmdline help
+    # the rest is put in the verbose help and manpage
+    """Obtain the container images needed to rerun a range of the history
+
+    The run records of the given commits are inspected for extra inputs, as
+    recorded by 'containers-run' for container images and their extra
+    inputs. The content of these files, in the state before each run, is
+    obtained in parallel. Files with the same content (annex key) are
+    obtained once. Thereby, a subsequent 'rerun' of the commits does not
+    need to wait for the transfer of images one by one.
+
+    Images in subdatasets are considered, as long as the subdatasets are
+    installed. Content available in the host-wide image store (see
+    'containers-store') is taken from there.
+    """
+
+    # parameters of the command, must be exhaustive
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            doc="""specify the dataset to operate on. If no dataset is given,
+            an attempt is made to identify the dataset based on the current
+            working directory""",
+            constraints=EnsureDataset() | EnsureNone()),
+        revision=Parameter(
+            args=("revision",),
+            metavar="REVISION",
+            nargs="?",
+            doc="""inspect this commit. If [CMD: --since CMD][PY: `since`
+            PY] is given, inspect the range of commits that ends with it,
+            like 'rerun' does.""",
+            constraints=EnsureStr()),
+        since=Parameter(
+            args=("--since",),
+            doc="""inspect the commits in the range SINCE..REVISION. An
+            empty string means all ancestors of REVISION""",
+            constraints=EnsureStr() | EnsureNone()),
+        jobs=jobs_opt,
+    )
+
+    @staticmethod
+    @datasetmethod(name='containers_prefetch')
+    @eval_results
+    def __call__(revision='HEAD', dataset=None, since=None, jobs='auto'):
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose='prefetch container images')
+
+        # the extra inputs of all runs, by the commit whose tree they need
+        # to be taken from
+        if since is None:
+            revrange = ['--no-walk', revision]
+        elif since:
+            revrange = ['{}..{}'.format(since, revision)]
+        else:
+            revrange = [revision]
+        needed = {}
+        for commit, _, record in iter_run_records(ds, revrange):
+            paths = get_record_paths(record, 'extra_inputs')
+            if paths:
+                needed.setdefault(
+                    get_parent_treeish(ds, commit), set()).update(paths)
+        if not needed:
+            yield get_status_dict(
+                action='containers_prefetch',
+                ds=ds,
+                status='notneeded',
+                message='no run records with extra inputs found')
+            return
+
+        # deduplicate by key across all runs
+        keys = {}
+        for treeish, paths in needed.items():
+            for path, key in get_annex_keys(
+                    ds, treeish, sorted(paths)).items():
+                keys.setdefault(key, op.join(ds.path, path))
+        lgr.info("Prefetching %i key(s) for %i run(s)", len(keys),
+                 len(needed))
+
+        by_repo = {}
+        for repo_path, key in keys:
+            by_repo.setdefault(repo_path, []).append(key)
+        for repo_path, repo_keys in by_repo.items():
+            repo_ds = Dataset(repo_path)
+            repo = repo_ds.repo
+            store = get_store(repo_ds)
+            to_fetch = []
+            for key in repo_keys:
+                res = get_status_dict(
+                    action='containers_prefetch',
+                    path=keys[(repo_path, key)],
+                    type='file',
+                    key=key,
+                    bytesize=AnnexRepo.get_size_from_key(key),
+                    logger=lgr)
+                if repo.call_annex_success(['contentlocation', key]):
+                    yield dict(res, status='notneeded')
+                elif store is not None \
+                        and get_object_path(store, key).exists():
+                    try:
+                        how = place_annex_object(
+                            repo, key, get_object_path(store, key))
+                    except ValueError as e:
+                        lgr.warning(
+                            "Ignoring corrupt object in image store: %s", e)
+                        to_fetch.append(res)
+                        continue
+                    yield dict(res, status='ok',
+                               message=('obtained from image store (%s)',
+                                        how))
+                else:
+                    to_fetch.append(res)
+            if not to_fetch:
+                continue
+            fetched = _fetch_keys(repo, [r['key'] for r in to_fetch], jobs)
+            for res in to_fetch:
+                rec = fetched.get(res['key'])
+                if rec is None or rec.get('success'):
+                    yield dict(res, status='ok')
+                else:
+                    yield dict(
+                        res, status='error',
+                        message=('cannot obtain content: %s',
+                                 '; '.join(rec.get('error-messages') or [])
+                                 or rec.get('note', 'unknown error')))
@@ -4,6 +4,7 @@ __docformat__ = 'restructuredtext'
 
 import logging
 import os.path as op
+from fnmatch import fnmatchcase
 
 from datalad.distribution.dataset import (
     EnsureDataset,
@@ -17,32 +18,103 @@ from datalad.interface.base import (
 )
 from datalad.interface.results import get_status_dict
 from datalad.support.constraints import (
+    EnsureInt,
     EnsureNone,
     EnsureStr,
 )
 from datalad.support.param import Parameter
-from datalad.utils import rmtree
+from datalad.utils import (
+    ensure_list,
+    rmtree,
+)
 
-from datalad_container.utils import get_container_configuration
+from datalad_container.utils import (
+    REGISTRATION_LOCK,
+    get_container_configuration,
+    get_dataset_lock,
+)
 
 lgr = logging.getLogger("datalad.containers.containers_remove")
 
 
+def _match_containers(names, container_cfgs):
+    """Map names and glob patterns to the names of configured containers
+
+    Returns
+    -------
+    dict
+      Mapping of each of `names` to the matching container names.
+    """
+    return {
+        n: sorted(c for c in container_cfgs if fnmatchcase(c, n))
+        for n in names
+    }
+
+
+def _get_image_keys(ds, container_cfgs):
+    """Return the annex keys of the files of the images of containers
+
+    Returns
+    -------
+    dict
+      Mapping of file paths (Path instances) to their key. Image
+      directories are represented by the files underneath.
+    """
+    images = [str(ds.pathobj / cfg['image'])
+              for cfg in container_cfgs if 'image' in cfg]
+    images = [p for p in images if op.lexists(p)]
+    if not images or not hasattr(ds.repo, 'get_content_annexinfo'):
+        return {}
+    return {
+        path: props['key']
+        for path, props in ds.repo.get_content_annexinfo(
+            paths=images, init=None).items()
+        if props.get('key')}
+
+
+def _drop_images(ds, container_cfgs, other_cfgs, jobs=None):
+    """Drop the local content of the images of containers, in parallel
+
+    Content is only dropped if git-annex can verify that it is available
+    elsewhere, and if it is not used by any of the containers in
+    `other_cfgs`, e.g., for an identical image.
+    """
+    used = set(_get_image_keys(ds, other_cfgs).values())
+    paths = []
+    for path, key in _get_image_keys(ds, container_cfgs).items():
+        if key in used:
+            yield get_status_dict(
+                action='drop', path=str(path), type='file', status='notneeded',
+                message='content is used by the image of another container',
+                logger=lgr)
+        else:
+            paths.append(str(path))
+    if not paths:
+        return
+    for r in ds.drop(paths, what='filecontent', jobs=jobs,
+                     on_failure='ignore', result_renderer='disabled',
+                     return_type='generator'):
+        yield r
+
+
 @build_doc
 # all commands must be derived from Interface
 class ContainersRemove(Interface):
     # first docstring line is used a short description in the cmdline help
     # the rest is put in the verbose help and manpage
-    """Remove a known container from a dataset
+    """Remove known containers from a dataset
 
-    This command is only removing a container from the committed
+    This command is only removing containers from the committed
     Dataset configuration (configuration scope ``branch``). It will not
-    modify any other configuration scopes.
+    modify any other configuration scopes. Any number of containers can be
+    removed at once, by name or glob pattern (e.g., 'fmriprep-*'), with a
+    single commit.
 
-    This command is *not* dropping the container image associated with the
-    removed record, because it may still be needed for other dataset versions.
-    In order to drop the container image, use the 'drop' command prior
-    to removing the container configuration.
+    By default, this command is *not* dropping the container images
+    associated with the removed records, because they may still be needed
+    for other dataset versions. With [CMD: --drop CMD][PY: drop=True PY],
+    the local content of the images is dropped (in parallel), if it is
+    available elsewhere.
     """
 
     # parameters of the command, must be exhaustive
@@ -55,56 +127,108 @@ class ContainersRemove(Interface):
             constraints=EnsureDataset() | EnsureNone()),
         name=Parameter(
             args=("name",),
-            doc="""name of the container to remove""",
+            doc="""name of the container to remove, or a glob pattern
+            matching the names of multiple containers""",
             metavar="NAME",
+            nargs="+",
             constraints=EnsureStr(),
         ),
         remove_image=Parameter(
             args=("-i", "--remove-image",),
             doc="""if set, remove container image as well. Even with this flag,
-            the container image content will not be dropped. Use the 'drop'
-            command explicitly before removing the container configuration.""",
+            the container image content will not be dropped, unless
+            [CMD: --drop CMD][PY: drop PY] is given.""",
             action="store_true",
         ),
+        drop=Parameter(
+            args=("--drop",),
+            doc="""if set, drop the content of the container images from the
+            local annex before removing the containers. Content is only
+            dropped if git-annex can verify its availability elsewhere.
+            Containers are removed even if the content of their image could
+            not be dropped.""",
+            action="store_true",
+        ),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            doc="""Number of images dropped in parallel. By default, it is
+            taken from the 'annex.jobs' configuration.""",
+            metavar="NJOBS",
+            constraints=EnsureInt() | EnsureNone(),
+        ),
     )
 
     @staticmethod
     @datasetmethod(name='containers_remove')
     @eval_results
-    def __call__(name, dataset=None, remove_image=False):
+    def __call__(name, dataset=None, remove_image=False, drop=False,
+                 jobs=None):
         ds = require_dataset(dataset, check_installed=True,
                              purpose='remove a container')
+        names = ensure_list(name)
 
-        res = get_status_dict(
-            ds=ds,
-            action='containers_remove',
-            logger=lgr)
-
-        container_cfg = get_container_configuration(ds, name)
-
-        to_save = []
-        if remove_image and 'image' in container_cfg:
-            imagepath = ds.pathobj / container_cfg['image']
-            # we use rmtree() and not .unlink(), because
-            # the image could be more than a single file underneath
-            # this location (e.g., docker image dumps)
-            rmtree(imagepath)
-            # at the very end, save() will take care of committing
-            # any removal that just occurred
-            to_save.append(imagepath)
-
-        if container_cfg:
-            ds.config.remove_section(
-                f'datalad.containers.{name}',
-                scope='branch',
-                reload=True)
-            res['status'] = 'ok'
-            to_save.append(op.join('.datalad', 'config'))
-        else:
-            res['status'] = 'notneeded'
-        if to_save:
-            for r in ds.save(
-                    path=to_save,
-                    message='[DATALAD] Remove container {}'.format(name)):
+        if drop:
+            # the slow part happens before the configuration is modified
+            container_cfgs = get_container_configuration(ds)
+            matches = _match_containers(names, container_cfgs)
+            matched = set(n for m in matches.values() for n in m)
+            for r in _drop_images(
+                    ds,
+                    [container_cfgs[n] for n in matched],
+                    [cfg for n, cfg in container_cfgs.items()
+                     if n not in matched],
+                    jobs=jobs):
                 yield r
-        yield res
+
+        # serialized with concurrent additions and removals
+        with get_dataset_lock(ds, REGISTRATION_LOCK):
+            ds.config.reload(force=True)
+            container_cfgs = get_container_configuration(ds)
+            matches = _match_containers(names, container_cfgs)
+            removed = sorted(set(n for m in matches.values() for n in m))
+
+            to_save = []
+            for n in removed:
+                container_cfg = container_cfgs[n]
+                if remove_image and 'image' in container_cfg:
+                    imagepath = ds.pathobj / container_cfg['image']
+                    # we use rmtree() and not .unlink(), because
+                    # the image could be more than a single file underneath
+                    # this location (e.g., docker image dumps)
+                    rmtree(imagepath)
+                    # at the very end, save() will take care of committing
+                    # any removal that just occurred
+                    to_save.append(imagepath)
+                ds.config.remove_section(
+                    f'datalad.containers.{n}',
+                    scope='branch',
+                    reload=False)
+            if removed:
+                ds.config.reload()
+                to_save.append(op.join('.datalad', 'config'))
+                saved = list(ds.save(
+                    path=to_save,
+                    message='[DATALAD] Remove container {}'.format(removed[0])
+                    if len(removed) == 1
+                    else '[DATALAD] Remove {} containers\n\n{}'.format(
+                        len(removed), '\n'.join(removed))))
+            else:
+                saved = []
+        for r in saved:
+            yield r
+        for n in removed:
+            yield get_status_dict(
+                ds=ds,
+                action='containers_remove',
+                name=n,
+                status='ok',
+                logger=lgr)
+        for n, m in matches.items():
+            if not m:
+                yield get_status_dict(
+                    ds=ds,
+                    action='containers_remove',
+                    name=n,
+                    status='notneeded',
+                    message=('no container matches %r', n),
+                    logger=lgr)
@@ -2,17 +2,26 @@
 
 __docformat__ = 'restructuredtext'
 
+import asyncio
 import logging
+import os
 import os.path as op
+import shutil
 import sys
+import tempfile
+import time
+import weakref
 
+from datalad.cmd import WitlessRunner
 from datalad.core.local.run import (
+    GlobbedPaths,
     Run,
     get_command_pwds,
     normalize_command,
     run_command,
 )
 from datalad.distribution.dataset import (
+    Dataset,
     datasetmethod,
     require_dataset,
 )
@@ -22,10 +31,57 @@ from datalad.interface.base import (
     eval_results,
 )
 from datalad.interface.results import get_status_dict
+from datalad.support.constraints import EnsureChoice
+from datalad.support.exceptions import (
+    CommandError,
+    IncompleteResultsError,
+)
 from datalad.support.param import Parameter
-from datalad.utils import ensure_iter
+from datalad.utils import (
+    bytes2human,
+    ensure_iter,
+    ensure_list,
+    rmtree,
+)
 
+from datalad_container.fetch_cost import estimate_fetch_cost
 from datalad_container.find_container import find_container_
+from datalad_container.image_store import (
+    add_to_store,
+    get_from_store,
+    get_store,
+)
+from datalad_container.image_warm import (
+    WARM_CFG,
+    warm_files,
+)
+from datalad_container.input_streaming import (
+    STATUS_ENVVAR,
+    InputStreamer,
+)
+from datalad_container.run_cache import (
+    RECORD_KEY,
+    get_fingerprint,
+    lookup,
+    restore_outputs,
+)
+from datalad_container.run_journal import (
+    JOURNAL_LOCK,
+    append_to_journal,
+    flush_journal,
+    overlaps_journal,
+    save_run,
+)
+from datalad_container.run_server import run_server
+from datalad_container.run_wrapper import (
+    USAGE_ENVVAR,
+    read_usage,
+    wrap_command,
+)
+from datalad_container.utils import (
+    get_dataset_lock,
+    get_image_files,
+)
 
 lgr = logging.getLogger("datalad.containers.containers_run")
 
@@ -34,6 +90,8 @@ lgr = logging.getLogger("datalad.containers.containers_run")
 # the container
 CONTAINER_NAME_ENVVAR = 'DATALAD_CONTAINER_NAME'
 
+TIMINGS_CFG = 'datalad.containers.timings'
+
 _run_params = dict(
     Run._params_,
     container_name=Parameter(
@@ -41,9 +99,771 @@ _run_params = dict(
         metavar="NAME",
         doc="""Specify the name of or a path to a known container to use
         for execution, in case multiple containers are configured."""),
+    run_cache=Parameter(
+        args=('--run-cache',),
+        action='store_true',
+        doc="""if enabled, the command is not executed again when an earlier
+        run with the same container image, extra inputs, command, and input
+        content can be found in the dataset history. Instead, the changes
+        committed by the earlier run are restored, and recorded with a new
+        run record. Only earlier runs that were executed with this option
+        enabled are considered."""),
+    worktree=Parameter(
+        args=('--worktree',),
+        action='store_true',
+        doc="""if enabled, the command is executed in a temporary git worktree
+        of the dataset, which shares the annex with it. Upon success, the
+        committed run record is integrated into the current branch of the
+        dataset, and the worktree is removed. This allows for concurrent
+        executions in the same dataset, without contention on its working
+        tree and index. The command is always executed in the root
+        directory of the worktree, and relative paths are interpreted
+        accordingly. Containers in subdatasets are not supported."""),
+    journal=Parameter(
+        args=('--journal',),
+        action='store_true',
+        doc="""if enabled, the command is executed, but its outputs are not
+        saved. Instead, the run record is added to a journal, to be saved
+        later with [CMD: --flush CMD][PY: flush=True PY]. This moves the
+        cost of saving out of a series of short runs. All
+        outputs of the command must be declared, as it is executed in
+        explicit mode. If the outputs of the command overlap those of an
+        already journaled run, the journal is flushed before the command is
+        executed."""),
+    dry_run=Parameter(
+        args=("--dry-run",),
+        doc=Run._params_['dry_run']._doc + """ A value of "cost" reports how
+        much annexed content of the container images, extra inputs, and
+        inputs would need to be fetched, and from which remotes, without
+        fetching anything. Inputs in uninstalled subdatasets are not
+        considered.""",
+        constraints=EnsureChoice(None, "basic", "command", "cost")),
+    flush=Parameter(
+        args=('--flush',),
+        action='store_true',
+        doc="""save the outputs of all journaled runs (see
+        [CMD: --journal CMD][PY: journal PY]) in the order of execution,
+        with one commit and run record per run. Each run remains
+        individually rerunnable. No command is executed."""),
+    stage=Parameter(
+        args=('--stage',),
+        nargs=2,
+        action='append',
+        metavar=('NAME', 'COMMAND'),
+        doc="""a stage of a pipeline, given by the name of (or path to) a
+        container, and the command to execute in it. The output of each
+        stage is piped into the next one. A command or container name
+        cannot be given in addition.
+        [CMD: This option can be given multiple times. CMD]
+        [PY: Must be a list of (name, command) tuples. PY]"""),
+    serve=Parameter(
+        args=('--serve',),
+        action='store_true',
+        doc="""serve run requests for the dataset on a unix socket, until
+        interrupted. This avoids the startup cost of individual
+        invocations. Requests are executed concurrently (always in explicit
+        mode), up to a limit set by the configuration
+        ``datalad.containers.server-jobs`` (default: number of CPUs). The
+        socket is located at ``.git/datalad/containers/run.sock``, unless
+        configured otherwise via ``datalad.containers.server-socket``.
+        Requests can be made with the ``datalad_container/run_client.py``
+        script. No command is executed."""),
+    stream_inputs=Parameter(
+        args=('--stream-inputs',),
+        action='store_true',
+        doc="""if enabled, the command is started as soon as the container
+        image is present, while the inputs are obtained in the background,
+        in the order of their declaration. The command must wait for an
+        input to be present before reading it. As long as the content of a
+        (locked) annexed input file is not obtained, it is a dangling
+        symlink. In addition, the environment variable
+        DATALAD_CONTAINERS_INPUT_STATUS points to a file, to which a line
+        with the status and the path of each input is appended once it was
+        processed, and a last line 'done', or 'failed' if any input could
+        not be obtained. In the latter case, the run fails. The Docker
+        adapter of containers-add mounts the status file into the container
+        at the same path. With a custom call format that starts a container
+        via a daemon (e.g., 'docker run'), the call format has to make the
+        file and the variable available to the container."""),
 )
 
 
+class _PhaseTimer(object):
+    """Accumulate the wall-clock time spent in the phases of a run"""
+
+    def __init__(self):
+        self.timings = {}
+        self._mark = time.perf_counter()
+
+    def account(self, phase):
+        """Add the time since the last mark to `phase`, and set a new mark"""
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self._mark
+        self._mark = now
+
+    def skip(self):
+        """Set a new mark, without accounting the time since the last one"""
+        self._mark = time.perf_counter()
+
+    def format(self):
+        return ", ".join("{}: {:.2f}s".format(phase, t)
+                         for phase, t in self.timings.items())
+
+
+class _RecordInfo(dict):
+    """Information for the run record, completed when `run` writes it
+
+    `run` writes the run record right after the command was executed, and
+    offers no way to add to it at that point. Instead, `on_record` is called
+    with this dictionary, before its items are read for the serialization of
+    the record.
+    """
+
+    def __init__(self, on_record, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_record = on_record
+
+    def items(self):
+        if self._on_record:
+            on_record, self._on_record = self._on_record, None
+            on_record(self)
+        return super().items()
+
+
+def _mktemp(ds, prefix):
+    """Create a temporary file for the communication with a command"""
+    tmp_dir = ds.repo.dot_git / 'datalad' / 'containers'
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=prefix, dir=str(tmp_dir))
+    os.close(fd)
+    return path
+
+
+def _get_container_command(ds, pwd, container_name, cmd, timer):
+    """Locate a container and expand a command for execution in it
+
+    Parameters
+    ----------
+    ds : Dataset
+    pwd : str
+      Working directory of the command.
+    container_name : str or None
+    cmd : str or list
+    timer : _PhaseTimer
+
+    Yields
+    ------
+    Result records of subdataset installations needed to locate the
+    container, and an error record if the command cannot be expanded.
+
+    Returns
+    -------
+    tuple or None
+      The container record, the expanded command, the path of the
+      container image, and the list of extra inputs (both relative to
+      `pwd`), or None if the command cannot be expanded.
+    """
+    # this following block locates the target container. this involves a
+    # configuration look-up. This is not using
+    # get_container_configuration(), because it needs to account for a
+    # wide range of scenarios, including the installation of the dataset(s)
+    # that will eventually provide (the configuration) for the container.
+    # However, internally this is calling `containers_list()`, which is
+    # using get_container_configuration(), so any normalization of
+    # configuration on-read, get still be implemented in this helper.
+    container = None
+    for res in find_container_(ds, container_name):
+        if res.get("action") == "containers":
+            container = res
+        else:
+            timer.account('subdataset_install')
+            yield res
+            timer.skip()
+    assert container, "bug: container should always be defined here"
+
+    image_path = op.relpath(container["path"], pwd)
+    # container record would contain path to the (sub)dataset containing
+    # it.  If not - take current dataset, as it must be coming from it
+    image_dspath = op.relpath(container.get('parentds', ds.path), pwd)
+
+    # sure we could check whether the container image is present,
+    # but it might live in a subdataset that isn't even installed yet
+    # let's leave all this business to `get` that is called by `run`
+
+    cmd = normalize_command(cmd)
+    # expand the command with container execution
+    if 'cmdexec' in container:
+        callspec = container['cmdexec']
+
+        # Temporary kludge to give a more helpful message
+        if callspec.startswith("["):
+            import json
+            try:
+                json.loads(callspec)
+            except json.JSONDecodeError:
+                pass  # Never mind, false positive.
+            else:
+                raise ValueError(
+                    'cmdexe {!r} is in an old, unsupported format. '
+                    'Convert it to a plain string.'.format(callspec))
+        try:
+            cmd_kwargs = dict(
+                # point to the python installation that runs *this* code
+                # we know that it would have things like the docker
+                # adaptor installed with this extension package
+                python=sys.executable,
+                img=image_path,
+                cmd=cmd,
+                img_dspath=image_dspath,
+                img_dirpath=op.dirname(image_path) or ".",
+            )
+            if '{overlay}' in callspec:
+                if not container.get('overlay-size'):
+                    yield get_status_dict(
+                        'run',
+                        ds=ds,
+                        status='error',
+                        message=('Container %s uses an overlay, but no '
+                                 'overlay size is configured. See '
+                                 'containers-add --overlay-size',
+                                 container['name']))
+                    return None
+                # kept as a placeholder through the expansion by `run`, an
+                # overlay is only allocated for the execution by the wrapper
+                # of the container process (see `_wrap_command`)
+                cmd_kwargs['overlay'] = '{{overlay}}'
+            cmd = callspec.format(**cmd_kwargs)
+        except KeyError as exc:
+            yield get_status_dict(
+                'run',
+                ds=ds,
+                status='error',
+                message=(
+                    'Unrecognized cmdexec placeholder: %s. '
+                    'See containers-add for information on known ones: %s',
+                    exc,
+                    ", ".join(cmd_kwargs)))
+            return None
+    else:
+        # just prepend and pray
+        cmd = container['path'] + ' ' + cmd
+
+    extra_inputs = []
+    for extra_input in ensure_iter(container.get("extra-input",[]), set):
+        try:
+            xi_kwargs = dict(
+                img_dspath=image_dspath,
+                img_dirpath=op.dirname(image_path) or ".",
+            )
+            extra_inputs.append(extra_input.format(**xi_kwargs))
+        except KeyError as exc:
+            yield get_status_dict(
+                'run',
+                ds=ds,
+                status='error',
+                message=(
+                    'Unrecognized extra_input placeholder: %s. '
+                    'See containers-add for information on known ones: %s',
+                    exc,
+                    ", ".join(xi_kwargs)))
+            return None
+
+    lgr.debug("extra_inputs = %r", extra_inputs)
+    timer.account('container_lookup')
+    return container, cmd, image_path, extra_inputs
+
+
+def _describe_containers(containers, pwd):
+    """Describe the containers of a run for its run record"""
+    return [
+        dict(name=c['name'],
+             image=op.relpath(c['path'], pwd),
+             cmdexec=c.get('cmdexec'))
+        for c in containers
+    ]
+
+
+def _expand_command(run_kwargs):
+    """Return the command of a run with all placeholders expanded
+
+    Returns
+    -------
+    str or None
+      None, if the command cannot be expanded. The run will report why.
+    """
+    for r in run_command(dry_run='basic', **run_kwargs):
+        if r.get('dry_run_info'):
+            return r['dry_run_info']['cmd_expanded']
+    return None
+
+
+def _wrap_command(cmd, container, pwd):
+    """Put the wrapper of the container process in front of a command
+
+    If the container uses an overlay, the wrapper allocates one from the
+    pool of the container for the execution (see
+    `datalad_container.run_wrapper`).
+
+    Parameters
+    ----------
+    cmd : str
+    container : dict or None
+      The container record, or None for a pipeline of containers, whose
+      stages were wrapped already.
+    pwd : str
+    """
+    overlay = None
+    if container and '{overlay}' in container.get('cmdexec', ''):
+        # the pool belongs to the dataset the container is configured in
+        overlay = (op.relpath(container.get('parentds', pwd), pwd),
+                   container['name'].rsplit('/', 1)[-1])
+    return wrap_command(cmd, overlay=overlay)
+
+
+def _format_pipeline(cmds):
+    """Return a command that executes the stages `cmds` as a pipeline
+
+    The stages are connected by the pipes of bash with the 'pipefail'
+    option. Without it, only a failure of the last stage would fail the
+    run. The pipeline is passed to bash via a quoted here-document, which
+    keeps its text as is. Hence, the placeholders of `run` are expanded to
+    paths that are quoted for the shell that executes the stages.
+    """
+    pipeline = ' | '.join(cmds)
+    delimiter = 'DATALAD_PIPELINE'
+    while delimiter in pipeline.splitlines():
+        delimiter += '_'
+    return 'bash -o pipefail -c "$(cat <<\'{0}\'\n{1}\n{0}\n)"'.format(
+        delimiter, pipeline)
+
+
+def _report_fetch_cost(ds, pwd, stages, inputs):
+    """Report the content that would be fetched for a run, without fetching
+
+    Yields
+    ------
+    Result records of subdataset installations needed to locate the
+    containers, and a 'run [dry-run]' record with the estimate in its
+    'fetch_cost' property (see `estimate_fetch_cost`).
+    """
+    paths = []
+    for stage_container, _ in stages:
+        for res in find_container_(ds, stage_container):
+            if res.get("action") == "containers":
+                paths.extend(get_image_files(ds, res, pwd))
+            else:
+                yield res
+    paths.extend(GlobbedPaths(ensure_list(inputs), pwd=pwd).expand_strict(
+        full=True))
+    cost = estimate_fetch_cost(paths)
+    msg = ['%s to fetch in %i file(s)', bytes2human(cost['bytes']),
+           cost['files']]
+    if cost['unknown_size']:
+        msg[0] += ', plus %i file(s) of unknown size'
+        msg.append(cost['unknown_size'])
+    if cost['remotes']:
+        msg[0] += ', available from: %s'
+        msg.append(', '.join(
+            '{} ({})'.format(remote, bytes2human(size))
+            for remote, size in sorted(cost['remotes'].items())))
+    if cost['unavailable']:
+        msg[0] += ', %i file(s) not available from any remote'
+        msg.append(len(cost['unavailable']))
+    yield get_status_dict(
+        'run [dry-run]',
+        ds=ds,
+        status='ok',
+        fetch_cost=cost,
+        message=tuple(msg))
+
+
+def _prepare_worktree(ds, pwd, run_kwargs, before_prep=None,
+                      inputs_ready=False):
+    """Prepare the execution of a command outside of `run`
+
+    Lets `run` expand the command and the input and output specifications,
+    obtains the inputs, and unlocks existing outputs. Like `run`, the command
+    is not executed if any of this fails.
+
+    Parameters
+    ----------
+    ds : Dataset
+    pwd : str
+    run_kwargs : dict
+      Keyword arguments for `run_command`, including the command.
+    before_prep : callable, optional
+      Generator function that is called with the 'run [dry-run]' result,
+      before inputs and outputs are prepared.
+    inputs_ready : bool, optional
+      Whether to obtain the extra inputs only.
+
+    Yields
+    ------
+    Result records.
+
+    Returns
+    -------
+    dict or None
+      The 'run [dry-run]' result, or None if the command cannot be executed.
+    """
+    failed = False
+    # let `run` expand placeholders and globs, without doing anything
+    expanded = None
+    for r in run_command(dry_run=True, **run_kwargs):
+        if r['action'] == 'run [dry-run]':
+            expanded = r
+        else:
+            yield r
+    if expanded is None:
+        return None
+    if before_prep:
+        yield from before_prep(expanded)
+    info = expanded['dry_run_info']
+    inputs = ([] if inputs_ready else info['inputs']) + \
+        ensure_list(run_kwargs.get('extra_inputs'))
+    if inputs:
+        for r in ds.get(
+                [op.join(pwd, p) for p in inputs],
+                on_failure='ignore',
+                return_type='generator',
+                result_renderer='disabled'):
+            failed = failed or r.get('status') in ('error', 'impossible')
+            yield r
+    existing_outputs = [op.join(pwd, p) for p in info['outputs']
+                        if op.lexists(op.join(pwd, p))]
+    if existing_outputs and not failed:
+        # make existing outputs writable for the command
+        for r in ds.unlock(
+                existing_outputs,
+                on_failure='ignore',
+                return_type='generator',
+                result_renderer='disabled'):
+            failed = failed or r.get('status') in ('error', 'impossible')
+            yield r
+    return None if failed else expanded
+
+
+def _prepare_execution(ds, pwd, container_name, cmd, run_kwargs,
+                       before_prep=None):
+    """Prepare the execution of a containerized command outside of `run`
+
+    Locates the container, and prepares the worktree (see
+    `_prepare_worktree`).
+
+    Parameters
+    ----------
+    ds : Dataset
+    pwd : str
+    container_name : str or None
+    cmd : str or list
+    run_kwargs : dict
+      Keyword arguments for `run_command`.
+    before_prep : callable, optional
+      Generator function that is called with the 'run [dry-run]' result,
+      before inputs and outputs are prepared.
+
+    Yields
+    ------
+    Result records.
+
+    Returns
+    -------
+    tuple or None
+      The container record, the (unexpanded) wrapped container command
+      (see `datalad_container.run_wrapper`), the extra inputs including the
+      image, and the 'run [dry-run]' result, or None if the command cannot
+      be executed.
+    """
+    spec = yield from _get_container_command(
+        ds, pwd, container_name, cmd, _PhaseTimer())
+    if spec is None:
+        return None
+    container, container_cmd, image_path, extra_inputs = spec
+    container_cmd = _wrap_command(container_cmd, container, pwd)
+    extra_inputs = [image_path] + extra_inputs
+    expanded = yield from _prepare_worktree(
+        ds, pwd,
+        dict(run_kwargs, cmd=container_cmd, extra_inputs=extra_inputs),
+        before_prep=before_prep)
+    if expanded is None:
+        return None
+    return container, container_cmd, extra_inputs, expanded
+
+
+def _execute(ds, cmd, pwd, env):
+    """Execute a wrapped command like `run` does
+
+    Returns
+    -------
+    int, dict
+      The exit code and the resource usage of the command.
+    """
+    usage_file = _mktemp(ds, 'usage-')
+    try:
+        WitlessRunner(cwd=pwd, env=dict(
+            os.environ, **env, **{USAGE_ENVVAR: usage_file})).run(cmd)
+        exit_code = 0
+    except CommandError as e:
+        exit_code = e.code
+    try:
+        return exit_code, read_usage(usage_file)
+    finally:
+        os.unlink(usage_file)
+
+
+def _get_run_result(ds, pwd, container, expanded, exit_code, usage,
+                    message):
+    """Return the 'run' result of a command executed outside of `run`
+
+    Parameters
+    ----------
+    ds : Dataset
+    pwd : str
+    container : dict
+    expanded : dict
+      The 'run [dry-run]' result of the command.
+    exit_code : int
+    usage : dict
+      The resource usage of the command.
+    message : str
+      Message of a successful run.
+
+    Returns
+    -------
+    dict
+      With the run record, as `run` would create it, in the 'run_info'
+      property. An error, if the command failed.
+    """
+    if exit_code:
+        # like `run`, nothing is saved after a failed command
+        return get_status_dict(
+            'run',
+            ds=ds,
+            status='error',
+            message=('command exited with non-zero code %s: %s',
+                     exit_code, expanded['dry_run_info']['cmd_expanded']),
+            exit_code=exit_code)
+    run_info = dict(expanded['run_info'], exit=0)
+    run_info.setdefault(RECORD_KEY, {}).update(
+        containers=_describe_containers([container], pwd),
+        resource_usage=usage)
+    return get_status_dict(
+        'run',
+        ds=ds,
+        status='ok',
+        message=message,
+        run_info=run_info,
+        resource_usage=usage)
+
+
+def _run_journaled(ds, pwd, container_name, cmd, run_kwargs):
+    """Execute a command, and add it to the journal instead of saving it"""
+    def _flush_if_overlapping(expanded):
+        outputs = [op.join(pwd, p)
+                   for p in expanded['dry_run_info']['outputs']]
+        with get_dataset_lock(ds, JOURNAL_LOCK):
+            if overlaps_journal(ds, outputs):
+                # the changes of journaled runs can only be committed
+                # separately, if no later run modifies the same outputs
+                lgr.info("Outputs are modified by journaled runs, "
+                         "flushing the journal first")
+                yield from flush_journal(ds)
+
+    spec = yield from _prepare_execution(
+        ds, pwd, container_name, cmd, run_kwargs,
+        before_prep=_flush_if_overlapping)
+    if spec is None:
+        return
+    container, _, _, expanded = spec
+    info = expanded['dry_run_info']
+    outputs = GlobbedPaths(info['outputs'], pwd=pwd)
+    # outputs that are removed by the command need to be recorded too
+    pre_outputs = set(outputs.expand_strict(full=True))
+
+    exit_code, usage = _execute(
+        ds, info['cmd_expanded'], pwd,
+        {CONTAINER_NAME_ENVVAR: container['name']})
+    res = _get_run_result(ds, pwd, container, expanded, exit_code, usage,
+                          'added run to journal, not saved')
+    if res['status'] == 'ok':
+        post_outputs = set(outputs.expand_strict(full=True, refresh=True))
+        with get_dataset_lock(ds, JOURNAL_LOCK):
+            append_to_journal(
+                ds, res['run_info'], sorted(pre_outputs | post_outputs),
+                info['cmd_expanded'],
+                message=run_kwargs['message'],
+                sidecar=run_kwargs['sidecar'])
+    yield res
+
+
+def _run_instrumented(ds, pwd, run_kwargs, extra_info, env, timer,
+                      warm_paths, stream_inputs=False):
+    """Execute a command with `run`, and report on its execution
+
+    The container process is executed via `datalad_container.run_wrapper`,
+    which reports its resource usage.
+
+    Parameters
+    ----------
+    ds : Dataset
+    pwd : str
+    run_kwargs : dict
+      Keyword arguments for `run_command`, including the wrapped command.
+    extra_info : dict
+      Additional information for the run record.
+    env : dict
+      Environment variables for the command.
+    timer : _PhaseTimer
+    warm_paths : list
+      Paths to bring into the page cache before the execution.
+    stream_inputs : bool, optional
+      Whether to obtain the inputs while the command is executed.
+
+    Yields
+    ------
+    Result records.
+    """
+    from unittest.mock import \
+        patch  # delayed, since takes long (~600ms for yoh)
+
+    warm = ds.config.obtain(WARM_CFG)
+    if warm != 'none':
+        # the images are obtained upfront to be warmed, `run` then finds
+        # them present
+        failed = False
+        for r in ds.get(warm_paths, on_failure='ignore',
+                        return_type='generator', result_renderer='disabled'):
+            timer.account('fetch')
+            failed = failed or r.get('status') in ('error', 'impossible')
+            yield r
+            timer.skip()
+        if failed:
+            return
+        for path, _, _, exc in warm_files(warm_paths, warm):
+            if exc:
+                lgr.debug("Cannot warm %s: %s", path, exc)
+        timer.account('warm')
+
+    phase = 'fetch'
+
+    def _on_record(info):
+        # the command was just executed
+        nonlocal phase
+        timer.account('execution')
+        phase = 'save'
+        info['resource_usage'] = read_usage(env[USAGE_ENVVAR])
+
+    extra_info = dict(extra_info, **{
+        RECORD_KEY: _RecordInfo(_on_record, extra_info[RECORD_KEY])})
+    env = dict(env, **{USAGE_ENVVAR: _mktemp(ds, 'usage-')})
+    streamer = None
+    if stream_inputs:
+        env[STATUS_ENVVAR] = _mktemp(ds, 'input-status-')
+        streamer = InputStreamer(
+            ds, pwd,
+            GlobbedPaths(ensure_list(run_kwargs['inputs']),
+                         pwd=pwd).expand_strict(full=True),
+            env[STATUS_ENVVAR])
+        # the wrapper of the container process waits for the inputs
+        streamer.start()
+    reported = 0
+    try:
+        with patch.dict('os.environ', env):
+            # fire!
+            for r in run_command(
+                    extra_info=extra_info,
+                    assume_ready='inputs' if streamer else None,
+                    **run_kwargs):
+                timer.account(phase)
+                if streamer:
+                    # results of obtaining inputs so far
+                    results = streamer.results[reported:]
+                    reported += len(results)
+                    yield from results
+                if r.get('action') == 'run':
+                    r['timings'] = timer.timings
+                    usage = extra_info[RECORD_KEY].get('resource_usage')
+                    if usage is not None:
+                        r['resource_usage'] = usage
+                yield r
+                timer.skip()
+        if streamer:
+            streamer.join()
+            yield from streamer.results[reported:]
+    finally:
+        if streamer:
+            streamer.join()
+            os.unlink(env[STATUS_ENVVAR])
+        os.unlink(env[USAGE_ENVVAR])
+
+
+def _integrate_commits(ds, base, head):
+    """Bring the commits in `base..head` onto the current branch of `ds`
+
+    The branch is fast-forwarded if it still points to `base`, otherwise the
+    commits are cherry-picked onto it.
+    """
+    repo = ds.repo
+    try:
+        if repo.get_hexsha() == base:
+            repo.call_git(['merge', '--ff-only', head])
+        else:
+            repo.call_git(['cherry-pick', '{}..{}'.format(base, head)])
+    except CommandError as e:
+        if repo.call_git_success(
+                ['rev-parse', '-q', '--verify', 'CHERRY_PICK_HEAD'],
+                read_only=True):
+            repo.call_git(['cherry-pick', '--abort'])
+        return get_status_dict(
+            'merge',
+            ds=ds,
+            status='error',
+            message=('cannot integrate run commit(s) %s..%s: %s',
+                     base[:8], head[:8], (e.stderr or '').strip() or e))
+    return get_status_dict(
+        'merge',
+        ds=ds,
+        status='ok',
+        message=('integrated run commit(s) %s..%s', base[:8], head[:8]))
+
+
+def _run_in_worktree(ds, run_kwargs):
+    """Execute `containers_run` in a temporary worktree of `ds`"""
+    repo = ds.repo
+    base = repo.get_hexsha()
+    wt_root = repo.dot_git / 'datalad' / 'containers' / 'worktrees'
+    wt_root.mkdir(parents=True, exist_ok=True)
+    wt_path = tempfile.mkdtemp(prefix='run-', dir=str(wt_root))
+    # detached, to neither need a branch, nor conflict with the checked out
+    # one
+    repo.call_git(['worktree', 'add', '--detach', wt_path, base])
+    lgr.debug("Executing in worktree %s", wt_path)
+    wt_ds = Dataset(wt_path)
+    failed = False
+    for r in wt_ds.containers_run(
+            return_type='generator',
+            result_renderer='disabled',
+            on_failure='ignore',
+            **run_kwargs):
+        failed = failed or r.get('status') in ('error', 'impossible')
+        yield r
+    head = wt_ds.repo.get_hexsha()
+    if head != base:
+        # only the integration of the commits needs exclusive access to the
+        # dataset
+        with get_dataset_lock(ds, 'worktree'):
+            res = _integrate_commits(ds, base, head)
+        yield res
+        failed = failed or res['status'] != 'ok'
+    if failed:
+        lgr.info("Keeping worktree %s for inspection", wt_path)
+        return
+    # git-annex replaces the .git file of the worktree with a symlink,
+    # which `git worktree remove` refuses to handle
+    rmtree(wt_path)
+    repo.call_git(['worktree', 'prune'])
+
+
 @build_doc
 # all commands must be derived from Interface
 class ContainersRun(Interface):
@@ -63,10 +883,37 @@ class ContainersRun(Interface):
 
     During execution the environment variable {name_envvar} is set to the
     name of the used container.
+
+    Instead of a single command, a pipeline of commands in (possibly)
+    different containers can be specified as a sequence of stages. The
+    stages are connected by pipes, and execute concurrently. The pipeline is
+    recorded as a single run, with the images of all containers as extra
+    inputs. The pipeline is executed by bash with the 'pipefail' option:
+    the run fails if any stage fails, with the exit code of the last stage
+    that failed. During the execution of a pipeline, {name_envvar} holds
+    the names of all its containers, separated by spaces.
+
+    The wall-clock time spent in the phases of a run (container lookup,
+    subdataset installation, fetching of image and inputs, warming of images,
+    command execution, and saving) is reported in the 'timings' property of
+    the 'run' result. The time spent saving is only added after all results
+    have been processed. Depending on the configuration ``{timings_cfg}``, a summary
+    line is logged ('summary'), and timings are additionally stored in the
+    run record ('record').
+
+    If the configuration ``{warm_cfg}`` is set to 'fadvise' or 'read', the
+    images and extra inputs of the containers are brought into the page cache
+    right before the execution (see containers-warm).
+
+    The resource usage (wall time, CPU time, peak memory, and I/O volume) of
+    the executed command is reported in the 'resource_usage' property of the
+    'run' result, and stored in the run record.
     """
 
     _docs_ = dict(
-        name_envvar=CONTAINER_NAME_ENVVAR
+        name_envvar=CONTAINER_NAME_ENVVAR,
+        timings_cfg=TIMINGS_CFG,
+        warm_cfg=WARM_CFG,
     )
 
     _params_ = _run_params
@@ -77,116 +924,321 @@ class ContainersRun(Interface):
     @staticmethod
     @datasetmethod(name='containers_run')
     @eval_results
-    def __call__(cmd, container_name=None, dataset=None,
+    def __call__(cmd=None, container_name=None, dataset=None,
                  inputs=None, outputs=None, message=None, expand=None,
-                 explicit=False, sidecar=None):
-        from unittest.mock import \
-            patch  # delayed, since takes long (~600ms for yoh)
+                 explicit=False, sidecar=None, dry_run=None, run_cache=False,
+                 worktree=False, journal=False, flush=False, serve=False,
+                 stage=None, stream_inputs=False):
+        timer = _PhaseTimer()
         pwd, _ = get_command_pwds(dataset)
         ds = require_dataset(dataset, check_installed=True,
                              purpose='run a containerized command execution')
 
-        # this following block locates the target container. this involves a
-        # configuration look-up. This is not using
-        # get_container_configuration(), because it needs to account for a
-        # wide range of scenarios, including the installation of the dataset(s)
-        # that will eventually provide (the configuration) for the container.
-        # However, internally this is calling `containers_list()`, which is
-        # using get_container_configuration(), so any normalization of
-        # configuration on-read, get still be implemented in this helper.
-        container = None
-        for res in find_container_(ds, container_name):
-            if res.get("action") == "containers":
-                container = res
-            else:
-                yield res
-        assert container, "bug: container should always be defined here"
-
-        image_path = op.relpath(container["path"], pwd)
-        # container record would contain path to the (sub)dataset containing
-        # it.  If not - take current dataset, as it must be coming from it
-        image_dspath = op.relpath(container.get('parentds', ds.path), pwd)
-
-        # sure we could check whether the container image is present,
-        # but it might live in a subdataset that isn't even installed yet
-        # let's leave all this business to `get` that is called by `run`
-
-        cmd = normalize_command(cmd)
-        # expand the command with container execution
-        if 'cmdexec' in container:
-            callspec = container['cmdexec']
-
-            # Temporary kludge to give a more helpful message
-            if callspec.startswith("["):
-                import json
-                try:
-                    json.loads(callspec)
-                except json.JSONDecodeError:
-                    pass  # Never mind, false positive.
-                else:
-                    raise ValueError(
-                        'cmdexe {!r} is in an old, unsupported format. '
-                        'Convert it to a plain string.'.format(callspec))
-            try:
-                cmd_kwargs = dict(
-                    # point to the python installation that runs *this* code
-                    # we know that it would have things like the docker
-                    # adaptor installed with this extension package
-                    python=sys.executable,
-                    img=image_path,
-                    cmd=cmd,
-                    img_dspath=image_dspath,
-                    img_dirpath=op.dirname(image_path) or ".",
-                )
-                cmd = callspec.format(**cmd_kwargs)
-            except KeyError as exc:
-                yield get_status_dict(
-                    'run',
-                    ds=ds,
-                    status='error',
-                    message=(
-                        'Unrecognized cmdexec placeholder: %s. '
-                        'See containers-add for information on known ones: %s',
-                        exc,
-                        ", ".join(cmd_kwargs)))
-                return
-        else:
-            # just prepend and pray
-            cmd = container['path'] + ' ' + cmd
+        if serve:
+            yield from run_server(ds)
+            return
+        if flush:
+            with get_dataset_lock(ds, JOURNAL_LOCK):
+                yield from flush_journal(ds)
+            return
+        if stage and (cmd or container_name):
+            yield get_status_dict(
+                'run',
+                ds=ds,
+                status='impossible',
+                message='a command or container name cannot be given '
+                        'together with pipeline stages')
+            return
+        if stage and len(stage) > 1 and not shutil.which('bash'):
+            yield get_status_dict(
+                'run',
+                ds=ds,
+                status='impossible',
+                message='pipeline stages require bash')
+            return
+        if dry_run == 'cost':
+            yield from _report_fetch_cost(
+                ds, pwd, stage or [(container_name, cmd)], inputs)
+            return
+        if dry_run and (journal or worktree):
+            yield get_status_dict(
+                'run',
+                ds=ds,
+                status='impossible',
+                message='a dry run cannot be combined with journal mode or '
+                        'worktree execution')
+            return
+        if journal and (worktree or run_cache or stage or stream_inputs):
+            yield get_status_dict(
+                'run',
+                ds=ds,
+                status='impossible',
+                message='journal mode cannot be combined with worktree '
+                        'execution, the run cache, pipeline stages, or '
+                        'streaming inputs')
+            return
+        if journal:
+            yield from _run_journaled(ds, pwd, container_name, cmd, dict(
+                dataset=dataset or (ds if ds.path == pwd else None),
+                inputs=inputs,
+                outputs=outputs,
+                message=message,
+                expand=expand,
+                explicit=True,
+                sidecar=sidecar,
+            ))
+            return
+        if worktree:
+            yield from _run_in_worktree(ds, dict(
+                cmd=cmd,
+                container_name=container_name,
+                inputs=inputs,
+                outputs=outputs,
+                message=message,
+                expand=expand,
+                explicit=explicit,
+                sidecar=sidecar,
+                run_cache=run_cache,
+                stage=stage,
+                stream_inputs=stream_inputs,
+            ))
+            return
 
+        containers = []
+        cmds = []
         extra_inputs = []
-        for extra_input in ensure_iter(container.get("extra-input",[]), set):
-            try:
-                xi_kwargs = dict(
-                    img_dspath=image_dspath,
-                    img_dirpath=op.dirname(image_path) or ".",
-                )
-                extra_inputs.append(extra_input.format(**xi_kwargs))
-            except KeyError as exc:
-                yield get_status_dict(
-                    'run',
-                    ds=ds,
-                    status='error',
-                    message=(
-                        'Unrecognized extra_input placeholder: %s. '
-                        'See containers-add for information on known ones: %s',
-                        exc,
-                        ", ".join(xi_kwargs)))
+        store_paths = []
+        for stage_container, stage_cmd in stage or [(container_name, cmd)]:
+            spec = yield from _get_container_command(
+                ds, pwd, stage_container, stage_cmd, timer)
+            if spec is None:
                 return
+            container, stage_cmd, image_path, stage_inputs = spec
+            containers.append(container)
+            cmds.append(stage_cmd)
+            for p in [image_path] + stage_inputs:
+                if p not in extra_inputs:
+                    extra_inputs.append(p)
+            store_paths.append([container['path']] + [
+                op.join(pwd, p) for p in stage_inputs])
+        if len(cmds) == 1:
+            cmd = _wrap_command(cmds[0], containers[0], pwd)
+        else:
+            cmd = _wrap_command(_format_pipeline(
+                # stages with an overlay need a wrapper of their own
+                _wrap_command(c, container, pwd)
+                if '{overlay}' in container.get('cmdexec', '') else c
+                for c, container in zip(cmds, containers)), None, pwd)
 
-        lgr.debug("extra_inputs = %r", extra_inputs)
+        # with an image store, missing image content is taken from the
+        # store instead of being downloaded by `run`, and downloaded
+        # content is deposited in the store afterwards
+        use_store = []
+        for container, paths in zip(containers, store_paths):
+            image_ds = Dataset(container.get('parentds', ds.path))
+            if get_store(image_ds) is not None \
+                    and image_ds.is_installed() and not dry_run:
+                get_from_store(image_ds, paths)
+                use_store.append((image_ds, paths))
+        if use_store:
+            timer.account('fetch')
 
-        with patch.dict('os.environ',
-                        {CONTAINER_NAME_ENVVAR: container['name']}):
-            # fire!
-            for r in run_command(
-                    cmd=cmd,
-                    dataset=dataset or (ds if ds.path == pwd else None),
-                    inputs=inputs,
-                    extra_inputs=[image_path] + extra_inputs,
-                    outputs=outputs,
-                    message=message,
-                    expand=expand,
-                    explicit=explicit,
-                    sidecar=sidecar):
+        run_kwargs = dict(
+            cmd=cmd,
+            dataset=dataset or (ds if ds.path == pwd else None),
+            inputs=inputs,
+            extra_inputs=extra_inputs,
+            outputs=outputs,
+            message=message,
+            expand=expand,
+            explicit=explicit,
+            sidecar=sidecar,
+        )
+        extra_info = {RECORD_KEY: {
+            'containers': _describe_containers(containers, pwd)}}
+        inject = False
+        if run_cache:
+            cmd_expanded = _expand_command(run_kwargs)
+            fingerprint = get_fingerprint(
+                ds, pwd, cmd_expanded, extra_inputs, ensure_list(inputs),
+                ensure_list(outputs)) if cmd_expanded else None
+            cached = lookup(ds, fingerprint) if fingerprint else None
+            if cached:
+                restored = restore_outputs(ds, cached)
+                if not restored:
+                    yield get_status_dict(
+                        'run',
+                        ds=ds,
+                        status='notneeded',
+                        message=('outputs of identical run %s are '
+                                 'up-to-date', cached))
+                    return
+                lgr.info("Restored outputs of identical run %s, "
+                         "not executing command", cached)
+                # record the restored changes, as if the command had run
+                inject = True
+            if fingerprint:
+                extra_info[RECORD_KEY]['run_cache'] = fingerprint
+            timer.account('run_cache')
+
+        report_timings = ds.config.obtain(TIMINGS_CFG)
+        if report_timings == 'record':
+            # the execution is timed before the record is created, hence
+            # all but the final save will be reflected in the record
+            extra_info[RECORD_KEY]['timings'] = timer.timings
+
+        env = {CONTAINER_NAME_ENVVAR:
+               ' '.join(c['name'] for c in containers)}
+        if inject or dry_run:
+            # with `inject` there is neither input preparation nor
+            # execution, only the saving of the recorded changes
+            for r in run_command(extra_info=extra_info, inject=inject,
+                                 dry_run=dry_run, **run_kwargs):
+                timer.account('save')
+                if r.get('action') == 'run':
+                    r['timings'] = timer.timings
                 yield r
+                timer.skip()
+        else:
+            yield from _run_instrumented(
+                ds, pwd, run_kwargs, extra_info, env, timer,
+                [p for paths in store_paths for p in paths],
+                stream_inputs)
+        for image_ds, paths in use_store:
+            add_to_store(image_ds, paths)
+        if use_store:
+            timer.account('save')
+        if report_timings in ('summary', 'record'):
+            lgr.info("Timings of containerized run: %s", timer.format())
+
+    @staticmethod
+    def custom_result_renderer(res, **kwargs):
+        # the 'basic' and 'command' dry runs are displayed like those of
+        # `run`, the 'cost' estimate is reported by its message
+        Run.custom_result_renderer(res, **kwargs)
+
+
+# locks serializing the dataset modifications of asynchronous runs, per
+# event loop and dataset
+_async_locks = weakref.WeakKeyDictionary()
+
+
+def _get_async_lock(ds):
+    locks = _async_locks.setdefault(asyncio.get_running_loop(), {})
+    return locks.setdefault(ds.path, asyncio.Lock())
+
+
+@datasetmethod(name='containers_run_async')
+async def containers_run_async(cmd, container_name=None, dataset=None,
+                               inputs=None, outputs=None, message=None,
+                               expand=None, sidecar=None, on_result=None):
+    """Asynchronous variant of `containers_run`
+
+    Multiple containerized commands can be executed concurrently in the same
+    dataset, for example via ``asyncio.gather()``. Only the execution of the
+    commands happens concurrently. Locating the container, obtaining inputs,
+    and saving the outputs with a run record are serialized per dataset, to
+    keep the history consistent.
+
+    As concurrently executed commands share the same working tree, all
+    outputs of a command must be declared. Commands are always executed in
+    explicit mode (see `containers_run`), and without access to stdin.
+
+    Parameters
+    ----------
+    on_result : callable, optional
+      Called with each result record as soon as it is available, possibly
+      from another thread.
+    Other parameters: see `containers_run`.
+
+    Returns
+    -------
+    list
+      Result records.
+
+    Raises
+    ------
+    IncompleteResultsError
+      If any result record indicates a failure.
+    """
+    loop = asyncio.get_running_loop()
+    pwd, _ = get_command_pwds(dataset)
+    ds = require_dataset(dataset, check_installed=True,
+                         purpose='run a containerized command execution')
+    run_kwargs = dict(
+        dataset=dataset or (ds if ds.path == pwd else None),
+        inputs=inputs,
+        outputs=outputs,
+        message=message,
+        expand=expand,
+        explicit=True,
+        sidecar=sidecar,
+    )
+    results = []
+    lock = _get_async_lock(ds)
+
+    def _add_result(r):
+        results.append(r)
+        if on_result:
+            on_result(r)
+
+    def _run_sync(gen):
+        # run a result generator to completion, and report its return value
+        value = []
+
+        def _consume():
+            value.append((yield from gen))
+        for r in _consume():
+            _add_result(r)
+        return value[0]
+
+    async with lock:
+        spec = await loop.run_in_executor(
+            None, _run_sync,
+            _prepare_execution(ds, pwd, container_name, cmd, run_kwargs))
+    failed = [r for r in results
+              if r.get('status') in ('error', 'impossible')]
+    if failed or spec is None:
+        raise IncompleteResultsError(results=results, failed=failed)
+    container, _, _, expanded = spec
+    cmd_expanded = expanded['dry_run_info']['cmd_expanded']
+    outputs = GlobbedPaths(expanded['dry_run_info']['outputs'], pwd=pwd)
+    # outputs that are removed by the command need to be recorded too
+    pre_outputs = set(outputs.expand_strict(full=True))
+
+    lgr.info("Starting containerized command: %s", cmd_expanded)
+    usage_file = _mktemp(ds, 'usage-')
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            cmd_expanded,
+            cwd=pwd,
+            stdin=asyncio.subprocess.DEVNULL,
+            env=dict(os.environ, **{
+                CONTAINER_NAME_ENVVAR: container['name'],
+                USAGE_ENVVAR: usage_file}),
+        )
+        exit_code = await proc.wait()
+        usage = read_usage(usage_file)
+    finally:
+        os.unlink(usage_file)
+    res = _get_run_result(ds, pwd, container, expanded, exit_code, usage,
+                          cmd_expanded)
+    _add_result(res)
+    if res['status'] != 'ok':
+        raise IncompleteResultsError(results=results, failed=[res])
+
+    post_outputs = set(outputs.expand_strict(full=True, refresh=True))
+    async with lock:
+        # the command already ran, only record its outcome like the
+        # journal does
+        await loop.run_in_executor(
+            None, _run_sync,
+            save_run(ds, res['run_info'], sorted(pre_outputs | post_outputs),
+                     cmd_expanded,
+                     message=run_kwargs['message'],
+                     sidecar=run_kwargs['sidecar']))
+    failed = [r for r in results
+              if r.get('status') in ('error', 'impossible')]
+    if failed:
+        raise IncompleteResultsError(results=results, failed=failed)
+    return results
@@ -0,0 +1,138 @@
+"""Report on and clean up the host-wide container image store"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+
+import datalad.support.ansi_colors as ac
+from datalad.distribution.dataset import (
+    EnsureDataset,
+    datasetmethod,
+    require_dataset,
+)
+from datalad.interface.base import (
+    Interface,
+    build_doc,
+    eval_results,
+)
+from datalad.interface.results import get_status_dict
+from datalad.interface.utils import default_result_renderer
+from datalad.support.constraints import EnsureNone
+from datalad.support.param import Parameter
+from datalad.ui import ui
+from datalad.utils import bytes2human
+
+from datalad_container.image_store import (
+    STORE_CFG,
+    get_store,
+    iter_store,
+    remove_object,
+)
+
+lgr = logging.getLogger("datalad.containers.containers_store")
+
+
+@build_doc
+# all commands must be derived from Interface
+class ContainersStore(Interface):
+    # first docstring line is used a short description in the cmdline help
+    # the rest is put in the verbose help and manpage
+    """Report usage of the host-wide container image store
+
+    If the configuration ``{store_cfg}`` is set to a directory, container
+    images are shared across datasets on the same host via this store:
+    'containers-add' and 'containers-run' take image content from the store
+    instead of downloading it, and deposit newly obtained images in it.
+
+    Stored images are placed into datasets via hardlinks where possible.
+    An image that is not hardlinked into any dataset anymore is considered
+    unused, and can be removed with [CMD: --gc CMD][PY: gc=True PY].
+    Images that had to be copied into a dataset (e.g., due to a store
+    on another file system) are always reported as unused.
+    """
+
+    _docs_ = dict(
+        store_cfg=STORE_CFG,
+    )
+
+    result_renderer = 'tailored'
+    # parameters of the command, must be exhaustive
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            doc="""specify a dataset whose configuration is used to determine
+            the location of the image store. If no dataset is given, only
+            the global and user configuration is considered""",
+            constraints=EnsureDataset() | EnsureNone()),
+        gc=Parameter(
+            args=("--gc",),
+            action="store_true",
+            doc="""remove unused images from the store"""),
+    )
+
+    @staticmethod
+    @datasetmethod(name='containers_store')
+    @eval_results
+    def __call__(dataset=None, gc=False):
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose='locate the image store') \
+            if dataset else None
+        store = get_store(ds)
+        if store is None:
+            yield get_status_dict(
+                action='containers_store',
+                status='impossible',
+                logger=lgr,
+                message=('no image store configured (%s)', STORE_CFG))
+            return
+
+        for key, path, stat in iter_store(store):
+            # the store holds one link itself, every additional link is
+            # a dataset annex sharing the same content
+            used = stat.st_nlink > 1
+            res = get_status_dict(
+                action='containers_store',
+                path=str(path),
+                type='file',
+                status='ok',
+                key=key,
+                bytesize=stat.st_size,
+                nlinks=stat.st_nlink - 1,
+                state='used' if used else 'unused',
+                logger=lgr,
+            )
+            if gc and not used:
+                remove_object(store, key)
+                res['state'] = 'removed'
+            yield res
+
+    @staticmethod
+    def custom_result_renderer(res, **kwargs):
+        if res["action"] != "containers_store" or res['status'] != 'ok':
+            default_result_renderer(res)
+        else:
+            ui.message(
+                "{key} {size} [{state}]".format(
+                    key=res["key"],
+                    size=bytes2human(res["bytesize"]),
+                    state=ac.color_word(
+                        res["state"],
+                        ac.GREEN if res["state"] == 'used' else ac.YELLOW)))
+
+    @staticmethod
+    def custom_result_summary_renderer(results):
+        stored = [r for r in results
+                  if r['action'] == 'containers_store'
+                  and r['status'] == 'ok']
+        if not stored:
+            return
+        kept = [r for r in stored if r['state'] != 'removed']
+        ui.message(
+            "{n} image(s) in store, {size} total{removed}".format(
+                n=len(kept),
+                size=bytes2human(sum(r['bytesize'] for r in kept)),
+                removed=", {} removed ({})".format(
+                    len(stored) - len(kept),
+                    bytes2human(sum(r['bytesize'] for r in stored
+                                    if r['state'] == 'removed')))
+                if len(kept) < len(stored) else ''))
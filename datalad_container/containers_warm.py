@@ -0,0 +1,184 @@
+"""Pre-warm the page cache with container images"""
+
+__docformat__ = 'restructuredtext'
+
+import logging
+import os.path as op
+
+from datalad.distribution.dataset import (
+    EnsureDataset,
+    datasetmethod,
+    require_dataset,
+)
+from datalad.interface.base import (
+    Interface,
+    build_doc,
+    eval_results,
+)
+from datalad.interface.results import get_status_dict
+from datalad.interface.utils import default_result_renderer
+from datalad.support.constraints import (
+    EnsureChoice,
+    EnsureInt,
+    EnsureNone,
+    EnsureStr,
+)
+from datalad.support.param import Parameter
+from datalad.ui import ui
+from datalad.utils import (
+    bytes2human,
+    ensure_iter,
+)
+
+from datalad_container.find_container import find_container_
+from datalad_container.image_warm import (
+    WARM_CFG,
+    WARM_METHODS,
+    warm_files,
+)
+from datalad_container.utils import get_image_files
+
+lgr = logging.getLogger("datalad.containers.containers_warm")
+
+
+@build_doc
+# all commands must be derived from Interface
+class ContainersWarm(Interface):
+    # first docstring line is used a short description in the cmdline help
+    # the rest is put in the verbose help and manpage
+    """Pre-warm the page cache with container images
+
+    On a node with a cold page cache, the first execution in a large
+    container image can be much slower than subsequent ones, because the
+    blocks of the image are read in random order from (network) storage.
+    This command brings the images of the given containers, and their extra
+    inputs (e.g., overlays), into the page cache ahead of an execution,
+    processing multiple files in parallel. Only images whose content is
+    present are warmed.
+
+    With 'fadvise', the kernel is advised to read the files ahead, and the
+    command returns immediately. With 'read', the files are read
+    sequentially, and the command returns once they are cached.
+
+    'containers-run' warms the images of a run before its execution, if the
+    configuration ``{warm_cfg}`` is set to one of these methods. The time
+    spent is reported as the 'warm' phase of its timings.
+    """
+
+    _docs_ = dict(
+        warm_cfg=WARM_CFG,
+    )
+
+    result_renderer = 'tailored'
+    # parameters of the command, must be exhaustive
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            doc="""specify the dataset to query. If no dataset is given, an
+            attempt is made to identify the dataset based on the current
+            working directory""",
+            constraints=EnsureDataset() | EnsureNone()),
+        name=Parameter(
+            args=("name",),
+            nargs='*',
+            metavar="NAME",
+            doc="""name of (or path to) a container to warm. If none is
+            given, all containers of the dataset are warmed""",
+            constraints=EnsureStr() | EnsureNone()),
+        method=Parameter(
+            args=("--method",),
+            doc="""how to warm the images""",
+            constraints=EnsureChoice(*WARM_METHODS)),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of files warmed in parallel. By default, it is
+            derived from the number of CPUs""",
+            constraints=EnsureInt() | EnsureNone()),
+    )
+
+    @staticmethod
+    @datasetmethod(name='containers_warm')
+    @eval_results
+    def __call__(name=None, dataset=None, method='fadvise', jobs=None):
+        ds = require_dataset(dataset, check_installed=True,
+                             purpose='warm container images')
+
+        if name:
+            containers = []
+            for n in ensure_iter(name, list):
+                try:
+                    for res in find_container_(ds, n):
+                        if res.get('action') == 'containers':
+                            containers.append(res)
+                        else:
+                            yield res
+                except ValueError as e:
+                    yield get_status_dict(
+                        action='containers_warm',
+                        ds=ds,
+                        status='impossible',
+                        logger=lgr,
+                        message=('cannot find container %s: %s', n, e))
+        else:
+            containers = ds.containers_list(
+                return_type='list', result_renderer='disabled')
+
+        paths = []
+        for container in containers:
+            for path in get_image_files(ds, container):
+                if not op.exists(path):
+                    # e.g., the dangling symlink of an annexed file
+                    yield get_status_dict(
+                        action='containers_warm',
+                        path=path,
+                        type='file',
+                        status='impossible',
+                        logger=lgr,
+                        message='content not present')
+                elif path not in paths:
+                    paths.append(path)
+
+        for path, size, duration, exc in warm_files(paths, method, jobs):
+            if exc:
+                yield get_status_dict(
+                    action='containers_warm',
+                    path=path,
+                    type='file',
+                    status='error',
+                    logger=lgr,
+                    message=('cannot warm: %s', exc))
+                continue
+            yield get_status_dict(
+                action='containers_warm',
+                path=path,
+                type='file',
+                status='ok',
+                method=method,
+                bytesize=size,
+                duration=duration,
+                logger=lgr,
+            )
+
+    @staticmethod
+    def custom_result_renderer(res, **kwargs):
+        if res["action"] != "containers_warm" or res['status'] != 'ok':
+            default_result_renderer(res)
+        else:
+            ui.message(
+                "{path} {size} [{duration:.2f}s]".format(
+                    path=res["path"],
+                    size=bytes2human(res["bytesize"]),
+                    duration=res["duration"]))
+
+    @staticmethod
+    def custom_result_summary_renderer(results):
+        warmed = [r for r in results
+                  if r['action'] == 'containers_warm'
+                  and r['status'] == 'ok']
+        if not warmed:
+            return
+        ui.message(
+            "{n} file(s) warmed, {size} total".format(
+                n=len(warmed),
+                size=bytes2human(sum(r['bytesize'] for r in warmed))))
@@ -0,0 +1,100 @@
+"""Estimation of the data transfer needed before a containerized execution
+
+The annexed content of the image, the extra inputs, and the inputs of a run
+has to be obtained before the command can be executed. Its size, and the
+remotes it is available from, can be determined from the annex keys and
+location logs alone, without any transfer.
+"""
+
+from __future__ import annotations
+
+import logging
+import os.path as op
+import re
+from collections import defaultdict
+
+from datalad.distribution.dataset import Dataset
+from datalad.support.annexrepo import AnnexRepo
+from datalad.support.exceptions import CommandError
+from datalad.utils import get_dataset_root
+
+lgr = logging.getLogger("datalad.containers.fetch_cost")
+
+# annex describes remotes as "<description> [<name>]"
+_REMOTE_NAME_REGEX = re.compile(r'\[(?P<name>[^\]]+)\]$')
+
+
+def _remote_label(location: dict) -> str:
+    match = _REMOTE_NAME_REGEX.search(location['description'])
+    return match.group('name') if match else location['description']
+
+
+def _group_by_repo(paths) -> dict:
+    repos = defaultdict(list)
+    for path in paths:
+        if not op.lexists(path):
+            continue
+        root = get_dataset_root(
+            path if op.isdir(path) and not op.islink(path)
+            else op.dirname(path))
+        if root:
+            repos[root].append(op.relpath(path, root))
+    return repos
+
+
+def estimate_fetch_cost(paths) -> dict:
+    """Determine the annexed content of `paths` that would need fetching
+
+    Parameters
+    ----------
+    paths: list
+      Absolute paths of files or directories. Nonexistent paths are ignored.
+
+    Returns
+    -------
+    dict
+      With the keys 'bytes' (total size of the missing content), 'files'
+      (number of missing keys), 'unknown_size' (number of missing keys of
+      unknown size, not accounted for in 'bytes'), 'present_bytes' (size of
+      content that is present already), 'remotes' (mapping of remote names
+      to the number of missing bytes available from them), and 'unavailable'
+      (paths whose content is not known to be available anywhere).
+    """
+    cost = dict(bytes=0, files=0, unknown_size=0, present_bytes=0,
+                remotes={}, unavailable=[])
+    seen = set()
+    for root, relpaths in _group_by_repo(paths).items():
+        repo = Dataset(root).repo
+        if not isinstance(repo, AnnexRepo):
+            # content in git is always present
+            continue
+        try:
+            # one query for all paths in this repository
+            records = list(repo.call_annex_records(['whereis'],
+                                                   files=relpaths))
+        except CommandError as e:
+            lgr.debug("Cannot query locations in %s: %s", root, e)
+            records = [r for r in e.kwargs.get('stdout_json', [])
+                       if r.get('success')]
+        for rec in records:
+            key = rec.get('key')
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            size = AnnexRepo.get_size_from_key(key)
+            locations = rec.get('whereis', [])
+            if any(loc.get('here') for loc in locations):
+                cost['present_bytes'] += size or 0
+                continue
+            cost['files'] += 1
+            if size is None:
+                cost['unknown_size'] += 1
+            else:
+                cost['bytes'] += size
+            if not locations:
+                cost['unavailable'].append(op.join(root, rec['file']))
+            for loc in locations:
+                label = _remote_label(loc)
+                cost['remotes'][label] = \
+                    cost['remotes'].get(label, 0) + (size or 0)
+    return cost
@@ -0,0 +1,347 @@
+"""Parallel download of large container images via HTTP range requests
+
+A single HTTP stream is often limited by the latency of the link rather than
+its bandwidth. Images from HTTP(S) servers that support range requests are
+therefore downloaded in chunks, by multiple concurrent requests. The chunks
+are written into a partial file in ``.git/datalad/containers/downloads``,
+next to a record of the completed chunks. An interrupted download is resumed
+from there, as long as the server still reports the same content.
+
+The content is hashed in order while the chunks arrive, and verified against
+a checksum announced by the server (``Digest``/``Repr-Digest`` header). The
+hash is used as the annex key of the image, hence the content is not read
+again when it is annexed. Without an announced checksum, the completed file
+is hashed once more, and has to match the hash of the key.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import re
+import threading
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
+from pathlib import Path
+
+from datalad.distribution.dataset import Dataset
+from datalad.support.exceptions import (
+    CommandError,
+    DownloadError,
+)
+
+from datalad_container.image_store import place_annex_object
+from datalad_container.utils import (
+    REGISTRATION_LOCK,
+    get_dataset_lock,
+)
+
+lgr = logging.getLogger("datalad.containers.image_download")
+
+DOWNLOAD_JOBS_CFG = 'datalad.containers.download-jobs'
+
+CHUNK_SIZE = 16 * 1024 * 1024
+# smaller files are not worth the overhead of multiple requests
+MIN_SIZE = 2 * CHUNK_SIZE
+
+# annex backends whose keys can be made from a hash computed here
+_BACKENDS = {'SHA256': 'sha256', 'MD5': 'md5'}
+
+# RFC 3230 and RFC 9530 algorithm names
+_DIGEST_ALGORITHMS = {'sha-256': 'sha256', 'md5': 'md5'}
+_DIGEST_REGEX = re.compile(r'([\w-]+)=:?([A-Za-z0-9+/=]+):?')
+
+
+def _get_announced_digest(headers) -> tuple | None:
+    # the checksum of the content, as announced by the server
+    for header in ('Repr-Digest', 'Digest'):
+        for algorithm, value in _DIGEST_REGEX.findall(
+                headers.get(header, '')):
+            name = _DIGEST_ALGORITHMS.get(algorithm.lower())
+            if name:
+                return name, base64.b64decode(value).hex()
+    return None
+
+
+def probe(url: str, session=None) -> dict:
+    """Determine size, identity, and range support of the content at `url`
+
+    Returns
+    -------
+    dict
+      With the keys 'url' (after redirects), 'size' (or None), 'etag',
+      'ranges' (bool), and 'digest' (an announced (algorithm, hex digest),
+      or None).
+    """
+    import requests
+    session = session or requests.Session()
+    r = session.head(url, allow_redirects=True, timeout=60)
+    r.raise_for_status()
+    size = r.headers.get('Content-Length')
+    return dict(
+        url=r.url,
+        size=int(size) if size and size.isdigit() else None,
+        etag=r.headers.get('ETag'),
+        ranges=r.headers.get('Accept-Ranges', '').lower() == 'bytes',
+        digest=_get_announced_digest(r.headers),
+    )
+
+
+class _OrderedHasher:
+    """Hash the chunks of a file in order, as they are completed"""
+
+    def __init__(self, path: Path, chunk_size: int, nchunks: int,
+                 algorithms):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.nchunks = nchunks
+        self.hashes = {a: hashlib.new(a) for a in algorithms}
+        self.done = set()
+        self.next = 0
+
+    def complete(self, chunk: int):
+        self.done.add(chunk)
+        with self.path.open('rb') as f:
+            while self.next in self.done:
+                f.seek(self.next * self.chunk_size)
+                data = f.read(self.chunk_size)
+                for h in self.hashes.values():
+                    h.update(data)
+                self.next += 1
+
+    def hexdigests(self) -> dict:
+        assert self.next == self.nchunks
+        return {a: h.hexdigest() for a, h in self.hashes.items()}
+
+
+def _hash_file(path: Path, algorithms) -> dict:
+    hashes = {a: hashlib.new(a) for a in algorithms}
+    with path.open('rb') as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+            for h in hashes.values():
+                h.update(data)
+    return {a: h.hexdigest() for a, h in hashes.items()}
+
+
+def _fetch_chunk(session, url, path, chunk, chunk_size, size, etag=None):
+    start = chunk * chunk_size
+    end = min(start + chunk_size, size) - 1
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if etag and not etag.startswith('W/'):
+        # the full, changed content is sent instead of a range, if the
+        # content changed since the download started
+        headers['If-Range'] = etag
+    r = session.get(url, headers=headers, stream=True, timeout=60)
+    if r.status_code != 206:
+        r.close()
+        raise DownloadError(
+            "Range request for {} failed with status {}".format(
+                url, r.status_code))
+    written = 0
+    # each chunk is written through its own file descriptor
+    with open(path, 'r+b') as f:
+        f.seek(start)
+        for data in r.iter_content(1024 * 1024):
+            f.write(data)
+            written += len(data)
+    if written != end - start + 1:
+        raise DownloadError(
+            "Incomplete chunk {} of {}: {} of {} bytes".format(
+                chunk, url, written, end - start + 1))
+    return chunk
+
+
+def download(url: str, path: str | Path, info: dict, jobs: int = 4,
+             algorithms=('sha256',), chunk_size: int | None = None) -> dict:
+    """Download `url` to `path` in chunks, resuming a partial download
+
+    Parameters
+    ----------
+    url: str
+    path: str or Path
+      Destination. While incomplete, the download is kept at this path, and
+      the completed chunks are recorded in a file with the suffix '.state'.
+    info: dict
+      As returned by `probe()`. The server must support range requests,
+      and report the size.
+    jobs: int, optional
+      Number of concurrent requests.
+    algorithms: sequence, optional
+      Names of the hash algorithms to compute.
+    chunk_size: int, optional
+      Size of the ranges requested, `CHUNK_SIZE` by default.
+
+    Returns
+    -------
+    dict
+      Mapping of algorithm names to hex digests of the content.
+
+    Raises
+    ------
+    DownloadError
+      If a chunk could not be obtained (the download can be resumed), or
+      the content does not match the checksum announced by the server (or,
+      without one, the content of the completed file).
+    """
+    import requests
+    chunk_size = chunk_size or CHUNK_SIZE
+    path = Path(path)
+    state_path = path.with_name(path.name + '.state')
+    size = info['size']
+    nchunks = max(1, -(-size // chunk_size))
+    identity = dict(url=url, size=size, etag=info['etag'],
+                    chunk_size=chunk_size)
+
+    done = []
+    if path.exists() and state_path.exists():
+        state = json.loads(state_path.read_text())
+        if state.get('identity') == identity:
+            done = state['done']
+            lgr.info("Resuming download of %s, %i of %i chunks present",
+                     url, len(done), nchunks)
+    if not done:
+        with path.open('wb') as f:
+            f.truncate(size)
+
+    def _record(chunk):
+        done.append(chunk)
+        tmp = state_path.with_name(state_path.name + '.tmp')
+        tmp.write_text(json.dumps(dict(identity=identity, done=done)))
+        os.replace(tmp, state_path)
+
+    algorithms = set(algorithms)
+    if info['digest']:
+        algorithms.add(info['digest'][0])
+    hasher = _OrderedHasher(path, chunk_size, nchunks, algorithms)
+    for chunk in sorted(done):
+        hasher.complete(chunk)
+
+    # a session is not thread-safe, each worker uses its own
+    sessions = threading.local()
+
+    def _fetch(chunk):
+        session = getattr(sessions, 'session', None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        return _fetch_chunk(session, info['url'], path, chunk, chunk_size,
+                            size, info['etag'])
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_fetch, c)
+                   for c in range(nchunks) if c not in done]
+        for future in as_completed(futures):
+            try:
+                chunk = future.result()
+            except (requests.RequestException, DownloadError) as e:
+                failures.append(e)
+                continue
+            _record(chunk)
+            # hashed while other chunks are still in flight
+            hasher.complete(chunk)
+    if failures:
+        raise DownloadError(
+            "Download of {} interrupted, {} chunk(s) missing: {}".format(
+                url, len(failures), failures[0]))
+
+    digests = hasher.hexdigests()
+    if info['digest']:
+        expected = dict([info['digest']])
+    else:
+        lgr.debug("No checksum announced for %s, verifying the completed "
+                  "file", url)
+        expected = _hash_file(path, algorithms)
+    for algorithm, value in expected.items():
+        if digests[algorithm] != value:
+            path.unlink()
+            state_path.unlink()
+            raise DownloadError(
+                "Checksum mismatch for {}: {} {} != {}".format(
+                    url, algorithm, digests[algorithm], value))
+    state_path.unlink()
+    return digests
+
+
+def _get_backend(repo, path: str) -> str:
+    out = repo.call_git(
+        ['check-attr', 'annex.backend', '--', op.relpath(path, repo.path)],
+        read_only=True)
+    backend = out.strip().rsplit(': ', 1)[-1]
+    if backend in ('unspecified', 'unset', ''):
+        backend = repo.config.get('annex.backend') or 'SHA256E'
+    return backend
+
+
+def download_to_annex(ds: Dataset, url: str, path: str,
+                      jobs: int = 4) -> str | None:
+    """Create an annexed file at `path` with the content at `url`
+
+    The annex key is made with the backend configured for `path`, like
+    git-annex would make it when adding the file.
+
+    Returns
+    -------
+    str or None
+      The annex key. None, if the server does not support a chunked
+      download, or the content is too small to benefit from it.
+
+    Raises
+    ------
+    DownloadError
+    CommandError
+      If the content could not be annexed.
+    """
+    import requests
+    try:
+        info = probe(url)
+    except requests.RequestException as e:
+        lgr.debug("Cannot probe %s for a chunked download: %s", url, e)
+        return None
+    if not info['ranges'] or not info['size'] or info['size'] < MIN_SIZE:
+        return None
+
+    repo = ds.repo
+    backend = _get_backend(repo, path)
+    # the hash is computed for the backend, or its non-E variant
+    key_backend = next((b for b in _BACKENDS if backend.startswith(b)), None)
+    tmpdir = repo.dot_git / 'datalad' / 'containers' / 'downloads'
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    tmp = tmpdir / hashlib.sha256(url.encode()).hexdigest()
+    lgr.info("Downloading %s in chunks (%i concurrent requests)", url, jobs)
+    digests = download(
+        url, tmp, info, jobs=jobs,
+        algorithms=[_BACKENDS[key_backend]] if key_backend else [])
+
+    os.makedirs(op.dirname(path), exist_ok=True)
+    relpath = op.relpath(path, repo.path)
+    if key_backend:
+        key = '{}-s{}--{}'.format(
+            key_backend, info['size'], digests[_BACKENDS[key_backend]])
+        if backend != key_backend:
+            # the E variant adds the extension of the file name
+            key = repo.call_annex_oneline(
+                ['examinekey', '--migrate-to-backend=' + backend,
+                 '--filename=' + relpath, key])
+        # the object shares the inode of the download, protect both
+        tmp.chmod(0o444)
+        place_annex_object(repo, key, tmp)
+        tmp.unlink()
+        with get_dataset_lock(ds, REGISTRATION_LOCK):
+            repo.call_annex(['fromkey', key, relpath])
+    else:
+        # the content has to be hashed by git-annex
+        os.replace(tmp, path)
+        with get_dataset_lock(ds, REGISTRATION_LOCK):
+            repo.call_annex(['add', relpath])
+        key = repo.get_file_annexinfo(relpath)['key']
+    try:
+        repo.call_annex(['registerurl', key, url])
+    except CommandError as e:
+        lgr.debug("Could not register %s for %s: %s", url, key, e)
+    return key
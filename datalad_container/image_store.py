@@ -0,0 +1,335 @@
+"""Host-wide, content-addressed store for container images
+
+The same container image is frequently annexed in many datasets on the same
+host. If the configuration ``datalad.containers.store`` points to a directory,
+image content is shared between datasets via this store. Objects are kept
+under their annex key, and placed into (or taken from) a dataset's annex by
+hardlinking where possible, falling back on a reflink or a plain copy. An
+annex object is only hardlinked, if it stays read-only, i.e., not on a
+crippled filesystem, and not with ``annex.thin``, which makes unlocked files
+hardlinks of their objects.
+
+Layout of the store::
+
+  <store>/objects/<annex-key>   image content
+  <store>/urls/<sha256(url)>    annex key of the content behind a URL, and
+                                the fingerprint of the content at the time
+
+A URL can serve different content over time. Content is only taken from the
+store for a URL, if the URL still has the recorded fingerprint.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import os.path as op
+from pathlib import Path
+from shutil import copyfile
+from typing import Callable
+
+from datalad.cmd import WitlessRunner
+from datalad.distribution.dataset import Dataset
+from datalad.support.exceptions import CommandError
+from datalad.utils import (
+    on_windows,
+    path_is_subpath,
+)
+
+from datalad_container.utils import (
+    REGISTRATION_LOCK,
+    get_dataset_lock,
+)
+
+lgr = logging.getLogger("datalad.containers.image_store")
+
+STORE_CFG = 'datalad.containers.store'
+
+
+def get_store(ds: Dataset | None = None) -> Path | None:
+    """Return the path of the image store configured for `ds`, if any
+
+    Without a dataset, only the global and user configuration is consulted.
+    """
+    if ds is None:
+        from datalad import cfg
+    else:
+        cfg = ds.config
+    store = cfg.get(STORE_CFG)
+    return Path(store).expanduser() if store else None
+
+
+def link_or_copy(src: str | Path, dst: str | Path,
+                 hardlink: bool = True) -> str:
+    """Place `src` at `dst` with the cheapest available method
+
+    Parameters
+    ----------
+    hardlink: bool, optional
+      Whether a hardlink is acceptable. It is not, if `dst` could be modified
+      (e.g., its permissions) without affecting `src`.
+
+    Returns
+    -------
+    str
+      Method used, one of 'hardlink', 'reflink', or 'copy'.
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            lgr.debug("Cannot hardlink %s to %s: %s", src, dst, e)
+    if not on_windows:
+        try:
+            WitlessRunner().run(
+                ['cp', '--reflink=always', str(src), str(dst)])
+            return 'reflink'
+        except (CommandError, OSError) as e:
+            lgr.debug("Cannot reflink %s to %s: %s", src, dst, e)
+    copyfile(src, dst)
+    return 'copy'
+
+
+def may_hardlink(repo) -> bool:
+    """Whether the annex objects of `repo` can be shared by hardlinks
+
+    They cannot, if a write to a file in the worktree could modify them.
+    """
+    return not (repo.config.getbool('annex', 'thin', default=False)
+                or repo.is_crippled_fs())
+
+
+def _url_index_path(store: Path, url: str) -> Path:
+    return store / 'urls' / hashlib.sha256(url.encode()).hexdigest()
+
+
+def get_object_path(store: Path, key: str) -> Path:
+    return store / 'objects' / key
+
+
+def _read_url_index(index: Path) -> tuple:
+    # an index without a fingerprint (written by older versions) can never
+    # be validated
+    key, _, fingerprint = index.read_text().strip().partition('\n')
+    return key, fingerprint or None
+
+
+def lookup_url(store: Path, url: str,
+               get_fingerprint: Callable[[], str | None]) -> str | None:
+    """Return the key of a stored object known to be available at `url`
+
+    Parameters
+    ----------
+    get_fingerprint: callable
+      Called without arguments, if an object is known for `url`, to
+      determine the fingerprint of the content currently at `url`. The
+      object is only returned, if it matches the recorded fingerprint.
+    """
+    index = _url_index_path(store, url)
+    if not index.exists():
+        return None
+    key, fingerprint = _read_url_index(index)
+    if not get_object_path(store, key).exists() or fingerprint is None:
+        return None
+    current = get_fingerprint()
+    if current != fingerprint:
+        lgr.debug("Content at %s changed since it was stored (%s != %s)",
+                  url, current, fingerprint)
+        return None
+    return key
+
+
+def _annex_object_path(repo, key: str) -> Path:
+    return repo.pathobj / repo.call_annex_oneline(
+        ['examinekey', '--format=${objectpath}\n', key])
+
+
+def place_annex_object(repo, key: str, src: str | Path,
+                       hardlink: bool = True) -> str:
+    """Deposit `src` as the content of `key` in the annex of `repo`
+
+    The content is trusted to match the key, hence no checksum is computed.
+    Only its size is verified against the one in the key, if any.
+
+    Parameters
+    ----------
+    hardlink: bool, optional
+      Whether `src` stays read-only, and may be hardlinked. It is only
+      hardlinked, if the annex objects of `repo` stay read-only too (see
+      `may_hardlink`).
+
+    Returns
+    -------
+    str
+      Method used to place the content (see `link_or_copy`).
+
+    Raises
+    ------
+    ValueError
+      If the size of `src` does not match the key. Nothing is done.
+    """
+    size = repo.get_size_from_key(key)
+    if size is not None and os.stat(src).st_size != size:
+        raise ValueError('{} has a size of {} bytes, not the one of {}'.format(
+            src, os.stat(src).st_size, key))
+    objpath = _annex_object_path(repo, key)
+    objpath.parent.mkdir(parents=True, exist_ok=True)
+    how = link_or_copy(src, objpath,
+                       hardlink=hardlink and may_hardlink(repo))
+    if how != 'hardlink':
+        # a hardlink shares the (already read-only) permissions of the
+        # store object, anything else needs to be protected like annex does
+        objpath.chmod(0o444)
+    repo.call_annex(['setpresentkey', key, repo.uuid, '1'])
+    return how
+
+
+def _get_annexinfo(ds: Dataset, paths) -> dict:
+    # only consider paths that belong to this dataset, images and extra
+    # inputs can come from anywhere in a dataset hierarchy
+    paths = [p for p in paths
+             if path_is_subpath(str(p), ds.path) and op.lexists(p)]
+    if not paths:
+        return {}
+    return ds.repo.get_content_annexinfo(
+        paths=paths, init=None, eval_availability=True)
+
+
+def add_to_store(ds: Dataset, paths, url: str | None = None,
+                 get_fingerprint: Callable[[], str | None] | None = None
+                 ) -> list:
+    """Make the annexed content of `paths` in `ds` available in the store
+
+    Parameters
+    ----------
+    ds: Dataset
+      Dataset the paths belong to.
+    paths: list
+      Paths of (locked) annexed files. Paths without present content are
+      ignored.
+    url: str, optional
+      If given, record that the content of the (single) path is available at
+      this URL, to allow for later `lookup_url()` calls.
+    get_fingerprint: callable, optional
+      Called without arguments to determine the fingerprint of the content
+      at `url`. Without a fingerprint, the URL is not recorded.
+
+    Returns
+    -------
+    list
+      Annex keys that were newly added to the store.
+    """
+    store = get_store(ds)
+    if store is None or not hasattr(ds.repo, 'get_content_annexinfo'):
+        return []
+    added = []
+    for path, props in _get_annexinfo(ds, paths).items():
+        key = props.get('key')
+        if not key or not props.get('has_content'):
+            continue
+        fingerprint = get_fingerprint() if url and get_fingerprint else None
+        if fingerprint:
+            index = _url_index_path(store, url)
+            index.parent.mkdir(parents=True, exist_ok=True)
+            index.write_text('{}\n{}'.format(key, fingerprint))
+        objpath = get_object_path(store, key)
+        if objpath.exists():
+            continue
+        objpath.parent.mkdir(parents=True, exist_ok=True)
+        lgr.debug("Adding %s to image store at %s", key, store)
+        link_or_copy(_annex_object_path(ds.repo, key), objpath,
+                     hardlink=may_hardlink(ds.repo))
+        objpath.chmod(0o444)
+        added.append(key)
+    return added
+
+
+def get_from_store(ds: Dataset, paths) -> list:
+    """Obtain missing annexed content of `paths` in `ds` from the store
+
+    Only locked annexed files, whose content is not yet present, and whose
+    key is available in the store are considered.
+
+    Returns
+    -------
+    list
+      Paths (Path instances) whose content was obtained from the store.
+    """
+    store = get_store(ds)
+    if store is None or not hasattr(ds.repo, 'get_content_annexinfo'):
+        return []
+    obtained = []
+    for path, props in _get_annexinfo(ds, paths).items():
+        key = props.get('key')
+        if not key or props.get('has_content') or not op.islink(path):
+            continue
+        objpath = get_object_path(store, key)
+        if not objpath.exists():
+            continue
+        try:
+            how = place_annex_object(ds.repo, key, objpath)
+        except ValueError as e:
+            lgr.warning("Ignoring corrupt object in image store: %s", e)
+            continue
+        lgr.info("Obtained %s from image store (%s)", path, how)
+        obtained.append(path)
+    return obtained
+
+
+def add_url_from_store(ds: Dataset, path: str, url: str,
+                       get_fingerprint: Callable[[], str | None]) -> bool:
+    """Create annexed file `path` from stored content known for `url`
+
+    Parameters
+    ----------
+    get_fingerprint: callable
+      See `lookup_url()`.
+
+    Returns
+    -------
+    bool
+      Whether the store could provide the content. If not, nothing was done.
+    """
+    store = get_store(ds)
+    if store is None or not hasattr(ds.repo, 'get_content_annexinfo'):
+        return False
+    key = lookup_url(store, url, get_fingerprint)
+    if key is None:
+        return False
+    repo = ds.repo
+    try:
+        how = place_annex_object(repo, key, get_object_path(store, key))
+    except ValueError as e:
+        lgr.warning("Ignoring corrupt object in image store: %s", e)
+        return False
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with get_dataset_lock(ds, REGISTRATION_LOCK):
+        repo.call_annex(['fromkey', key, op.relpath(path, repo.path)])
+    try:
+        repo.call_annex(['registerurl', key, url])
+    except CommandError as e:
+        # no special remote claims this URL, not fatal
+        lgr.debug("Could not register %s for %s: %s", url, key, e)
+    lgr.info("Obtained %s from image store (%s)", url, how)
+    return True
+
+
+def iter_store(store: Path):
+    """Yield (key, path, stat) for all objects in a store"""
+    objdir = store / 'objects'
+    if not objdir.is_dir():
+        return
+    for p in sorted(objdir.iterdir()):
+        yield p.name, p, p.lstat()
+
+
+def remove_object(store: Path, key: str) -> None:
+    """Remove an object and any URL index entries pointing to it"""
+    get_object_path(store, key).unlink()
+    urldir = store / 'urls'
+    if urldir.is_dir():
+        for index in urldir.iterdir():
+            if _read_url_index(index)[0] == key:
+                index.unlink()
@@ -0,0 +1,98 @@
+"""Pre-warming of the page cache with container images
+
+On a node with a cold page cache, the blocks of a large (e.g., squashfs-based
+SIF) image are faulted in randomly from (network) storage as a container
+starts, which is much slower than reading the image sequentially. Images can
+therefore be warmed before the execution, either by advising the kernel to
+read them ahead (``posix_fadvise(POSIX_FADV_WILLNEED)``, 'fadvise'), or by
+reading them sequentially ('read'). The former returns immediately, the
+latter only once the whole image was read. Where ``posix_fadvise()`` is not
+available, images are always read.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import os.path as op
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+lgr = logging.getLogger("datalad.containers.image_warm")
+
+WARM_CFG = 'datalad.containers.warm'
+
+WARM_METHODS = ('fadvise', 'read')
+
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _iter_files(path: str):
+    # directories (e.g., extracted docker images) are warmed file by file
+    if op.isdir(path):
+        for root, _, files in os.walk(path):
+            for f in sorted(files):
+                yield op.join(root, f)
+    else:
+        yield path
+
+
+def warm_file(path: str, method: str = 'fadvise') -> int:
+    """Bring the content of a file into the page cache
+
+    Parameters
+    ----------
+    path: str
+      File to warm. Symlinks (e.g., of annexed files) are followed.
+    method: {'fadvise', 'read'}
+
+    Returns
+    -------
+    int
+      Size of the file in bytes.
+    """
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if method == 'fadvise' and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            # sequential reads let the kernel's readahead do its job
+            buf = bytearray(_CHUNK_SIZE)
+            while f.readinto(buf):
+                pass
+    return size
+
+
+def warm_files(paths: list, method: str = 'fadvise',
+               jobs: int | None = None):
+    """Warm files in parallel
+
+    Parameters
+    ----------
+    paths: list
+      Files or directories to warm.
+    method: {'fadvise', 'read'}
+    jobs: int, optional
+      Number of files warmed in parallel. By default, the default of
+      `ThreadPoolExecutor` is used.
+
+    Yields
+    ------
+    tuple
+      The path, its size in bytes (None on failure), the seconds spent
+      warming it, and the exception raised when warming it (or None), for
+      each file, in the given order.
+    """
+    def _warm(path):
+        start = time.perf_counter()
+        try:
+            size, exc = warm_file(path, method), None
+        except OSError as e:
+            size, exc = None, e
+        return path, size, time.perf_counter() - start, exc
+
+    files = [f for p in paths for f in _iter_files(p)]
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(_warm, files)
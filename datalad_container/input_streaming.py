@@ -0,0 +1,132 @@
+"""Fetching of command inputs concurrently with the command execution
+
+In streaming-input mode, containers-run starts a command as soon as the
+container image is present, while the declared inputs are still being
+obtained in the background, in the order of their declaration. A command
+has to wait for an input before reading it. Two means are available for
+that:
+
+- An input file in the annex (that is not unlocked) is a dangling symlink,
+  until its content has been obtained entirely. Hence, a test for its
+  existence (e.g., ``[ -e FILE ]``) only succeeds once it can be read.
+- The environment variable ``DATALAD_CONTAINERS_INPUT_STATUS`` points to
+  a status file. For each input file, a line ``<status><TAB><path>`` is
+  appended to it, once the file was obtained (status 'ok' or 'notneeded'),
+  or could not be obtained (status 'error' or 'impossible'). Paths are
+  relative to the working directory of the command. A last line 'done' or
+  'failed' is appended after all inputs were processed.
+
+A command waiting for an input must also watch for the 'failed' line, in
+order to not wait forever. If any input cannot be obtained, the run fails,
+even if the command succeeded: the wrapper of the container process (see
+`datalad_container.run_wrapper`) waits for the last line, and fails if it
+is 'failed'.
+"""
+
+from __future__ import annotations
+
+import logging
+import os.path as op
+import threading
+import time
+
+from datalad.distribution.dataset import Dataset
+from datalad.interface.results import get_status_dict
+from datalad.support.exceptions import CapturedException
+
+lgr = logging.getLogger("datalad.containers.input_streaming")
+
+# environment variable pointing a command to the input status file
+STATUS_ENVVAR = 'DATALAD_CONTAINERS_INPUT_STATUS'
+
+
+def wait_for_inputs(status_file: str, interval: float = 0.1) -> bool:
+    """Wait until all inputs were processed
+
+    Parameters
+    ----------
+    status_file: str
+      Path of the status file.
+    interval: float, optional
+      Seconds to wait before reading the status file again.
+
+    Returns
+    -------
+    bool
+      Whether all inputs were obtained.
+    """
+    with open(status_file, 'rb') as status:
+        while True:
+            pos = status.tell()
+            line = status.readline()
+            if not line.endswith(b'\n'):
+                # nothing new, or a line that is not complete yet
+                status.seek(pos)
+                time.sleep(interval)
+            elif line in (b'done\n', b'failed\n'):
+                return line == b'done\n'
+
+
+class InputStreamer(threading.Thread):
+    """Obtain inputs in a background thread, and report on the progress
+
+    After the thread has finished, `results` holds the result records of
+    obtaining the inputs, and `failed` indicates whether any input could not
+    be obtained.
+    """
+
+    def __init__(self, ds: Dataset, pwd: str, paths: list, status_file: str):
+        """
+        Parameters
+        ----------
+        ds: Dataset
+        pwd: str
+          Working directory of the command.
+        paths: list
+          Absolute paths of the inputs, in the order they are to be
+          obtained.
+        status_file: str
+          Path of the status file to append to.
+        """
+        super().__init__(name='containers-run-inputs', daemon=True)
+        self.ds = ds
+        self.pwd = pwd
+        self.paths = paths
+        self.status_file = status_file
+        self.results = []
+        self.failed = False
+
+    def run(self):
+        with open(self.status_file, 'a', encoding='utf-8') as status:
+            try:
+                # one input at a time: `get` reports only after all given
+                # files were processed, and may process them in parallel
+                for path in self.paths:
+                    self._get(path, status)
+            except Exception as e:
+                self.failed = True
+                ce = CapturedException(e)
+                self.results.append(get_status_dict(
+                    'get',
+                    ds=self.ds,
+                    status='error',
+                    message=('cannot obtain inputs: %s', ce),
+                    exception=ce))
+            status.write('failed\n' if self.failed else 'done\n')
+        lgr.debug("Finished obtaining %i input(s)%s", len(self.paths),
+                  ', with failures' if self.failed else '')
+
+    def _get(self, path, status):
+        for res in self.ds.get(
+                path,
+                jobs=1,
+                on_failure='ignore',
+                return_type='generator',
+                result_renderer='disabled'):
+            self.results.append(res)
+            if res.get('status') in ('error', 'impossible'):
+                self.failed = True
+            if res.get('type') == 'file':
+                status.write('{}\t{}\n'.format(
+                    res['status'], op.relpath(res['path'], self.pwd)))
+                status.flush()
@@ -0,0 +1,138 @@
+"""Pool of writable overlay images for concurrent executions
+
+A writable overlay image cannot be shared by concurrent executions in the
+same container, while creating a fresh one for each execution is slow. For a
+container with a configured overlay size, a pool of overlay images is kept in
+``.git/datalad/containers/overlays/<name>/<size>``. Each execution is handed
+an overlay that is not in use by another one, and the pool grows as needed.
+After an execution, the overlay is reset to a pristine copy of a template
+overlay that is created once per pool. The copy is sparse (or a reflink,
+where supported), so resetting is cheap.
+
+Overlays are created with ``apptainer overlay create`` (or ``singularity``),
+unless the configuration ``datalad.containers.overlay-create`` provides a
+different command, with the placeholders ``{size}`` (in MiB) and ``{path}``.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from shutil import copyfile
+
+from datalad.cmd import WitlessRunner
+from datalad.distribution.dataset import Dataset
+from datalad.support.exceptions import CommandError
+from datalad.utils import (
+    on_windows,
+    quote_cmdlinearg,
+)
+from fasteners import InterProcessLock
+
+from datalad_container.utils import (
+    get_container_command,
+    get_dataset_lock,
+)
+
+lgr = logging.getLogger("datalad.containers.overlay_pool")
+
+OVERLAY_CREATE_CFG = 'datalad.containers.overlay-create'
+
+# locks on files are held per process, hence overlays in use by this process
+# need to be tracked in addition
+_in_use = set()
+_in_use_lock = threading.Lock()
+
+
+def _get_pool(ds: Dataset, name: str, size: int) -> Path:
+    return ds.repo.dot_git / 'datalad' / 'containers' / 'overlays' \
+        / name / str(size)
+
+
+def _create_overlay(ds: Dataset, path: Path, size: int):
+    createcmd = ds.config.get(OVERLAY_CREATE_CFG)
+    if createcmd:
+        cmd = createcmd.format(size=size, path=quote_cmdlinearg(str(path)))
+    else:
+        cmd = [get_container_command(), 'overlay', 'create',
+               '--size', str(size), str(path)]
+    lgr.info("Creating %i MiB overlay %s", size, path)
+    WitlessRunner().run(cmd)
+
+
+def _reset_overlay(template: Path, path: Path):
+    if not on_windows:
+        try:
+            WitlessRunner().run(
+                ['cp', '--sparse=always', '--reflink=auto',
+                 str(template), str(path)])
+            return
+        except (CommandError, OSError) as e:
+            lgr.debug("Cannot copy %s sparsely: %s", template, e)
+    copyfile(template, path)
+
+
+def _acquire_slot(pool: Path):
+    # the first slot that is neither in use by this process, nor locked by
+    # another one
+    with _in_use_lock:
+        for i in count():
+            path = pool / 'slot-{}.img'.format(i)
+            if path in _in_use:
+                continue
+            lock = InterProcessLock(str(path.with_suffix('.lck')))
+            if lock.acquire(blocking=False):
+                _in_use.add(path)
+                return path, lock
+
+
+def _release_slot(path: Path, lock: InterProcessLock):
+    with _in_use_lock:
+        lock.release()
+        _in_use.discard(path)
+
+
+@contextmanager
+def allocate_overlay(ds: Dataset, name: str, size: int):
+    """Allocate an overlay from the pool of a container
+
+    Parameters
+    ----------
+    ds: Dataset
+      Dataset the pool belongs to.
+    name: str
+      Name of the container.
+    size: int
+      Size of the overlay in MiB.
+
+    Yields
+    ------
+    Path
+      Location of an overlay for exclusive use by the caller. It is reset,
+      and returned to the pool on exit.
+    """
+    pool = _get_pool(ds, name, size)
+    pool.mkdir(parents=True, exist_ok=True)
+    template = pool / 'template.img'
+    with get_dataset_lock(ds, 'overlay-{}'.format(name)):
+        if not template.exists():
+            _create_overlay(ds, template, size)
+    path, lock = _acquire_slot(pool)
+    try:
+        if not path.exists():
+            lgr.debug("Adding overlay %s to pool", path)
+            _reset_overlay(template, path)
+        lgr.debug("Allocated overlay %s", path)
+        yield path
+    finally:
+        try:
+            _reset_overlay(template, path)
+        except (CommandError, OSError) as e:
+            # do not hand out a dirty overlay
+            lgr.warning("Cannot reset overlay %s, removing it: %s", path, e)
+            path.unlink()
+        finally:
+            _release_slot(path, lock)
@@ -0,0 +1,98 @@
+"""Resource usage of containerized command executions
+
+A command is executed as a child process of the current process, and its
+resource usage is taken from the ``wait4()`` call that reaps this process.
+It covers the process and all of its (waited-for) descendants, and nothing
+else, i.e., neither other children of the current process, nor other
+processes that happen to run at the same time. CPU time and peak memory
+usage are reported as is, the I/O volume is estimated from the number of
+block I/O operations.
+
+Processes that are not descendants of the command, such as those of a
+container started by a Docker daemon, are not accounted for.
+
+containers-run determines the resource usage of the container process via
+`datalad_container.run_wrapper`.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import subprocess
+import sys
+import time
+
+lgr = logging.getLogger("datalad.containers.resource_usage")
+
+# size of a block reported in ru_inblock/ru_oublock
+_BLOCK_SIZE = 512
+
+
+def _get_exit_code(status):
+    # like os.waitstatus_to_exitcode(), which needs Python 3.9
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _get_usage(rusage):
+    # maxrss is reported in kilobytes on linux, and bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'cpu_user': rusage.ru_utime,
+        'cpu_system': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * rss_unit,
+        'io_read_bytes': rusage.ru_inblock * _BLOCK_SIZE,
+        'io_write_bytes': rusage.ru_oublock * _BLOCK_SIZE,
+    }
+
+
+def execute_command(cmd, env=None):
+    """Execute a command, and determine its resource usage
+
+    The output of the command is not captured.
+
+    Parameters
+    ----------
+    cmd : list
+      The command and its arguments. It is not executed by a shell.
+    env : dict, optional
+      Environment of the command, by default the one of the current
+      process.
+
+    Returns
+    -------
+    int, dict
+      The exit code of the command (negative, if it was terminated by a
+      signal), and its resource usage with the items:
+
+      ``wall_time``
+        elapsed time in seconds
+      ``cpu_user``, ``cpu_system``
+        CPU time in seconds spent in user and system mode
+      ``max_rss``
+        peak resident set size in bytes of the largest process
+      ``io_read_bytes``, ``io_write_bytes``
+        bytes read from and written to block devices
+
+      Only ``wall_time`` is reported on platforms without ``os.wait4()``.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env)
+    try:
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(proc.pid, 0)
+            # the process is reaped, let Popen know
+            proc.returncode = _get_exit_code(status)
+            usage = _get_usage(rusage)
+        else:
+            # not available on windows
+            proc.wait()
+            usage = {}
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    usage['wall_time'] = time.perf_counter() - start
+    return proc.returncode, usage
@@ -0,0 +1,179 @@
+"""Memoization of containerized command executions
+
+A containerized execution is identified by a fingerprint computed from the
+annex keys (or git blob checksums, for files not in the annex) of the
+container image, its extra inputs, and the declared inputs, plus the fully
+expanded command and the declared outputs. Runs that were executed with the
+run cache enabled record this fingerprint in their run record. An index
+mapping fingerprints to commits is built (incrementally) from the git
+history, and kept in ``.git/datalad/containers/run-cache.json``.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os.path as op
+
+from datalad.core.local.run import GlobbedPaths
+from datalad.distribution.dataset import Dataset
+from datalad.local.rerun import get_run_info
+from datalad.support.exceptions import CommandError
+
+lgr = logging.getLogger("datalad.containers.run_cache")
+
+# key under which containers-run stores its information in a run record
+RECORD_KEY = 'datalad_container'
+
+
+def get_fingerprint(ds: Dataset, pwd: str, cmd: str, image_paths: list,
+                    inputs: list, outputs: list) -> str | None:
+    """Compute the run cache fingerprint of a containerized execution
+
+    Parameters
+    ----------
+    ds: Dataset
+      Dataset the command is executed in.
+    pwd: str
+      Working directory of the command. Relative `image_paths` and
+      `inputs` are interpreted relative to it.
+    cmd: str
+      Command, after expansion of the container call format and of all
+      placeholders (e.g., '{inputs}').
+    image_paths: list
+      Paths of the container image and its extra inputs.
+    inputs: list
+      Input specification (possibly containing globs) of the command.
+    outputs: list
+      Output specification (possibly containing globs) of the command.
+
+    Returns
+    -------
+    str or None
+      None is returned, if any of the dependencies has modifications, or
+      cannot be identified by its content.
+    """
+    inputs = inputs or []
+    outputs = outputs or []
+    globbed = GlobbedPaths(inputs, pwd=pwd)
+    paths = {
+        'image': [op.join(pwd, p) for p in image_paths],
+        'inputs': [op.join(pwd, p)
+                   for p in globbed.expand(include_misses=False)],
+    }
+    content = {}
+    for res in ds.status(
+            path=paths['image'] + paths['inputs'],
+            annex='basic',
+            recursive=True,
+            untracked='no',
+            eval_subdataset_state='commit',
+            result_renderer='disabled',
+            return_type='generator',
+            on_failure='ignore'):
+        if res.get('status') != 'ok' or res.get('state') != 'clean':
+            lgr.debug("Not using run cache, dependency %s is not clean: %s",
+                      res.get('path'), res.get('state', res.get('message')))
+            return None
+        content[op.relpath(res['path'], ds.path)] = \
+            res.get('key') or res.get('gitshasum')
+    spec = {
+        'cmd': cmd,
+        'pwd': op.relpath(pwd, ds.path),
+        'inputs': sorted(inputs),
+        'outputs': sorted(outputs),
+        'content': sorted(content.items()),
+    }
+    return hashlib.sha256(
+        json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def _index_path(ds: Dataset):
+    return ds.repo.dot_git / 'datalad' / 'containers' / 'run-cache.json'
+
+
+def _load_index(ds: Dataset) -> dict:
+    repo = ds.repo
+    index_path = _index_path(ds)
+    index = {'last': None, 'runs': {}}
+    if index_path.exists():
+        index = json.loads(index_path.read_text())
+    if index['last']:
+        try:
+            repo.call_git(
+                ['merge-base', '--is-ancestor', index['last'], 'HEAD'])
+        except CommandError:
+            lgr.debug("History changed, rebuilding run cache index")
+            index = {'last': None, 'runs': {}}
+    head = repo.get_hexsha()
+    if head is None or head == index['last']:
+        return index
+
+    revrange = head if index['last'] is None else \
+        '{}..{}'.format(index['last'], head)
+    out = repo.call_git(
+        ['log', '-z', '--format=%H%n%B', '--fixed-strings',
+         '--grep=[DATALAD RUNCMD]', revrange],
+        read_only=True)
+    # log reports newest first, the newest matching commit is the one
+    # to use, and runs from an earlier index update are older
+    new_runs = {}
+    for entry in out.split('\0'):
+        if not entry.strip():
+            continue
+        hexsha, msg = entry.split('\n', 1)
+        try:
+            _, info = get_run_info(ds, msg)
+        except ValueError as e:
+            lgr.debug("Ignoring invalid run record in %s: %s", hexsha, e)
+            continue
+        fp = (info or {}).get(RECORD_KEY, {}).get('run_cache')
+        if fp and info.get('exit', 0) == 0 and fp not in new_runs:
+            new_runs[fp] = hexsha
+    index['runs'].update(new_runs)
+    index['last'] = head
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    index_path.write_text(json.dumps(index))
+    return index
+
+
+def lookup(ds: Dataset, fingerprint: str) -> str | None:
+    """Return the commit of an earlier run with the given fingerprint"""
+    return _load_index(ds)['runs'].get(fingerprint)
+
+
+def restore_outputs(ds: Dataset, hexsha: str) -> list:
+    """Restore all changes committed by the run in `hexsha`
+
+    Returns
+    -------
+    list
+      Paths (relative to the dataset root) that differed from the state
+      committed by the earlier run, and were restored.
+    """
+    repo = ds.repo
+    items = list(repo.call_git_items_(
+        ['diff', '--raw', '--no-renames', '-z', hexsha + '^', hexsha],
+        sep='\0', read_only=True))
+    changed = []
+    removed = []
+    # the raw format alternates between the change info and the path
+    for info, path in zip(items[::2], items[1::2]):
+        srcmode, dstmode, _, _, status = info.lstrip(':').split(' ')
+        if '160000' in (srcmode, dstmode):
+            # subdataset modifications are not restored
+            continue
+        (removed if status == 'D' else changed).append(path)
+
+    differing = [
+        p for p in changed + removed
+        if not repo.call_git_success(
+            ['diff', '--quiet', hexsha, 'HEAD', '--', p], read_only=True)]
+    restore = [p for p in differing if p in changed]
+    if restore:
+        repo.call_git(['checkout', hexsha, '--'] + restore)
+    remove = [p for p in differing if p in removed]
+    if remove:
+        repo.call_git(['rm', '-q', '--ignore-unmatch', '--'] + remove)
+    return differing
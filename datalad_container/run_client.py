@@ -0,0 +1,100 @@
+"""Client for the containers-run server
+
+This module only uses the Python standard library, and does not import
+DataLad. To avoid the import of DataLad via this package, it can be executed
+as a script by path::
+
+  python .../datalad_container/run_client.py -o out -- cmd args
+
+See `datalad_container.run_server` for the protocol.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os.path as op
+import socket
+import sys
+
+# the default location of the server socket, relative to a dataset root
+DEFAULT_SOCKET = op.join('.git', 'datalad', 'containers', 'run.sock')
+
+
+def request_run(socket_path: str, cmd: str | list, **kwargs):
+    """Request a run from a server, and yield its results
+
+    Parameters
+    ----------
+    socket_path: str
+      Location of the server socket.
+    cmd: str or list
+      Command to execute.
+    **kwargs
+      Further parameters of the run (container_name, inputs, outputs,
+      message, expand, sidecar).
+
+    Yields
+    ------
+    dict
+      Result records, as soon as they are reported by the server.
+    """
+    request = dict(kwargs, cmd=cmd)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def _format_result(res: dict) -> str:
+    msg = res.get('message')
+    if isinstance(msg, list):
+        try:
+            msg = msg[0] % tuple(msg[1:])
+        except (TypeError, ValueError):
+            msg = ' '.join(map(str, msg))
+    return '{}({}): {}{}'.format(
+        res.get('action'), res.get('status'), res.get('path', ''),
+        ' ({})'.format(msg) if msg else '')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Request a containerized run from a containers-run "
+                    "server")
+    parser.add_argument(
+        '-d', '--dataset', default='.',
+        help="root of the dataset served (default: current directory)")
+    parser.add_argument(
+        '-S', '--socket',
+        help="location of the server socket (default: {} in the dataset)"
+             .format(DEFAULT_SOCKET))
+    parser.add_argument('-n', '--container-name')
+    parser.add_argument('-i', '--input', dest='inputs', action='append')
+    parser.add_argument('-o', '--output', dest='outputs', action='append')
+    parser.add_argument('-m', '--message')
+    parser.add_argument(
+        '--expand', choices=('inputs', 'outputs', 'both'))
+    parser.add_argument('cmd', nargs=argparse.REMAINDER)
+    args = parser.parse_args(args)
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    if not cmd:
+        parser.error("no command given")
+
+    kwargs = {k: getattr(args, k)
+              for k in ('container_name', 'inputs', 'outputs', 'message',
+                        'expand')
+              if getattr(args, k) is not None}
+    failed = False
+    for res in request_run(
+            args.socket or op.join(args.dataset, DEFAULT_SOCKET),
+            cmd, **kwargs):
+        print(_format_result(res))
+        failed = failed or res.get('status') in ('error', 'impossible')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
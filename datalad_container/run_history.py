@@ -0,0 +1,163 @@
+"""Inspection of containerized runs in the history of a dataset"""
+
+from __future__ import annotations
+
+import logging
+import os
+import os.path as op
+from pathlib import PurePosixPath
+
+from datalad.distribution.dataset import Dataset
+from datalad.local.rerun import get_run_info
+from datalad.support.annexrepo import AnnexRepo
+
+lgr = logging.getLogger("datalad.containers.run_history")
+
+
+def iter_run_records(ds: Dataset, revrange: list):
+    """Yield the run records of the commits selected by `git log` arguments
+
+    Parameters
+    ----------
+    ds: Dataset
+    revrange: list
+      Arguments to `git log` selecting the commits (e.g., ``['A..B']``).
+
+    Yields
+    ------
+    tuple
+      The commit, its commit date (seconds since the epoch), and its run
+      record, for each run commit, newest first.
+    """
+    out = ds.repo.call_git(
+        ['log', '-z', '--format=%H%n%ct%n%B', '--fixed-strings',
+         '--grep=[DATALAD RUNCMD]'] + revrange,
+        read_only=True)
+    for entry in out.split('\0'):
+        if not entry.strip():
+            continue
+        commit, date, msg = entry.split('\n', 2)
+        try:
+            _, record = get_run_info(ds, msg)
+        except ValueError as e:
+            lgr.debug("Ignoring invalid run record in %s: %s", commit, e)
+            continue
+        if record:
+            yield commit, int(date), record
+
+
+def get_record_paths(record: dict, name: str) -> list:
+    """Return paths of a run record, as POSIX paths relative to the dataset
+
+    Parameters
+    ----------
+    record: dict
+    name: str
+      Name of the list of paths in the record, e.g., 'extra_inputs'.
+
+    Returns
+    -------
+    list
+      Paths outside of the dataset are not included.
+    """
+    pwd = record.get('pwd', '.')
+    paths = []
+    for p in record.get(name, []):
+        path = op.normpath(op.join(pwd, p))
+        if not path.startswith(op.pardir):
+            paths.append(PurePosixPath(*path.split(op.sep)).as_posix())
+    return paths
+
+
+def _annex_key(content: str) -> str | None:
+    # a symlink target or a pointer file of an annexed file
+    content = content.strip()
+    if '/annex/objects/' not in content or '\n' in content:
+        return None
+    return PurePosixPath(content).name
+
+
+def get_parent_treeish(ds: Dataset, commit: str) -> str:
+    """Return what precedes a commit, to inspect the state before it
+
+    Returns
+    -------
+    str
+      The first parent of `commit`, or the empty tree for a root commit (as
+      `git diff-tree --root` does).
+    """
+    parent = '{}^'.format(commit)
+    if ds.repo.call_git_success(['rev-parse', '--verify', '--quiet', parent],
+                                read_only=True):
+        return parent
+    return ds.repo.call_git_oneline(['hash-object', '-t', 'tree', os.devnull],
+                                    read_only=True)
+
+
+def get_annex_keys(ds: Dataset, treeish: str, paths: list) -> dict:
+    """Determine the annex keys of files in a tree of a dataset
+
+    Paths of directories (e.g., images pulled from a registry) stand for
+    all files underneath. Paths in (installed) subdatasets are resolved in
+    the commit of the subdataset that is recorded in the tree.
+
+    Parameters
+    ----------
+    ds: Dataset
+    treeish: str
+    paths: list
+      POSIX paths relative to the root of `ds`.
+
+    Returns
+    -------
+    dict
+      Mapping of paths of files to a tuple of the path of the repository
+      holding the key, and the key. Files that are not annexed in the tree
+      are not included.
+    """
+    repo = ds.repo
+    found = {}
+    for item in repo.call_git_items_(
+            ['ls-tree', '-r', '-z', '--long', treeish, '--'], files=paths,
+            sep='\0', read_only=True):
+        if item:
+            info, path = item.split('\t', 1)
+            mode, _, sha, size = info.split()
+            found[path] = (mode, sha, size)
+
+    keys = {}
+    subpaths = {}
+    for path in paths:
+        files = [p for p in found if p == path or p.startswith(path + '/')]
+        for p in files:
+            mode, sha, size = found[p]
+            # annex symlinks and pointer files are small, other files are
+            # in git
+            if mode in ('120000', '100644', '100755') and size.isdigit() \
+                    and int(size) < 1024 and isinstance(repo, AnnexRepo):
+                key = _annex_key(repo.call_git(
+                    ['cat-file', 'blob', sha], read_only=True))
+                if key:
+                    keys[p] = (repo.path, key)
+        if files:
+            continue
+        # not in this tree, maybe in a subdataset
+        parts = PurePosixPath(path).parts
+        for i in range(1, len(parts)):
+            prefix = '/'.join(parts[:i])
+            entry = repo.call_git(
+                ['ls-tree', treeish, '--', prefix], read_only=True).strip()
+            if entry and entry.startswith('160000 '):
+                subpaths.setdefault(
+                    (prefix, entry.split(' ')[2].split('\t')[0]),
+                    []).append('/'.join(parts[i:]))
+                break
+    for (prefix, commit), subds_paths in subpaths.items():
+        subds = Dataset(op.join(ds.path, prefix))
+        if not subds.is_installed():
+            lgr.debug("Subdataset %s is not installed, ignoring files "
+                      "in it: %s", subds, subds_paths)
+            continue
+        for path, key in get_annex_keys(subds, commit, subds_paths).items():
+            keys['{}/{}'.format(prefix, path)] = key
+    return keys
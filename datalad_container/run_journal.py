@@ -0,0 +1,207 @@
+"""Deferred recording of containerized command executions
+
+In journal mode, a command is executed, but its outputs are not saved.
+Instead, the run record and the list of output paths are appended to a
+journal in ``.git/datalad/containers/run-journal.jsonl``. Flushing the
+journal saves the outputs of the journaled runs in the order of execution,
+one `save` per run with a standard run record as its message. Hence, each
+run remains individually rerunnable.
+
+`save_run` records a command that was executed outside of `run` in the same
+way, right away. It is used for asynchronous runs.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os.path as op
+from hashlib import md5
+from pathlib import PurePath
+
+from datalad.distribution.dataset import Dataset
+from datalad.interface.results import get_status_dict
+from datalad.support.json_py import dump2stream
+from datalad.utils import join_cmdline
+
+lgr = logging.getLogger("datalad.containers.run_journal")
+
+# name of the dataset lock protecting the journal
+JOURNAL_LOCK = 'journal'
+
+# identical to the message format of `run`
+_MSG_TEMPLATE = u"""\
+[DATALAD RUNCMD] {}
+
+=== Do not change lines below ===
+{}
+^^^ Do not change lines above ^^^
+"""
+
+
+def _journal_path(ds: Dataset):
+    return ds.repo.dot_git / 'datalad' / 'containers' / 'run-journal.jsonl'
+
+
+def _relposix(ds: Dataset, path) -> str:
+    return PurePath(op.relpath(path, ds.path)).as_posix()
+
+
+def _shorten(cmd) -> str:
+    # like the default commit message of `run`
+    cmd = join_cmdline(cmd) if isinstance(cmd, list) else cmd
+    return cmd[:40] + ('...' if len(cmd) > 40 else '')
+
+
+def _write_journal(ds: Dataset, entries: list):
+    path = _journal_path(ds)
+    if not entries:
+        path.unlink()
+        return
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    tmp.replace(path)
+
+
+def _format_message(ds: Dataset, entry: dict):
+    """Return the commit message of a journaled run, and the path of its
+    record sidecar file, if it is stored in one (like `run` does)
+    """
+    run_info = entry['run_info']
+    record = json.dumps(run_info, indent=1, sort_keys=True,
+                        ensure_ascii=False)
+    sidecar = entry['sidecar']
+    if sidecar is None:
+        sidecar = ds.config.getbool(
+            'datalad', 'run.record-sidecar', default=False)
+    record_path = None
+    if sidecar:
+        # the record ID is the hash of the record itself
+        record_id = md5(record.encode('utf-8')).hexdigest()  # nosec
+        record_path = ds.pathobj / ds.config.get(
+            'datalad.run.record-directory',
+            default=op.join('.datalad', 'runinfo')) / record_id
+        if not op.lexists(record_path):
+            dump2stream([run_info], record_path, compressed=True)
+        record = '"{}"'.format(record_id)
+    return _MSG_TEMPLATE.format(entry['message'], record), record_path
+
+
+def read_journal(ds: Dataset) -> list:
+    """Return the journaled runs of a dataset, in the order of execution"""
+    path = _journal_path(ds)
+    if not path.exists():
+        return []
+    with path.open(encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def overlaps_journal(ds: Dataset, paths: list) -> bool:
+    """Whether any of the given (absolute) paths is an output of a journaled
+    run, or contains or is contained in one
+    """
+    journaled = set(p for entry in read_journal(ds) for p in entry['outputs'])
+    for path in map(PurePath, (_relposix(ds, p) for p in paths)):
+        for other in map(PurePath, journaled):
+            if path == other or path in other.parents \
+                    or other in path.parents:
+                return True
+    return False
+
+
+def append_to_journal(ds: Dataset, run_info: dict, outputs: list,
+                      cmd_expanded: str, message: str | None = None,
+                      sidecar: bool | None = None):
+    """Add an executed run to the journal
+
+    Parameters
+    ----------
+    ds: Dataset
+    run_info: dict
+      Run record, as it would be created by `run`.
+    outputs: list
+      Absolute paths of all outputs of the run, including those that were
+      removed by it.
+    cmd_expanded: str
+      The executed command. Used to generate a commit message, if no
+      `message` is given.
+    message: str, optional
+    sidecar: bool, optional
+      Whether to store the run record in a sidecar file.
+    """
+    entry = _make_entry(ds, run_info, outputs, cmd_expanded, message,
+                        sidecar)
+    path = _journal_path(ds)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('a', encoding='utf-8') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def save_run(ds: Dataset, run_info: dict, outputs: list, cmd_expanded: str,
+             message: str | None = None, sidecar: bool | None = None):
+    """Save the outputs of an executed run, with its run record
+
+    Parameters are the same as for `append_to_journal`.
+
+    Yields
+    ------
+    The results of `save`.
+    """
+    yield from _save_entry(ds, _make_entry(
+        ds, run_info, outputs, cmd_expanded, message, sidecar))
+
+
+def _make_entry(ds, run_info, outputs, cmd_expanded, message, sidecar):
+    return dict(
+        run_info=run_info,
+        outputs=[_relposix(ds, p) for p in outputs],
+        message=message if message is not None
+        else _shorten(cmd_expanded),
+        sidecar=sidecar,
+    )
+
+
+def _save_entry(ds, entry):
+    msg, record_path = _format_message(ds, entry)
+    paths = [op.join(ds.path, p) for p in entry['outputs']]
+    if record_path:
+        paths.append(str(record_path))
+    yield from ds.save(
+        path=paths,
+        message=msg,
+        return_type='generator',
+        result_renderer='disabled',
+        on_failure='ignore')
+
+
+def flush_journal(ds: Dataset):
+    """Save the outputs of all journaled runs, with one commit per run
+
+    Runs are removed from the journal once they are saved. If saving fails,
+    the remaining runs stay in the journal.
+
+    Yields
+    ------
+    The results of `save` for each journaled run.
+    """
+    entries = read_journal(ds)
+    if not entries:
+        yield get_status_dict(
+            'save',
+            ds=ds,
+            status='notneeded',
+            message='no journaled runs')
+        return
+
+    lgr.debug("Saving %i journaled run(s)", len(entries))
+    while entries:
+        failed = False
+        for res in _save_entry(ds, entries[0]):
+            failed = failed or res['status'] in ('impossible', 'error')
+            yield res
+        if failed:
+            return
+        entries.pop(0)
+        _write_journal(ds, entries)
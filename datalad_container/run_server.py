@@ -0,0 +1,166 @@
+"""Persistent server for containerized command executions
+
+A server process keeps a dataset, its configuration, and the container
+configuration loaded, and executes run requests received on a unix socket.
+The protocol is line-based JSON: a client sends a single JSON object with
+the parameters of the run (``cmd``, and optionally ``container_name``,
+``inputs``, ``outputs``, ``message``, ``expand``, ``sidecar``), and
+receives the result records of the run as JSON objects, one per line, as
+soon as they become available. The server closes the connection after the
+last result.
+
+Requests are executed concurrently via `containers_run_async`, up to a
+configurable limit.
+
+See `datalad_container.run_client` for a client.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+
+from datalad.distribution.dataset import Dataset
+from datalad.interface.results import get_status_dict
+from datalad.support.exceptions import (
+    CapturedException,
+    IncompleteResultsError,
+)
+
+lgr = logging.getLogger("datalad.containers.run_server")
+
+SOCKET_CFG = 'datalad.containers.server-socket'
+JOBS_CFG = 'datalad.containers.server-jobs'
+
+# parameters of `containers_run_async` that a request may specify
+REQUEST_PARAMS = frozenset((
+    'cmd', 'container_name', 'inputs', 'outputs', 'message', 'expand',
+    'sidecar'))
+
+
+def get_socket_path(ds: Dataset) -> Path:
+    """Return the location of the server socket of a dataset"""
+    path = ds.config.get(SOCKET_CFG)
+    if path:
+        return Path(path)
+    return ds.repo.dot_git / 'datalad' / 'containers' / 'run.sock'
+
+
+def _encode(res: dict) -> bytes:
+    # loggers are not serializable, and of no use to a client
+    res = {k: v for k, v in res.items() if k != 'logger'}
+    return (json.dumps(res, default=str) + '\n').encode('utf-8')
+
+
+async def _handle(ds: Dataset, jobs: asyncio.Semaphore,
+                  reader: asyncio.StreamReader,
+                  writer: asyncio.StreamWriter):
+    # delayed, to avoid a circular import
+    from datalad_container.containers_run import containers_run_async
+
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    def _on_result(res):
+        loop.call_soon_threadsafe(queue.put_nowait, res)
+
+    async def _run(request):
+        try:
+            async with jobs:
+                await containers_run_async(
+                    dataset=ds, on_result=_on_result, **request)
+        except IncompleteResultsError:
+            # the failures were reported already
+            pass
+        except Exception as e:
+            ce = CapturedException(e)
+            _on_result(get_status_dict(
+                'run', ds=ds, status='error', message=str(ce),
+                exception=ce))
+        finally:
+            _on_result(None)
+
+    try:
+        line = await reader.readline()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('not a JSON object')
+            unknown = set(request) - REQUEST_PARAMS
+            if unknown or 'cmd' not in request:
+                raise ValueError(
+                    'unknown parameters {}'.format(sorted(unknown))
+                    if unknown else 'no command given')
+        except ValueError as e:
+            writer.write(_encode(get_status_dict(
+                'run', ds=ds, status='impossible',
+                message=('invalid request: %s', e))))
+            return
+        lgr.debug("Received run request: %s", request)
+        task = asyncio.ensure_future(_run(request))
+        while True:
+            res = await queue.get()
+            if res is None:
+                break
+            writer.write(_encode(res))
+            await writer.drain()
+        await task
+    finally:
+        writer.close()
+
+
+async def serve(ds: Dataset, socket_path: Path, jobs: int):
+    """Serve run requests for a dataset until cancelled
+
+    Parameters
+    ----------
+    ds: Dataset
+    socket_path: Path
+      Location of the unix socket to listen on. Must not exist.
+    jobs: int
+      Maximum number of concurrently executed commands.
+    """
+    limit = asyncio.Semaphore(jobs)
+    server = await asyncio.start_unix_server(
+        lambda r, w: _handle(ds, limit, r, w),
+        path=str(socket_path))
+    lgr.info("Serving containerized runs of %s on %s (%i concurrent)",
+             ds, socket_path, jobs)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if socket_path.is_socket():
+            socket_path.unlink()
+
+
+def run_server(ds: Dataset):
+    """Serve run requests for a dataset until interrupted
+
+    Yields
+    ------
+    A result record, after the server was shut down.
+    """
+    socket_path = get_socket_path(ds)
+    if socket_path.exists():
+        yield get_status_dict(
+            'containers_serve',
+            ds=ds,
+            status='impossible',
+            message=('socket %s exists already, is another server running?',
+                     socket_path))
+        return
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    jobs = ds.config.obtain(JOBS_CFG, default=os.cpu_count() or 1)
+    try:
+        asyncio.run(serve(ds, socket_path, jobs))
+    except KeyboardInterrupt:
+        lgr.info("Server interrupted")
+    yield get_status_dict(
+        'containers_serve',
+        ds=ds,
+        status='ok',
+        message=('stopped serving on %s', socket_path))
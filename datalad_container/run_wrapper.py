@@ -0,0 +1,147 @@
+"""Wrapper of the container process of a containerized command execution
+
+containers-run puts this wrapper in front of the command that starts the
+container, for example::
+
+    python -m datalad_container.run_wrapper singularity exec image.sif cmd
+
+The wrapper executes the command as a child process, without a shell, and
+determines its resource usage (see `datalad_container.resource_usage`). If
+the environment variable ``DATALAD_CONTAINERS_USAGE_FILE`` names a file, the
+usage is written to it as a JSON object. In streaming-input mode (see
+`datalad_container.input_streaming`), a wrapper that reports the usage also
+waits until all inputs were processed after the command exited, and fails
+if any input could not be obtained.
+
+With ``--overlay DATASET NAME``, the wrapper allocates a writable overlay
+from the pool of container NAME in DATASET (see
+`datalad_container.overlay_pool`) for the execution, and replaces the
+placeholder ``{overlay}`` in the command with its path. The recorded command
+holds the placeholder, hence a rerun uses an overlay that is not in use by
+another execution, too.
+
+The wrapper exits with the exit code of the command. As it is part of the
+recorded command, a rerun executes it, too.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import os.path as op
+import sys
+from contextlib import ExitStack
+
+from datalad.utils import quote_cmdlinearg
+
+from datalad_container.input_streaming import (
+    STATUS_ENVVAR,
+    wait_for_inputs,
+)
+from datalad_container.resource_usage import execute_command
+
+lgr = logging.getLogger("datalad.containers.run_wrapper")
+
+# environment variable pointing the wrapper to the file to write the
+# resource usage to
+USAGE_ENVVAR = 'DATALAD_CONTAINERS_USAGE_FILE'
+
+
+def wrap_command(cmd: str, overlay: tuple | None = None) -> str:
+    """Return a shell command that executes `cmd` via the wrapper
+
+    Parameters
+    ----------
+    cmd: str
+      Has to start with the executable of the container process.
+    overlay: tuple, optional
+      Path of the dataset (relative to the working directory of the
+      command) and name of a container to allocate an overlay for.
+    """
+    # the python installation that runs *this* code, like the {python}
+    # placeholder of a call format
+    args = [sys.executable, '-m', 'datalad_container.run_wrapper']
+    if overlay:
+        args += ['--overlay'] + list(overlay)
+    return '{} {}'.format(' '.join(map(quote_cmdlinearg, args)), cmd)
+
+
+def read_usage(path: str) -> dict:
+    """Return the resource usage written by the wrapper to `path`
+
+    An empty dictionary is returned, if no usage was written.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _allocate_overlay(dspath, name, stack):
+    from datalad.distribution.dataset import Dataset
+
+    from datalad_container.overlay_pool import allocate_overlay
+
+    ds = Dataset(dspath)
+    size = ds.config.get('datalad.containers.{}.overlay-size'.format(name))
+    if not size:
+        print("No overlay size configured for container {} in {}".format(
+            name, dspath), file=sys.stderr)
+        return None
+    return op.relpath(stack.enter_context(
+        allocate_overlay(ds, name, int(size))))
+
+
+def main(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m datalad_container.run_wrapper",
+        description="Execute the container process of a containerized "
+                    "command execution, and determine its resource usage")
+    parser.add_argument(
+        "--overlay", nargs=2, metavar=("DATASET", "NAME"),
+        help="allocate an overlay of container NAME in DATASET, and "
+             "replace {overlay} in the command with its path")
+    parser.add_argument(
+        "cmd", metavar="CMD", nargs=argparse.REMAINDER,
+        help="command to execute")
+    namespace = parser.parse_args(args[1:])
+    if not namespace.cmd:
+        parser.error("no command given")
+
+    env = dict(os.environ)
+    # only the outermost wrapper reports, that of a pipeline of containers
+    usage_file = env.pop(USAGE_ENVVAR, None)
+    cmd = namespace.cmd
+    with ExitStack() as stack:
+        if namespace.overlay:
+            overlay = _allocate_overlay(*namespace.overlay, stack)
+            if overlay is None:
+                return 1
+            cmd = [arg.replace('{overlay}', overlay) for arg in cmd]
+        try:
+            exit_code, usage = execute_command(cmd, env)
+        except OSError as e:
+            print("Cannot execute {}: {}".format(cmd[0], e),
+                  file=sys.stderr)
+            # like a shell
+            return 127
+    if exit_code < 0:
+        # like a shell, for a command terminated by a signal
+        exit_code = 128 - exit_code
+    status_file = env.get(STATUS_ENVVAR) if usage_file else None
+    if status_file and not wait_for_inputs(status_file) and not exit_code:
+        # like with inputs obtained upfront, the run fails
+        print("Not all inputs could be obtained", file=sys.stderr)
+        exit_code = 1
+    if usage_file:
+        with open(usage_file, 'w', encoding='utf-8') as f:
+            json.dump(usage, f)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
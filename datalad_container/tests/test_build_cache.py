@@ -0,0 +1,117 @@
+import json
+import os
+import os.path as op
+import sys
+import time
+from unittest.mock import patch
+
+from datalad.api import Dataset
+from datalad.tests.utils_pytest import (
+    assert_false,
+    eq_,
+    ok_,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from datalad_container.build_cache import (
+    _use,
+    evict,
+    get_build_cache,
+    run_build,
+)
+
+# stands in for a build, placing blobs into the cache like Apptainer does
+_FAKE_BUILD = """
+import json, os, sys
+blobdir = os.path.join(os.environ['APPTAINER_CACHEDIR'],
+                       'cache', 'blob', 'blobs', 'sha256')
+os.makedirs(blobdir, exist_ok=True)
+layers = sys.argv[1:]
+for layer in layers:
+    with open(os.path.join(blobdir, layer), 'w') as f:
+        f.write(layer * 100)
+manifest = {'layers': [{'digest': 'sha256:' + l} for l in layers]}
+with open(os.path.join(blobdir, 'manifest' + ''.join(layers)), 'w') as f:
+    json.dump(manifest, f)
+"""
+
+
+@with_tempfile(mkdir=True)
+def test_run_build(path=None):
+    cache = Path(path) / 'cache'
+    script = op.join(path, 'build.py')
+    with open(script, 'w') as f:
+        f.write(_FAKE_BUILD)
+    build = [sys.executable, script]
+
+    report = run_build(build + ['a', 'b'], None, cache)
+    eq_(report['misses'], 3)
+    eq_(report['hits'], 0)
+    ok_(report['miss_bytes'] > 200)
+    # a related image shares a layer
+    report = run_build(build + ['a', 'c'], None, cache)
+    eq_(report['misses'], 2)
+    eq_(report['hits'], 1)
+    # an image built from the cache entirely
+    report = run_build([sys.executable, '-c', ''], None, cache)
+    eq_(report, dict(misses=0, miss_bytes=0, hits=None))
+
+
+@with_tempfile(mkdir=True)
+def test_evict(path=None):
+    cache = Path(path)
+    now = time.time()
+    for i, name in enumerate(('old', 'middle', 'new')):
+        p = cache / 'cache' / 'library' / name / 'image.sif'
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text('x' * 100)
+        os.utime(p, (now - 100 + i, now - 100 + i))
+    removed = evict(cache, 250)
+    eq_(removed, [cache / 'cache' / 'library' / 'old' / 'image.sif'])
+    # the entry is removed as a whole
+    assert_false((cache / 'cache' / 'library' / 'old').exists())
+    ok_((cache / 'cache' / 'library' / 'new').exists())
+    # nothing is removed while a build uses the cache
+    with _use(cache):
+        eq_(evict(cache, 0), [])
+    eq_(len(evict(cache, 0)), 2)
+    ok_((cache / 'cache' / 'library').is_dir())
+
+
+@with_tempfile(mkdir=True)
+def test_evict_blobs(path=None):
+    cache = Path(path) / 'cache'
+    script = op.join(path, 'build.py')
+    with open(script, 'w') as f:
+        f.write(_FAKE_BUILD)
+    blobdir = cache / 'cache' / 'blob' / 'blobs' / 'sha256'
+    run_build([sys.executable, script, 'a', 'b'], None, cache)
+    old = time.time() - 100
+    for p in blobdir.iterdir():
+        os.utime(p, (old, old))
+    run_build([sys.executable, script, 'a', 'c'], None, cache)
+    index = cache / 'cache' / 'blob' / 'index.json'
+    index.write_text(json.dumps({'manifests': [
+        {'digest': 'sha256:manifestab'}, {'digest': 'sha256:manifestac'}]}))
+
+    # the older image goes, except for the layer the other one uses
+    removed = evict(cache, 400)
+    eq_(sorted(p.name for p in removed), ['b', 'manifestab'])
+    eq_(sorted(p.name for p in blobdir.iterdir()), ['a', 'c', 'manifestac'])
+    eq_(json.loads(index.read_text()),
+        {'manifests': [{'digest': 'sha256:manifestac'}]})
+
+
+@with_tempfile
+def test_get_build_cache(path=None):
+    ds = Dataset(path).create(result_renderer='disabled')
+    eq_(get_build_cache(ds), None)
+    with patch.dict(os.environ,
+                    {'DATALAD_CONTAINERS_BUILD__CACHE': 'dataset'}):
+        ds.config.reload(force=True)
+        cache, size = get_build_cache(ds)
+        eq_(cache, ds.repo.dot_git / 'datalad' / 'containers' / 'build-cache')
+        eq_(size, 10240 * 1024 * 1024)
+    ds.config.reload(force=True)
+    assert_false(get_build_cache(ds))
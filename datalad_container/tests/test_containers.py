@@ -1,4 +1,7 @@
+import json
+import os
 import os.path as op
+import subprocess
 
 from datalad.api import (
     Dataset,
@@ -7,10 +10,13 @@ from datalad.api import (
     containers_remove,
     install,
 )
+from datalad.core.local.run import run_command
+from datalad.support.exceptions import InsufficientArgumentsError
 from datalad.support.network import get_local_file_url
 from datalad.tests.utils_pytest import (
     SkipTest,
     assert_equal,
+    assert_false,
     assert_in,
     assert_in_results,
     assert_not_in,
@@ -27,6 +33,11 @@ from datalad.tests.utils_pytest import (
 )
 from datalad.utils import swallow_outputs
 
+from datalad_container.containers_add import _find_registered_duplicate
+from datalad_container.run_history import (
+    get_annex_keys,
+    get_parent_treeish,
+)
 from datalad_container.tests.utils import add_pyscript_image
 
 common_kwargs = {'result_renderer': 'disabled'}
@@ -36,7 +47,7 @@ common_kwargs = {'result_renderer': 'disabled'}
 def test_add_noop(path=None):
     ds = Dataset(path).create(**common_kwargs)
     ok_clean_git(ds.path)
-    assert_raises(TypeError, ds.containers_add)
+    assert_raises(InsufficientArgumentsError, ds.containers_add)
     # fails when there is no image
     assert_status(
         'error',
@@ -237,6 +248,49 @@ def test_container_update(ds_path=None, local_file=None, url=None):
                             **common_kwargs)
     assert_in("Configure ", get_commit_msg())
 
+    # the status of a plain local file is not recorded as a fingerprint
+    assert_false(ds.config.get("datalad.containers.foo.fingerprint"))
+
+    # An unchanged image is not obtained again
+    with open(op.join(ds.path, 'annexed.img'), 'w') as f:
+        f.write("annexed")
+    ds.save('annexed.img', **common_kwargs)
+    annexed = op.join(ds.path, 'annexed.img')
+    ds.containers_add(name="foo", update=True, url=annexed, **common_kwargs)
+    assert_equal(ds.config.get("datalad.containers.foo.fingerprint"),
+                 "{} key:{}".format(
+                     annexed,
+                     ds.repo.get_file_annexinfo('annexed.img')['key']))
+    commit = ds.repo.get_hexsha()
+    res = ds.containers_add(name="foo", update=True, url=annexed,
+                            **common_kwargs)
+    assert_result_count(res, 1, action="containers_add",
+                        status="notneeded")
+    assert_not_in("remove", [r["action"] for r in res])
+    assert_equal(ds.repo.get_hexsha(), commit)
+
+    # neither is an unchanged download via HTTP
+    http_bar = url + "bar.img"
+    ds.containers_add(name="foo", update=True, url=http_bar,
+                      **common_kwargs)
+    assert_status("notneeded", ds.containers_add(
+        name="foo", update=True, url=http_bar, **common_kwargs))
+    with open(op.join(local_file, 'bar.img'), 'w') as f:
+        f.write("bar, changed")
+    res = ds.containers_add(name="foo", update=True, url=http_bar,
+                            **common_kwargs)
+    assert_in_results(res, action="containers_add", status="ok")
+    ok_file_has_content(op.join(ds.path, img), "bar, changed")
+
+    # the fingerprint of the previous image is not kept for a source
+    # without one
+    ds.containers_add(name="foo", update=True, url=url_foo, **common_kwargs)
+    ok_file_has_content(op.join(ds.path, img), "foo")
+    assert_false(ds.config.get("datalad.containers.foo.fingerprint"))
+    res = ds.containers_add(name="foo", update=True, url=url_foo,
+                            **common_kwargs)
+    assert_in_results(res, action="containers_add", status="ok")
+
 
 @with_tempfile
 @with_tempfile
@@ -345,3 +399,402 @@ def test_list_contains(path=None):
     assert_result_count(res, 2)
     assert_in_results(res, name="in-top")
     assert_in_results(res, name="b/in-b")
+
+
+@with_tree(tree={'a.img': "image a", 'b.img': "image b",
+                 'overlay.img': "overlay"})
+def test_warm(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add('a', image='a.img', call_fmt="sh -c '{cmd}'",
+                      extra_input=['overlay.img'], **common_kwargs)
+    ds.containers_add('b', image='b.img', call_fmt="sh -c '{cmd}'",
+                      **common_kwargs)
+
+    res = ds.containers_warm(**common_kwargs)
+    assert_result_count(res, 3, action='containers_warm', status='ok')
+    assert_in_results(res, path=op.join(ds.path, 'overlay.img'),
+                      bytesize=len("overlay"))
+
+    res = ds.containers_warm('b', method='read', jobs=1, **common_kwargs)
+    assert_result_count(res, 1)
+    assert_in_results(res, path=op.join(ds.path, 'b.img'), method='read',
+                      status='ok')
+
+    ds.drop('a.img', reckless='kill', **common_kwargs)
+    res = ds.containers_warm('a', on_failure='ignore', **common_kwargs)
+    assert_in_results(res, path=op.join(ds.path, 'a.img'),
+                      status='impossible')
+    assert_in_results(res, path=op.join(ds.path, 'overlay.img'),
+                      status='ok')
+    assert_status('impossible', ds.containers_warm(
+        'unknown', on_failure='ignore', **common_kwargs))
+
+
+@with_tempfile
+@with_tree(tree={'a.img': "image a", 'b.img': "image b",
+                 'overlay.img': "overlay"})
+def test_prefetch(path=None, origin_path=None):
+    origin = Dataset(origin_path).create(force=True, **common_kwargs)
+    origin.save(**common_kwargs)
+    origin.containers_add('a', image='a.img', call_fmt="sh -c '{cmd}'",
+                          **common_kwargs)
+    origin.containers_add('b', image='b.img', call_fmt="sh -c '{cmd}'",
+                          extra_input=['overlay.img'], **common_kwargs)
+    origin.containers_run('echo 1 > out1', container_name='a',
+                          **common_kwargs)
+    origin.containers_run('echo 2 > out2', container_name='b',
+                          **common_kwargs)
+    origin.containers_run('echo 3 > out3', container_name='b',
+                          **common_kwargs)
+    old_a = origin.repo.get_file_annexinfo('a.img')['key']
+    origin.unlock('a.img', **common_kwargs)
+    with open(op.join(origin_path, 'a.img'), 'w') as f:
+        f.write("image a, updated")
+    origin.save(**common_kwargs)
+    origin.containers_run('echo 4 > out4', container_name='a',
+                          **common_kwargs)
+    new_a = origin.repo.get_file_annexinfo('a.img')['key']
+
+    ds = install(path, source=origin_path, **common_kwargs)
+    res = ds.containers_prefetch(**common_kwargs)
+    assert_result_count(res, 1, action='containers_prefetch', status='ok',
+                        key=new_a)
+    ok_(ds.repo.file_has_content('a.img'))
+    assert_false(ds.repo.file_has_content('b.img'))
+
+    # all images of the history, each key only once
+    res = ds.containers_prefetch(since='', **common_kwargs)
+    assert_result_count(res, 4)
+    assert_result_count(res, 1, status='notneeded', key=new_a)
+    assert_result_count(res, 1, status='ok', key=old_a)
+    for f in ('b.img', 'overlay.img'):
+        ok_(ds.repo.file_has_content(f))
+    ok_(ds.repo.call_annex_success(['contentlocation', old_a]))
+
+    assert_status('notneeded',
+                  ds.containers_prefetch('HEAD~1', **common_kwargs))
+
+
+@with_tree(tree={'dir.img': {'layer1': "layer 1", 'layer2': "layer 2"},
+                 'file.img': "image"})
+def test_get_annex_keys(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    # the files of a directory, e.g. an image pulled from a registry
+    keys = get_annex_keys(ds, 'HEAD', ['dir.img', 'file.img', 'none'])
+    assert_equal(sorted(keys),
+                 ['dir.img/layer1', 'dir.img/layer2', 'file.img'])
+    assert_equal(keys['file.img'],
+                 (ds.path, ds.repo.get_file_annexinfo('file.img')['key']))
+    # nothing precedes a root commit
+    root = ds.repo.call_git_oneline(['rev-list', '--max-parents=0', 'HEAD'])
+    assert_equal(
+        get_annex_keys(ds, get_parent_treeish(ds, root), ['.datalad']), {})
+    assert_equal(get_parent_treeish(ds, 'HEAD'), 'HEAD^')
+    assert_equal(get_annex_keys(ds, 'HEAD^', ['file.img']), {})
+
+
+@with_tree(tree={'a.img': "image a", 'b.img': "image b", 'in': "input"})
+def test_list_usage(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add('a', image='a.img', call_fmt="sh -c '{cmd}'",
+                      **common_kwargs)
+    ds.containers_add('b', image='b.img', call_fmt="sh -c '{cmd}'",
+                      **common_kwargs)
+    # a record without container information, as written by earlier versions
+    list(run_command("sh -c 'echo 0 > out0'", dataset=ds,
+                     extra_inputs=['a.img']))
+    ds.containers_run('cat in > out1', container_name='a', inputs=['in'],
+                      outputs=['out1'], **common_kwargs)
+    ds.containers_run('echo 2 > out2', container_name='b', **common_kwargs)
+    key_a = ds.repo.get_file_annexinfo('a.img')['key']
+
+    res = ds.containers_list(usage=True, **common_kwargs)
+    usage = {r['name']: r['usage'] for r in res}
+    assert_equal(usage['a']['runs'], 2)
+    assert_equal(usage['b']['runs'], 1)
+    run = usage['a']['commits'][0]
+    assert_equal(run['image'], 'a.img')
+    assert_equal(run['image_key'], key_a)
+    assert_equal(run['inputs'], ['in'])
+    assert_equal(run['outputs'], ['out1'])
+    ok_(run['wall_time'] is not None)
+    # the earlier record has no resource usage
+    assert_equal(usage['a']['commits'][1]['wall_time'], None)
+    assert_equal(usage['a']['wall_time'], run['wall_time'])
+
+    # only new commits are indexed
+    ds.containers_run('echo 3 > out3', container_name='b', **common_kwargs)
+    usage = {r['name']: r['usage']
+             for r in ds.containers_list(usage=True, **common_kwargs)}
+    assert_equal(usage['a']['runs'], 2)
+    assert_equal(usage['b']['runs'], 2)
+    assert_equal(usage['b']['commits'][0]['hexsha'], ds.repo.get_hexsha())
+
+    # a rewritten history is reindexed
+    ds.repo.call_git(['reset', '--hard', 'HEAD~2'])
+    usage = {r['name']: r['usage']
+             for r in ds.containers_list(usage=True, **common_kwargs)}
+    assert_equal(usage['a']['runs'], 2)
+    assert_equal(usage['b']['runs'], 0)
+
+    # without the flag, there is no usage
+    assert_not_in('usage', ds.containers_list(**common_kwargs)[0])
+
+
+@with_tempfile
+@with_tree(tree={'a.img': "image a", 'b.img': "image b",
+                 'c.img': "image c", 'overlay.img': "overlay"})
+def test_add_from_manifest(ds_path=None, local_file=None):
+    ds = Dataset(ds_path).create(**common_kwargs)
+    manifest = op.join(local_file, 'containers.json')
+
+    # nothing is done, unless all entries are valid
+    with open(manifest, 'w') as f:
+        json.dump([
+            {'name': 'a', 'url': op.join(local_file, 'a.img')},
+            {'name': 'a', 'url': op.join(local_file, 'b.img')},
+            {'name': 'b', 'uri': op.join(local_file, 'b.img')},
+            {'name': 'c', 'url': 'some', 'extra_input': '{bogus}'},
+        ], f)
+    res = ds.containers_add(from_file=manifest, on_failure='ignore',
+                            **common_kwargs)
+    assert_result_count(res, 2, status='impossible')
+    assert_result_count(res, 1, status='error')
+    assert_result_count(ds.containers_list(**common_kwargs), 0)
+    ok_clean_git(ds.path)
+
+    with open(manifest, 'w') as f:
+        json.dump([
+            # a copy of a local file
+            {'name': 'a', 'url': op.join(local_file, 'a.img'),
+             'call_fmt': "sh -c '{cmd}'"},
+            # a download by git-annex
+            {'name': 'b',
+             'url': get_local_file_url(op.join(local_file, 'b.img')),
+             'image': 'images/b.img',
+             'extra_input': 'overlay.img'},
+        ], f)
+    commit = ds.repo.get_hexsha()
+    res = ds.containers_add(from_file=manifest, jobs=2, **common_kwargs)
+    assert_result_count(res, 2, action='containers_add', status='ok')
+    assert_result_count(res, 1, action='save')
+    # a single commit
+    assert_equal(ds.repo.get_hexsha('HEAD~1'), commit)
+    assert_in("Configure 'b'", ds.repo.format_commit('%B'))
+    ok_clean_git(ds.path)
+    ok_file_has_content(op.join(ds.path, 'images', 'b.img'), "image b")
+    assert_equal(ds.config.get('datalad.containers.a.cmdexec'),
+                 "sh -c '{cmd}'")
+    assert_equal(ds.config.get('datalad.containers.b.extra-input'),
+                 'overlay.img')
+    assert_equal(ds.config.get('datalad.containers.b.image'),
+                 'images/b.img')
+
+    # existing containers are only changed with `update`
+    res = ds.containers_add(from_file=manifest, on_failure='ignore',
+                            **common_kwargs)
+    assert_result_count(res, 2, status='impossible')
+    with open(manifest, 'w') as f:
+        json.dump({'a': {'call_fmt': "bash -c '{cmd}'"}}, f)
+    ds.containers_add(from_file=manifest, update=True, **common_kwargs)
+    assert_equal(ds.config.get('datalad.containers.a.cmdexec'),
+                 "bash -c '{cmd}'")
+    ok_clean_git(ds.path)
+
+    # images are replaced in a single commit
+    with open(manifest, 'w') as f:
+        json.dump({'a': {'url': op.join(local_file, 'c.img')},
+                   'b': {'url': op.join(local_file, 'c.img')}}, f)
+    commit = ds.repo.get_hexsha()
+    res = ds.containers_add(from_file=manifest, update=True,
+                            **common_kwargs)
+    assert_result_count(res, 2, action='remove', status='ok')
+    assert_result_count(res, 2, action='containers_add', status='ok')
+    assert_equal(ds.repo.get_hexsha('HEAD~1'), commit)
+    assert_in("Update 'a'", ds.repo.format_commit('%B'))
+    ok_file_has_content(op.join(ds.path, 'images', 'b.img'), "image c")
+    ok_clean_git(ds.path)
+
+
+@with_tempfile
+@with_tempfile
+@with_tree(tree={'plain.img': "plain image"})
+def test_add_local_image(ds_path=None, src_path=None, local_file=None):
+    src = Dataset(src_path).create(**common_kwargs)
+    with open(op.join(src_path, 'annexed.img'), 'w') as f:
+        f.write("annexed image")
+    src.save(**common_kwargs)
+    key = src.repo.get_file_annexinfo('annexed.img')['key']
+
+    ds = Dataset(ds_path).create(**common_kwargs)
+    # an annexed image keeps its key, without being hashed again
+    ds.containers_add('annexed', url=op.join(src_path, 'annexed.img'),
+                      **common_kwargs)
+    assert_equal(ds.repo.get_file_annexinfo(
+        op.join('.datalad', 'environments', 'annexed', 'image'))['key'],
+        key)
+    ok_file_has_content(
+        op.join(ds_path, '.datalad', 'environments', 'annexed', 'image'),
+        "annexed image")
+    ok_clean_git(ds.path)
+    # the same content under another name
+    ds.containers_add('again', url=op.join(src_path, 'annexed.img'),
+                      image='again.img', **common_kwargs)
+    assert_equal(ds.repo.get_file_annexinfo('again.img')['key'], key)
+
+    # a plain file is not modified by annexing the image
+    plain = op.join(local_file, 'plain.img')
+    mode = os.stat(plain).st_mode
+    ds.containers_add('plain', url=plain, image='plain.img',
+                      **common_kwargs)
+    ok_file_has_content(op.join(ds_path, 'plain.img'), "plain image")
+    assert_equal(os.stat(plain).st_mode, mode)
+    assert_equal(os.stat(plain).st_nlink, 1)
+    ok_clean_git(ds.path)
+
+
+@with_tempfile
+@with_tree(tree={'a.img': "image a", 'b.img': "image b"})
+@serve_path_via_http
+def test_add_duplicate_image(ds_path=None, local_file=None, url=None):
+    ds = Dataset(ds_path).create(**common_kwargs)
+    url_a = url + "a.img"
+    ds.containers_add('a', url=url_a, image='a.img', **common_kwargs)
+    # a plain add records the fingerprint of the image
+    ok_(ds.config.get('datalad.containers.a.fingerprint'))
+    key = ds.repo.get_file_annexinfo('a.img')['key']
+    # hence, the first update of an unchanged image downloads nothing
+    ds.drop('a.img', reckless='kill', **common_kwargs)
+    commit = ds.repo.get_hexsha()
+    assert_result_count(
+        ds.containers_add('a', url=url_a, update=True, **common_kwargs),
+        1, action='containers_add', status='notneeded')
+    assert_false(ds.repo.file_has_content('a.img'))
+    assert_equal(ds.repo.get_hexsha(), commit)
+    ds.drop('a.img', reckless='kill', **common_kwargs)
+
+    # the existing key is reused, nothing is downloaded
+    ds.containers_add('latest', url=url_a, image='latest.img',
+                      **common_kwargs)
+    assert_equal(ds.repo.get_file_annexinfo('latest.img')['key'], key)
+    assert_false(ds.repo.file_has_content('latest.img'))
+    ok_clean_git(ds.path)
+
+    # identical images in a manifest are obtained once
+    manifest = op.join(local_file, 'containers.json')
+    with open(manifest, 'w') as f:
+        json.dump({'b': {'url': url + "b.img", 'image': 'b.img'},
+                   'c': {'url': url + "b.img", 'image': 'c.img'}}, f)
+    ds.containers_add(from_file=manifest, **common_kwargs)
+    key = ds.repo.get_file_annexinfo('b.img')['key']
+    assert_equal(ds.repo.get_file_annexinfo('c.img')['key'], key)
+    ok_file_has_content(op.join(ds_path, 'c.img'), "image b")
+    ok_clean_git(ds.path)
+
+
+@with_tempfile
+def test_find_registered_duplicate(ds_path=None):
+    ds = Dataset(ds_path).create(**common_kwargs)
+    (ds.pathobj / 'hub').mkdir()
+    (ds.pathobj / 'hub' / 'layer.tar').write_text("layer")
+    (ds.pathobj / 'file.img').write_text("image")
+    ds.save(**common_kwargs)
+    key = ds.repo.get_file_annexinfo('file.img')['key']
+    for name, image, fingerprint in (
+            ('hub', 'hub', 'dhub://busybox@sha256:abc digest:sha256:abc'),
+            ('file', 'file.img', 'http://a.example/file.img etag:"v1"')):
+        ds.config.set('datalad.containers.{}.image'.format(name), image,
+                      scope='branch', reload=False)
+        ds.config.set('datalad.containers.{}.fingerprint'.format(name),
+                      fingerprint, scope='branch', reload=False)
+    ds.config.reload()
+
+    def find(url, fingerprint):
+        return _find_registered_duplicate(
+            ds, dict(name='new', imgurl=url,
+                     fingerprint='{} {}'.format(url, fingerprint)))
+
+    # an image directory is not reused for a file
+    assert_equal(find('docker://busybox@sha256:abc', 'digest:sha256:abc'),
+                 None)
+    # an ETag only identifies an image at the same URL
+    assert_equal(find('http://a.example/other.img', 'etag:"v1"'), None)
+    assert_equal(find('http://a.example/file.img', 'etag:"v2"'), None)
+    assert_equal(find('http://a.example/file.img', 'etag:"v1"'), key)
+
+
+@with_tempfile
+@with_tree(tree={'a.img': "image a", 'b.img': "image b", 'c.img': "image c"})
+def test_add_remove_concurrently(ds_path=None, local_file=None):
+    ds = Dataset(ds_path).create(**common_kwargs)
+    names = ['a', 'b', 'c']
+
+    def run_concurrently(*args):
+        procs = [subprocess.Popen(
+            ['datalad', args[0], '-d', ds_path, name]
+            + [a.format(name=name) for a in args[1:]])
+            for name in names]
+        assert_equal([p.wait() for p in procs], [0] * len(names))
+
+    run_concurrently('containers-add',
+                     '--url', op.join(local_file, '{name}.img'))
+    ds.config.reload(force=True)
+    for name in names:
+        assert_equal(
+            ds.config.get('datalad.containers.{}.image'.format(name)),
+            '.datalad/environments/{}/image'.format(name))
+        ok_file_has_content(
+            op.join(ds_path, '.datalad', 'environments', name, 'image'),
+            "image " + name)
+    ok_clean_git(ds.path)
+
+    run_concurrently('containers-remove', '--remove-image')
+    ds.config.reload(force=True)
+    assert_result_count(ds.containers_list(**common_kwargs), 0)
+    ok_clean_git(ds.path)
+
+
+@with_tempfile
+@with_tree(tree={'a.img': "image a", 'b.img': "image b", 'c.img': "image c"})
+@serve_path_via_http
+def test_remove_multiple(ds_path=None, local_file=None, url=None):
+    ds = Dataset(ds_path).create(**common_kwargs)
+    for name in ('tool-a', 'tool-b'):
+        ds.containers_add(name, url=url + name[-1] + '.img', **common_kwargs)
+    # an identical image, annexed under the same key as the one of tool-a
+    ds.containers_add('keep', url=url + 'a.img', **common_kwargs)
+    ds.containers_add('other', url=op.join(local_file, 'c.img'),
+                      **common_kwargs)
+    commits = len(list(ds.repo.get_revisions()))
+
+    res = ds.containers_remove(['tool-*', 'none'], drop=True, jobs=2,
+                               **common_kwargs)
+    # the images are available from the web, hence dropped, unless still
+    # used by another container
+    assert_result_count(res, 1, action='drop', status='ok')
+    assert_result_count(res, 1, action='drop', status='notneeded')
+    assert_result_count(res, 2, action='containers_remove', status='ok')
+    assert_in_results(res, action='containers_remove', name='none',
+                      status='notneeded')
+    assert_equal(
+        [r['name'] for r in ds.containers_list(**RAW_KWDS)],
+        ['keep', 'other'])
+    # a single commit, keeping the images for other versions
+    assert_equal(len(list(ds.repo.get_revisions())), commits + 1)
+    assert_false(ds.repo.file_has_content(
+        op.join('.datalad', 'environments', 'tool-b', 'image')))
+    ok_(ds.repo.file_has_content(
+        op.join('.datalad', 'environments', 'keep', 'image')))
+    ok_clean_git(ds.path)
+
+    # the only copy of an image is not dropped, the container is removed
+    res = ds.containers_remove('other', drop=True, remove_image=True,
+                               on_failure='ignore', **common_kwargs)
+    assert_in_results(res, action='drop', status='error')
+    assert_in_results(res, action='containers_remove', status='ok')
+    assert_equal(
+        [r['name'] for r in ds.containers_list(**RAW_KWDS)], ['keep'])
+    ok_clean_git(ds.path)
@@ -0,0 +1,191 @@
+import base64
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from unittest.mock import patch
+
+from datalad.api import Dataset
+from datalad.support.annexrepo import AnnexRepo
+from datalad.support.exceptions import (
+    CommandError,
+    DownloadError,
+)
+from datalad.tests.utils_pytest import (
+    assert_false,
+    assert_in_results,
+    assert_raises,
+    eq_,
+    ok_,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from datalad_container import image_download
+from datalad_container.image_download import (
+    download,
+    download_to_annex,
+    probe,
+)
+
+_CONTENT = os.urandom(10000)
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    content = _CONTENT
+    digest = None
+    etag = '"v1"'
+    # byte offsets of ranges to fail once
+    fail = set()
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send_headers(self, status, length, extra=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.etag)
+        if self.digest:
+            self.send_header('Digest', self.digest)
+        for header in extra:
+            self.send_header(*header)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_headers(200, len(self.content))
+
+    def do_GET(self):
+        spec = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if not spec or (if_range and if_range != self.etag):
+            self._send_headers(200, len(self.content))
+            self.wfile.write(self.content)
+            return
+        start, end = map(int, spec[len('bytes='):].split('-'))
+        self.requests.append(start)
+        if start in self.fail:
+            self.fail.discard(start)
+            self.send_error(503)
+            return
+        self._send_headers(
+            206, end - start + 1,
+            [('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(self.content)))])
+        self.wfile.write(self.content[start:end + 1])
+
+
+@contextmanager
+def _serve():
+    _RangeHandler.fail = set()
+    _RangeHandler.requests = []
+    _RangeHandler.digest = None
+    _RangeHandler.etag = '"v1"'
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/image.sif'.format(
+            httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@with_tempfile(mkdir=True)
+def test_download_resume(path=None):
+    with _serve() as server:
+        info = probe(server)
+        ok_(info['ranges'])
+        eq_(info['size'], len(_CONTENT))
+        dest = Path(path) / 'image'
+        _RangeHandler.fail = {3000, 7000}
+        with assert_raises(DownloadError):
+            download(server, dest, info, jobs=3, chunk_size=1000)
+        ok_(dest.with_name('image.state').exists())
+        # only the missing chunks are requested again
+        _RangeHandler.requests = []
+        digests = download(server, dest, info, jobs=3, chunk_size=1000,
+                           algorithms=['sha256', 'md5'])
+        eq_(sorted(_RangeHandler.requests), [3000, 7000])
+        eq_(dest.read_bytes(), _CONTENT)
+        eq_(digests, dict(sha256=hashlib.sha256(_CONTENT).hexdigest(),
+                          md5=hashlib.md5(_CONTENT).hexdigest()))
+        assert_false(dest.with_name('image.state').exists())
+
+
+@with_tempfile(mkdir=True)
+def test_download_changed(path=None):
+    with _serve() as server:
+        info = probe(server)
+        dest = Path(path) / 'image'
+        # the content changes after the download started
+        _RangeHandler.etag = '"v2"'
+        with assert_raises(DownloadError):
+            download(server, dest, info, chunk_size=1000)
+
+
+@with_tempfile(mkdir=True)
+def test_download_checksum(path=None):
+    with _serve() as server:
+        _RangeHandler.digest = 'sha-256=' + base64.b64encode(
+            hashlib.sha256(b'other').digest()).decode()
+        info = probe(server)
+        eq_(info['digest'][0], 'sha256')
+        dest = Path(path) / 'image'
+        with assert_raises(DownloadError):
+            download(server, dest, info, chunk_size=1000)
+        assert_false(dest.exists())
+
+        _RangeHandler.digest = 'sha-256=' + base64.b64encode(
+            hashlib.sha256(_CONTENT).digest()).decode()
+        download(server, dest, probe(server), chunk_size=1000)
+        eq_(dest.read_bytes(), _CONTENT)
+
+        # without an announced checksum, the hash computed while the chunks
+        # arrive has to match the completed file
+        _RangeHandler.digest = None
+        dest.unlink()
+        with patch.object(image_download._OrderedHasher, 'hexdigests',
+                          return_value=dict(sha256='0' * 64)), \
+                assert_raises(DownloadError):
+            download(server, dest, probe(server), chunk_size=1000)
+        assert_false(dest.exists())
+
+
+@with_tempfile
+def test_download_to_annex(path=None):
+    with _serve() as server:
+        ds = Dataset(path).create(result_renderer='disabled')
+        image = str(ds.pathobj / 'images' / 'image.sif')
+        # too small to be downloaded in chunks by default
+        eq_(download_to_annex(ds, server, image), None)
+        with patch.object(image_download, 'MIN_SIZE', 0), \
+                patch.object(image_download, 'CHUNK_SIZE', 1000):
+            key = download_to_annex(ds, server, image, jobs=2)
+        # the key of the backend configured by DataLad, as made by git-annex
+        eq_(key, 'MD5E-s{}--{}.sif'.format(
+            len(_CONTENT), hashlib.md5(_CONTENT).hexdigest()))
+        eq_(Path(image).read_bytes(), _CONTENT)
+        eq_(ds.repo.get_file_annexinfo(image)['key'], key)
+        ok_(any(server in info.get('urls', [])
+                for info in ds.repo.whereis(image, output='full').values()))
+
+
+@with_tempfile
+def test_download_to_annex_error(path=None):
+    with _serve() as server:
+        ds = Dataset(path).create(result_renderer='disabled')
+        with patch.object(image_download, 'MIN_SIZE', 0), \
+                patch.object(image_download, 'CHUNK_SIZE', 1000), \
+                patch.object(AnnexRepo, 'call_annex',
+                             side_effect=CommandError('git annex fromkey')):
+            res = ds.containers_add('img', url=server, on_failure='ignore',
+                                    result_renderer='disabled')
+        assert_in_results(res, action='containers_add', status='error')
+        assert_false(ds.config.get('datalad.containers.img.image'))
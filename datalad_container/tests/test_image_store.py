@@ -0,0 +1,135 @@
+import os
+import os.path as op
+import sys
+from unittest.mock import patch
+
+from datalad.api import (
+    Dataset,
+    clone,
+)
+from datalad.tests.utils_pytest import (
+    assert_raises,
+    assert_result_count,
+    eq_,
+    ok_,
+    serve_path_via_http,
+    with_tempfile,
+    with_tree,
+)
+from datalad.utils import Path
+
+from datalad_container.image_store import (
+    get_object_path,
+    lookup_url,
+    place_annex_object,
+)
+
+common_kwargs = {'result_renderer': 'disabled'}
+
+
+@with_tempfile
+@with_tempfile
+@with_tempfile
+@with_tempfile(mkdir=True)
+@with_tree(tree={'some_container.img': "some image"})
+@serve_path_via_http
+def test_image_store(ds1_path=None, ds2_path=None, clone_path=None,
+                     store=None, local_file=None, url=None):
+    store = Path(store)
+    img_url = url + 'some_container.img'
+    with patch.dict(os.environ, {'DATALAD_CONTAINERS_STORE': str(store)}):
+        ds1 = Dataset(ds1_path).create(**common_kwargs)
+        ds1.containers_add('mycontainer', url=img_url,
+                           call_fmt=sys.executable + ' -c "" {img} {cmd}',
+                           **common_kwargs)
+        img1 = op.join('.datalad', 'environments', 'mycontainer', 'image')
+        key = ds1.repo.get_file_annexinfo(img1)['key']
+        objpath = get_object_path(store, key)
+        ok_(objpath.exists())
+
+        # another dataset gets the same image from the store
+        ds2 = Dataset(ds2_path).create(**common_kwargs)
+        ds2.containers_add('other', url=img_url, **common_kwargs)
+        img2 = ds2.pathobj / '.datalad' / 'environments' / 'other' / 'image'
+        eq_(ds2.repo.get_file_annexinfo(img2)['key'], key)
+        eq_(img2.stat().st_ino, objpath.stat().st_ino)
+        # the URL is still known to annex
+        ok_(any(img_url in r.get('urls', [])
+                for r in ds2.repo.whereis(
+                    str(img2), output='full', key=False).values()))
+        # the source was probed to validate the stored image
+        fingerprint = ds2.config.get('datalad.containers.other.fingerprint')
+        ok_(fingerprint)
+        eq_(lookup_url(store, img_url, lambda: fingerprint), key)
+        eq_(lookup_url(store, img_url, lambda: fingerprint + 'x'), None)
+
+        # a changed image at the URL is not taken from the store
+        src = Path(local_file) / 'some_container.img'
+        src.write_text("changed image")
+        os.utime(src, (src.stat().st_atime, src.stat().st_mtime + 100))
+        ds2.containers_add('changed', url=img_url, image='changed.img',
+                           **common_kwargs)
+        ok_(ds2.repo.get_file_annexinfo('changed.img')['key'] != key)
+        eq_((ds2.pathobj / 'changed.img').read_text(), "changed image")
+
+        # content that does not match the size of a key is not placed
+        bad = store / 'bad'
+        bad.write_text("bad")
+        with assert_raises(ValueError):
+            place_annex_object(ds2.repo, key, bad)
+
+        # a fresh clone runs the container without downloading the image
+        cloned = clone(source=ds1.path, path=clone_path, **common_kwargs)
+        ok_(not cloned.repo.file_has_content(img1))
+        res = cloned.containers_run(['true'], **common_kwargs)
+        assert_result_count(
+            res, 1, action='get', status='notneeded',
+            path=str(cloned.pathobj / img1))
+        eq_((cloned.pathobj / img1).stat().st_ino, objpath.stat().st_ino)
+
+        assert_result_count(
+            ds2.containers_store(**common_kwargs), 1,
+            key=key, state='used', nlinks=3)
+
+        # drop the image from all datasets, which makes it unused in the
+        # store
+        for ds in (ds1, ds2, cloned):
+            ds.drop('.datalad/environments', reckless='kill', **common_kwargs)
+        ds2.drop('changed.img', reckless='kill', **common_kwargs)
+        assert_result_count(
+            ds2.containers_store(gc=True, **common_kwargs), 1,
+            key=key, state='removed')
+        ok_(not objpath.exists())
+        eq_(lookup_url(store, img_url, lambda: fingerprint), None)
+
+
+@with_tempfile
+@with_tempfile
+@with_tempfile(mkdir=True)
+@with_tree(tree={'some_container.img': "some image"})
+@serve_path_via_http
+def test_image_store_unlock(ds1_path=None, ds2_path=None, store=None,
+                            local_file=None, url=None):
+    store = Path(store)
+    img_url = url + 'some_container.img'
+    img = op.join('.datalad', 'environments', 'mycontainer', 'image')
+    with patch.dict(os.environ, {'DATALAD_CONTAINERS_STORE': str(store)}):
+        ds1 = Dataset(ds1_path).create(**common_kwargs)
+        ds1.containers_add('mycontainer', url=img_url, **common_kwargs)
+        objpath = get_object_path(
+            store, ds1.repo.get_file_annexinfo(img)['key'])
+        eq_((ds1.pathobj / img).stat().st_ino, objpath.stat().st_ino)
+
+        # an unlocked file is a hardlink of its annex object in a thin
+        # dataset, hence the object is not hardlinked to the store
+        ds2 = Dataset(ds2_path).create(**common_kwargs)
+        ds2.config.set('annex.thin', 'true', scope='local')
+        ds2.containers_add('mycontainer', url=img_url, **common_kwargs)
+        ok_((ds2.pathobj / img).stat().st_ino != objpath.stat().st_ino)
+
+        # modifying an unlocked image leaves the store object unchanged
+        for ds in (ds1, ds2):
+            ds.unlock(img, **common_kwargs)
+            with open(ds.pathobj / img, 'a') as f:
+                f.write(" modified")
+        eq_(objpath.read_text(), "some image")
@@ -20,10 +20,13 @@ from datalad.support.network import get_local_file_url
 from datalad.tests.utils_pytest import (
     assert_false,
     assert_in,
+    assert_in_results,
+    assert_not_in,
     assert_not_in_results,
     assert_raises,
     assert_repo_status,
     assert_result_count,
+    eq_,
     ok_,
     ok_clean_git,
     ok_file_has_content,
@@ -37,6 +40,7 @@ from datalad.utils import (
     on_windows,
 )
 
+from datalad_container.run_wrapper import wrap_command
 from datalad_container.tests.utils import add_pyscript_image
 
 testimg_url = 'shub://datalad/datalad-container:testhelper'
@@ -425,3 +429,537 @@ def test_nonPOSIX_imagepath(tmp_path):
         action='run',
         status='ok',
     )
+
+
+@with_tempfile
+@with_tree(tree={'container.img': "image file", 'in': "innards"})
+def test_run_cache(counter=None, path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    cmd = "cat {{inputs}} > {{outputs}} && echo ran >> {}".format(counter)
+
+    def run(outputs=("out",)):
+        return ds.containers_run(cmd, inputs=["in"], outputs=list(outputs),
+                                 run_cache=True, **common_kwargs)
+
+    run()
+    ok_file_has_content(counter, "ran\n")
+    first = ds.repo.get_hexsha()
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    ok_(runinfo["datalad_container"]["run_cache"])
+
+    # identical run, outputs are up-to-date
+    assert_result_count(run(), 1, action="run", status="notneeded")
+    ok_file_has_content(counter, "ran\n")
+    assert ds.repo.get_hexsha() == first
+
+    # outputs are changed later on, the cached ones are restored
+    (ds.pathobj / "out").unlink()
+    ds.save(**common_kwargs)
+    run()
+    ok_file_has_content(counter, "ran\n")
+    ok_file_has_content(op.join(path, "out"), "innards")
+    assert_repo_status(path)
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert runinfo["cmd"].endswith(cmd + "'")
+
+    # changed input content invalidates the cache
+    (ds.pathobj / "in").unlink()
+    (ds.pathobj / "in").write_text("other")
+    ds.save(**common_kwargs)
+    run()
+    ok_file_has_content(counter, "ran\nran\n")
+    ok_file_has_content(op.join(path, "out"), "other")
+
+    # as do other outputs
+    run(outputs=["out2"])
+    ok_file_has_content(counter, "ran\nran\nran\n")
+    ok_file_has_content(op.join(path, "out2"), "other")
+
+
+@with_tree(tree={'container.img': "image file"})
+def test_run_timings(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    phases = {'container_lookup', 'fetch', 'execution', 'save'}
+
+    res = ds.containers_run("echo x > out", **common_kwargs)
+    run_res = [r for r in res if r['action'] == 'run'][0]
+    assert set(run_res['timings']) == phases
+    assert all(t >= 0 for t in run_res['timings'].values())
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert_not_in("timings", runinfo["datalad_container"])
+
+    ds.config.set('datalad.containers.timings', 'record', scope='local')
+    ds.containers_run("echo y > out2", **common_kwargs)
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    # saving happens after the record is created
+    assert set(runinfo["datalad_container"]["timings"]) == \
+        phases - {'save'}
+
+    ds.config.set('datalad.containers.warm', 'read', scope='local')
+    res = ds.containers_run("echo z > out3", **common_kwargs)
+    run_res = [r for r in res if r['action'] == 'run'][0]
+    assert set(run_res['timings']) == phases | {'warm'}
+
+
+@with_tree(tree={'container.img': "image file"})
+def test_run_resource_usage(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    res = ds.containers_run("echo x > out", **common_kwargs)
+    usage = [r for r in res if r['action'] == 'run'][0]['resource_usage']
+    assert usage['wall_time'] > 0
+    if not on_windows:
+        for k in ('cpu_user', 'cpu_system', 'io_read_bytes',
+                  'io_write_bytes'):
+            assert usage[k] >= 0
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert runinfo["datalad_container"]["resource_usage"] == usage
+
+
+@pytest.mark.skipif(on_windows, reason="no os.wait4 on windows")
+@with_tempfile(mkdir=True)
+def test_run_wrapper(path=None):
+    import json
+    import subprocess
+    import sys
+    import threading
+
+    from datalad_container.resource_usage import execute_command
+
+    # another child of this process, busy and reaped during the execution
+    busy = threading.Thread(target=subprocess.run, args=(
+        [sys.executable, '-c',
+         'import time\nt = time.time()\nwhile time.time() - t < 1: pass'],))
+    busy.start()
+    exit_code, usage = execute_command(['sh', '-c', 'sleep 2; exit 3'])
+    busy.join()
+    eq_(exit_code, 3)
+    assert usage['wall_time'] >= 2
+    # only the usage of the command is accounted for
+    assert usage['cpu_user'] < 0.5
+
+    usage_file = op.join(path, 'usage')
+    proc = subprocess.run(
+        [sys.executable, '-m', 'datalad_container.run_wrapper',
+         'sh', '-c', 'echo "$DATALAD_CONTAINERS_USAGE_FILE" > out; exit 2'],
+        cwd=path,
+        env=dict(os.environ, DATALAD_CONTAINERS_USAGE_FILE=usage_file))
+    eq_(proc.returncode, 2)
+    # the command itself does not see the usage file
+    ok_file_has_content(op.join(path, 'out'), '\n')
+    with open(usage_file) as f:
+        assert json.load(f)['wall_time'] > 0
+
+
+@with_tree(tree={'container.img': "image file", 'in': "innards"})
+def test_run_async(path=None):
+    import asyncio
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    before = ds.repo.get_hexsha()
+
+    async def main():
+        return await asyncio.gather(*(
+            ds.containers_run_async(
+                "sleep 1 && cat {{inputs}} > {}".format(out),
+                inputs=["in"], outputs=[out])
+            for out in ("out1", "out2", "out3")))
+
+    results = asyncio.run(main())
+    for res in results:
+        assert_result_count(res, 1, action="save", status="ok")
+    assert_repo_status(path)
+    for out in ("out1", "out2", "out3"):
+        ok_file_has_content(op.join(path, out), "innards")
+    commits = ds.repo.get_revisions(before + "..HEAD")
+    assert len(commits) == 3
+    for commit in commits:
+        _, runinfo = get_run_info(ds, ds.repo.format_commit("%B", commit))
+        assert runinfo["extra_inputs"] == ["container.img"]
+
+    # a failing command is reported, and nothing is saved
+    with pytest.raises(IncompleteResultsError):
+        asyncio.run(ds.containers_run_async("touch nokfile && exit 1",
+                                            outputs=["nokfile"]))
+    assert_repo_status(path, untracked=['nokfile'])
+
+    # the run record is the one of a synchronous run, and a removed output
+    # is recorded too
+    records = []
+    for run_async in (False, True):
+        (ds.pathobj / "gone").write_text("gone")
+        ds.save(**common_kwargs)
+        args = ("rm gone && echo x >> kept",)
+        kwargs = dict(inputs=["in"], outputs=["gone", "kept"])
+        if run_async:
+            res = asyncio.run(ds.containers_run_async(*args, **kwargs))
+        else:
+            res = ds.containers_run(*args, explicit=True, **kwargs,
+                                    **common_kwargs)
+        assert_in_results(res, action="run", status="ok")
+        assert_repo_status(path)
+        eq_(ds.repo.call_git(["diff", "--name-status", "HEAD^", "HEAD"])
+            .split(), ["D", "gone", "A", "kept"] if not run_async
+            else ["D", "gone", "M", "kept"])
+        _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+        usage = runinfo["datalad_container"].pop("resource_usage")
+        ok_(usage["wall_time"] > 0)
+        records.append((runinfo, sorted(usage)))
+    eq_(records[0], records[1])
+
+
+@with_tree(tree={'container.img': "image file"})
+def test_run_worktree(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    base = ds.repo.get_hexsha()
+
+    res = ds.containers_run("echo x > out", outputs=["out"], worktree=True,
+                            **common_kwargs)
+    assert_result_count(res, 1, action="merge", status="ok")
+    # the branch was fast-forwarded to the run commit
+    assert ds.repo.get_hexsha("HEAD~1") == base
+    ok_file_has_content(op.join(path, "out"), "x\n")
+    assert_repo_status(path)
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    eq_(runinfo["cmd"], wrap_command("sh -c 'echo x > out'"))
+    # the worktree is gone
+    assert len(list(ds.repo.call_git_items_(["worktree", "list"]))) == 1
+
+    # the dataset is modified while the command runs, the run commit is
+    # put on top
+    res = ds.containers_run(
+        'git -C "{}" commit -q --allow-empty -m concurrent '
+        '&& echo y > out2'.format(ds.path),
+        worktree=True, **common_kwargs)
+    assert_result_count(res, 1, action="merge", status="ok")
+    ok_file_has_content(op.join(path, "out2"), "y\n")
+    assert_repo_status(path)
+    assert ds.repo.format_commit("%s", "HEAD~1") == "concurrent"
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert runinfo["cmd"].endswith("echo y > out2'")
+
+
+@with_tree(tree={'container.img': "image file", 'in': "innards"})
+def test_run_journal(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    base = ds.repo.get_hexsha()
+
+    res = ds.containers_run("cat {inputs} > {outputs}", inputs=["in"],
+                            outputs=["out1"], journal=True, **common_kwargs)
+    assert_result_count(res, 1, action="run", status="ok")
+    ds.containers_run("echo 2 > out2", outputs=["out2"], journal=True,
+                      **common_kwargs)
+    # nothing is saved yet
+    assert ds.repo.get_hexsha() == base
+    ok_file_has_content(op.join(path, "out1"), "innards")
+
+    res = ds.containers_run(flush=True, **common_kwargs)
+    assert_result_count(res, 2, action="save", status="ok", path=path)
+    assert_repo_status(path)
+    assert ds.repo.get_hexsha("HEAD~2") == base
+    # one commit per run, with its outputs only
+    for rev, out in (("HEAD~1", "out1"), ("HEAD", "out2")):
+        _, runinfo = get_run_info(ds, ds.repo.format_commit("%B", rev))
+        assert runinfo["outputs"] == [out]
+        assert runinfo["exit"] == 0
+        assert ds.repo.call_git(
+            ["diff", "--name-only", rev + "^", rev]).split() == [out]
+    assert_result_count(ds.containers_run(flush=True, **common_kwargs),
+                        1, action="save", status="notneeded")
+
+    # a journaled run is individually rerunnable
+    (ds.pathobj / "in").unlink()
+    (ds.pathobj / "in").write_text("other")
+    ds.save(**common_kwargs)
+    ds.rerun(ds.repo.get_hexsha("HEAD~2"), **common_kwargs)
+    ok_file_has_content(op.join(path, "out1"), "other")
+
+    # overlapping outputs flush the journal first
+    ds.containers_run("echo 3 > out3", outputs=["out3"], journal=True,
+                      **common_kwargs)
+    head = ds.repo.get_hexsha()
+    ds.containers_run("echo 4 > out3", outputs=["out3"], journal=True,
+                      **common_kwargs)
+    assert ds.repo.get_hexsha("HEAD~1") == head
+    ds.containers_run(flush=True, **common_kwargs)
+    ok_file_has_content(op.join(path, "out3"), "4\n")
+
+    # the command is not executed without its inputs
+    res = ds.containers_run("echo 5 > out5", inputs=["missing"],
+                            outputs=["out5"], journal=True,
+                            on_failure='ignore', **common_kwargs)
+    assert_in_results(res, action="get", status="impossible")
+    assert_false(op.lexists(op.join(path, "out5")))
+    assert_repo_status(path)
+    assert ds.repo.get_hexsha("HEAD~2") == head
+
+
+@with_tree(tree={'container.img': "image file"})
+def test_run_journal_subdataset(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    sub = ds.create("sub", **common_kwargs)
+
+    ds.containers_run("echo 1 > sub/out", outputs=["sub/out"], journal=True,
+                      **common_kwargs)
+    res = ds.containers_run(flush=True, **common_kwargs)
+    assert_in_results(res, action="save", status="ok", path=sub.path)
+    assert_in_results(res, action="save", status="ok", path=path)
+    # the output is saved in the subdataset, and the run recorded in the
+    # superdataset
+    assert_repo_status(path)
+    ok_(sub.repo.file_has_content("out"))
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert runinfo["outputs"] == ["sub/out"]
+    assert ds.repo.call_git(
+        ["diff", "--name-only", "HEAD^", "HEAD"]).split() == ["sub"]
+
+
+@with_tree(tree={'container.img': "image file", 'in': "innards"})
+def test_run_server(path=None):
+    import json
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+
+    from datalad_container import run_client
+
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("mycontainer", image="container.img",
+                      call_fmt="sh -c '{cmd}'", **common_kwargs)
+    sock = ds.pathobj / '.git' / 'datalad' / 'containers' / 'run.sock'
+    server = subprocess.Popen(
+        ['datalad', 'containers-run', '--serve'], cwd=path)
+    try:
+        for _ in range(100):
+            if sock.exists():
+                break
+            time.sleep(0.1)
+        out = subprocess.run(
+            [sys.executable, run_client.__file__, '-d', path,
+             '-i', 'in', '-o', 'out', '--', 'cat {inputs} > {outputs}'],
+            stdout=subprocess.PIPE, text=True)
+        assert out.returncode == 0, out.stdout
+        assert_in("run(ok)", out.stdout)
+        ok_file_has_content(op.join(path, "out"), "innards")
+        assert_repo_status(path)
+        _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+        # the command is wrapped by the python of the server
+        assert runinfo["cmd"].endswith(
+            " -m datalad_container.run_wrapper "
+            "sh -c 'cat {inputs} > {outputs}'")
+
+        # failures are reported
+        res = list(run_client.request_run(str(sock), "exit 1"))
+        assert_result_count(res, 1, action="run", status="error")
+        res = list(run_client.request_run(str(sock), "true", bogus=1))
+        assert_result_count(res, 1, action="run", status="impossible")
+        # as are requests that are no JSON object
+        for request in (b'[]\n', b'"x"\n', b'5\n', b'[{}]\n'):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(30)
+                client.connect(str(sock))
+                client.sendall(request)
+                res = [json.loads(line)
+                       for line in client.makefile('rb') if line.strip()]
+            assert_result_count(res, 1, action="run", status="impossible")
+            assert_in("invalid request", res[0]["message"][0])
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait(timeout=30)
+    assert not sock.exists()
+
+
+@with_tree(tree={'a.img': "image A", 'b.img': "image B"})
+def test_run_pipeline(path=None):
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.containers_add("a", image="a.img", call_fmt="sh -c '{cmd}'",
+                      **common_kwargs)
+    ds.containers_add("b", image="b.img",
+                      call_fmt="sh -c 'echo $DATALAD_CONTAINER_NAME > names; "
+                               "{cmd}'",
+                      **common_kwargs)
+    ds.containers_run(stage=[("a", "echo hello"),
+                             ("b", "tr a-z A-Z > out")],
+                      **common_kwargs)
+    ok_file_has_content(op.join(path, "out"), "HELLO\n")
+    ok_file_has_content(op.join(path, "names"), "a b\n")
+    assert_repo_status(path)
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    eq_(runinfo["cmd"], wrap_command(
+        "bash -o pipefail -c \"$(cat <<'DATALAD_PIPELINE'\n"
+        "sh -c 'echo hello' | "
+        "sh -c 'echo $DATALAD_CONTAINER_NAME > names; tr a-z A-Z > out'\n"
+        "DATALAD_PIPELINE\n)\""))
+    assert runinfo["extra_inputs"] == ["a.img", "b.img"]
+
+    # a failing stage fails the run, not only the last one
+    res = ds.containers_run(stage=[("a", "false"), ("b", "cat > out2")],
+                            on_failure='ignore', **common_kwargs)
+    assert_in_results(res, action='run', status='error')
+
+    with assert_raises(IncompleteResultsError):
+        ds.containers_run("true", stage=[("a", "true")], **common_kwargs)
+
+    # placeholders are expanded to paths quoted for the stages
+    ds.containers_add("c", image="a.img", call_fmt="env {cmd}",
+                      **common_kwargs)
+    (ds.pathobj / "in 'file'").write_text("spaced\n")
+    ds.save(**common_kwargs)
+    ds.containers_run(stage=[("c", "cat {inputs}"),
+                             ("c", "tr a-z A-Z > {outputs}")],
+                      inputs=["in 'file'"], outputs=["out file"],
+                      **common_kwargs)
+    ok_file_has_content(op.join(path, "out file"), "SPACED\n")
+    assert_repo_status(path)
+
+
+@with_tempfile
+@with_tree(tree={'container.img': "image file", 'in1': "one", 'in2': "two"})
+def test_run_stream_inputs(path=None, origin_path=None):
+    origin = Dataset(origin_path).create(force=True, **common_kwargs)
+    origin.save(**common_kwargs)
+    origin.containers_add("mycontainer", image="container.img",
+                          call_fmt="sh -c '{cmd}'", **common_kwargs)
+    ds = clone(source=origin_path, path=path, **common_kwargs)
+    status = '"$DATALAD_CONTAINERS_INPUT_STATUS"'
+    # wait for each input to become readable, then for the end of the
+    # input processing
+    wait = ('for f in in1 in2; do while [ ! -e $f ]; do sleep 0.1; done; '
+            'done; until grep -q -e done -e failed {status}; do sleep 0.1; '
+            'done'.format(status=status))
+
+    res = ds.containers_run(
+        '{} && cat in1 in2 > out && cut -f2 {} > status'.format(
+            wait, status),
+        inputs=['in1', 'in2'], stream_inputs=True, **common_kwargs)
+    for f in ('container.img', 'in1', 'in2'):
+        assert_result_count(res, 1, action='get', status='ok',
+                            path=op.join(path, f))
+    ok_file_has_content(op.join(path, 'out'), 'onetwo')
+    ok_file_has_content(op.join(path, 'status'), 'in1\nin2\ndone\n')
+    assert_repo_status(path)
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert runinfo['inputs'] == ['in1', 'in2']
+
+    # an input that cannot be obtained fails the run, even if the command
+    # succeeds
+    ds.drop('in1', reckless='kill', **common_kwargs)
+    origin.drop('in1', reckless='kill', **common_kwargs)
+    head = ds.repo.get_hexsha()
+    with assert_raises(IncompleteResultsError):
+        ds.containers_run(
+            'until grep -q -e done -e failed {}; do sleep 0.1; done'.format(
+                status),
+            inputs=['in1'], stream_inputs=True, **common_kwargs)
+    assert ds.repo.get_hexsha() == head
+
+
+@pytest.mark.skipif(on_windows, reason="uses POSIX shell commands")
+@with_tree(tree={'container.img': "image file"})
+def test_run_overlay(path=None):
+    from datalad_container.overlay_pool import allocate_overlay
+
+    ds = Dataset(path).create(force=True, **common_kwargs)
+    ds.save(**common_kwargs)
+    ds.config.set('datalad.containers.overlay-create',
+                  'truncate -s {size}M {path}', scope='local')
+    with assert_raises(IncompleteResultsError):
+        ds.containers_add("c", image="container.img",
+                          call_fmt="sh -c 'echo dirty >> {overlay}; {cmd}'",
+                          **common_kwargs)
+    ds.containers_add("c", image="container.img",
+                      call_fmt="sh -c 'echo dirty >> {overlay}; "
+                               "echo {overlay} > used; {cmd}'",
+                      overlay_size=1, **common_kwargs)
+    eq_(ds.config.get('datalad.containers.c.overlay-size'), '1')
+
+    ds.containers_run("echo x > out", **common_kwargs)
+    ok_file_has_content(op.join(path, "out"), "x\n")
+    pool = ds.repo.dot_git / 'datalad' / 'containers' / 'overlays' / 'c' / '1'
+    ok_file_has_content(
+        op.join(path, "used"),
+        op.join('.git', 'datalad', 'containers', 'overlays', 'c', '1',
+                'slot-0.img\n'))
+    # the overlay was reset after the execution
+    eq_((pool / 'slot-0.img').read_bytes(),
+        (pool / 'template.img').read_bytes())
+    # the record holds the placeholder, not the overlay of this execution
+    _, runinfo = get_run_info(ds, ds.repo.format_commit("%B"))
+    assert_in('{overlay}', runinfo['cmd'])
+    assert_not_in('slot-0.img', runinfo['cmd'])
+    # a rerun is given an overlay that is not in use
+    with allocate_overlay(ds, 'c', 1):
+        ds.rerun(**common_kwargs)
+    ok_file_has_content(
+        op.join(path, "used"),
+        op.join('.git', 'datalad', 'containers', 'overlays', 'c', '1',
+                'slot-1.img\n'))
+
+    # concurrent executions get separate overlays, and released ones are
+    # reused
+    with allocate_overlay(ds, 'c', 1) as o1:
+        with allocate_overlay(ds, 'c', 1) as o2:
+            eq_(o1, pool / 'slot-0.img')
+            eq_(o2, pool / 'slot-1.img')
+    with allocate_overlay(ds, 'c', 1) as o1:
+        eq_(o1, pool / 'slot-0.img')
+
+
+@with_tempfile
+@with_tree(tree={'container.img': "image file", 'in1': "one", 'in2': "two"})
+def test_run_dry_run(path=None, origin_path=None):
+    origin = Dataset(origin_path).create(force=True, **common_kwargs)
+    origin.save(**common_kwargs)
+    origin.containers_add("mycontainer", image="container.img",
+                          call_fmt="sh -c '{cmd}'", **common_kwargs)
+    ds = clone(source=origin_path, path=path, **common_kwargs)
+    head = ds.repo.get_hexsha()
+
+    res = ds.containers_run("cat {inputs} > out", inputs=['in*'],
+                            dry_run='cost', **common_kwargs)
+    assert_result_count(res, 1)
+    cost = res[0]['fetch_cost']
+    eq_(cost['bytes'], len("image file") + len("one") + len("two"))
+    eq_(cost['files'], 3)
+    eq_(cost['remotes'], {ds.repo.get_remotes()[0]: cost['bytes']})
+    eq_(cost['unavailable'], [])
+    # nothing was fetched
+    assert_false(ds.repo.file_has_content('container.img'))
+
+    ds.get('in1', **common_kwargs)
+    cost = ds.containers_run("cat {inputs} > out", inputs=['in*'],
+                             dry_run='cost', **common_kwargs)[0]['fetch_cost']
+    eq_(cost['bytes'], len("image file") + len("two"))
+    eq_(cost['present_bytes'], len("one"))
+
+    # the dry-run modes of `run` are supported too
+    res = ds.containers_run("cat {inputs} > out", inputs=['in*'],
+                            dry_run='basic', **common_kwargs)
+    assert_result_count(res, 1, action='run [dry-run]')
+    eq_(res[0]['dry_run_info']['cmd_expanded'],
+        wrap_command("sh -c 'cat in1 in2 > out'"))
+    assert_false(op.lexists(op.join(path, 'out')))
+    eq_(ds.repo.get_hexsha(), head)
@@ -0,0 +1,219 @@
+"""Index of the usage of containers in the history of a dataset
+
+The run records of 'containers-run' are indexed in an SQLite database at
+``.git/datalad/containers/usage.sqlite``, to answer questions like which
+commits used a container (or a particular image), and how long they ran,
+without parsing the entire history each time. The index is updated
+incrementally from the last indexed commit, and rebuilt if the history was
+rewritten.
+
+Run records of recent versions name the containers that were used. For
+older records, containers are identified by matching the extra inputs of a
+run against the container images configured in the dataset at the time.
+"""
+
+from __future__ import annotations
+
+import logging
+import sqlite3
+
+from datalad.distribution.dataset import Dataset
+from datalad.support.exceptions import CommandError
+
+from datalad_container.run_cache import RECORD_KEY
+from datalad_container.run_history import (
+    get_annex_keys,
+    get_parent_treeish,
+    get_record_paths,
+    iter_run_records,
+)
+
+lgr = logging.getLogger("datalad.containers.usage_index")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    hexsha TEXT NOT NULL,
+    container TEXT NOT NULL,
+    image TEXT,
+    image_key TEXT,
+    cmdexec TEXT,
+    cmd TEXT,
+    date INTEGER,
+    wall_time REAL,
+    exit INTEGER,
+    PRIMARY KEY (hexsha, container)
+);
+CREATE INDEX IF NOT EXISTS runs_by_container ON runs (container);
+CREATE INDEX IF NOT EXISTS runs_by_image_key ON runs (image_key);
+CREATE TABLE IF NOT EXISTS paths (
+    hexsha TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS paths_by_hexsha ON paths (hexsha);
+"""
+
+
+def _index_path(ds: Dataset):
+    return ds.repo.dot_git / 'datalad' / 'containers' / 'usage.sqlite'
+
+
+def _get_configured_containers(ds: Dataset, hexsha: str) -> dict:
+    # the container configuration of the dataset in a commit
+    try:
+        out = ds.repo.call_git(
+            ['config', '-z', '--blob', '{}:.datalad/config'.format(hexsha),
+             '--get-regexp', r'^datalad\.containers\..*\.(image|cmdexec)$'],
+            read_only=True)
+    except CommandError:
+        # no configuration, or no container configured
+        return {}
+    containers = {}
+    for item in out.split('\0'):
+        if not item:
+            continue
+        var, value = item.split('\n', 1)
+        name, prop = var[len('datalad.containers.'):].rsplit('.', 1)
+        containers.setdefault(name, {})[prop] = value
+    return containers
+
+
+def _get_run_containers(ds: Dataset, hexsha: str, record: dict) -> list:
+    """Return name, image path, and call format of the containers of a run"""
+    recorded = record.get(RECORD_KEY, {}).get('containers')
+    if recorded:
+        images = get_record_paths(
+            dict(pwd=record.get('pwd', '.'),
+                 images=[c['image'] for c in recorded]),
+            'images')
+        return [dict(c, image=image) for c, image in zip(recorded, images)]
+    extra_inputs = set(get_record_paths(record, 'extra_inputs'))
+    if not extra_inputs:
+        return []
+    return [
+        dict(name=name, image=cfg['image'], cmdexec=cfg.get('cmdexec'))
+        for name, cfg in _get_configured_containers(ds, hexsha).items()
+        if cfg.get('image') in extra_inputs
+    ]
+
+
+def _reset(db: sqlite3.Connection):
+    db.execute('DELETE FROM runs')
+    db.execute('DELETE FROM paths')
+    db.execute("DELETE FROM meta WHERE name = 'last'")
+
+
+def update_usage_index(ds: Dataset) -> sqlite3.Connection:
+    """Bring the usage index of a dataset up to date with its HEAD
+
+    Returns
+    -------
+    sqlite3.Connection
+      Connection to the index, to be closed by the caller.
+    """
+    repo = ds.repo
+    index_path = _index_path(ds)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(index_path))
+    db.executescript(_SCHEMA)
+    row = db.execute("SELECT value FROM meta WHERE name = 'last'").fetchone()
+    last = row[0] if row else None
+    if last and not repo.call_git_success(
+            ['merge-base', '--is-ancestor', last, 'HEAD'], read_only=True):
+        lgr.debug("History changed, rebuilding container usage index")
+        with db:
+            _reset(db)
+        last = None
+    head = repo.get_hexsha()
+    if head is None or head == last:
+        return db
+
+    revrange = [head] if last is None else ['{}..{}'.format(last, head)]
+    n = 0
+    with db:
+        # oldest first, such that the row order follows the history
+        for hexsha, date, record in reversed(
+                list(iter_run_records(ds, revrange))):
+            containers = _get_run_containers(ds, hexsha, record)
+            if not containers:
+                continue
+            # the image used is the one before the run
+            keys = get_annex_keys(
+                ds, get_parent_treeish(ds, hexsha),
+                [c['image'] for c in containers])
+            usage = record.get(RECORD_KEY, {}).get('resource_usage', {})
+            db.executemany(
+                'INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?,?)',
+                [(hexsha, c['name'], c['image'],
+                  keys.get(c['image'], (None, None))[1], c.get('cmdexec'),
+                  record.get('cmd'), date, usage.get('wall_time'),
+                  record.get('exit'))
+                 for c in containers])
+            db.execute('DELETE FROM paths WHERE hexsha = ?', (hexsha,))
+            db.executemany(
+                'INSERT INTO paths VALUES (?,?,?)',
+                [(hexsha, kind, p)
+                 for kind, name in (('input', 'inputs'),
+                                    ('output', 'outputs'))
+                 for p in get_record_paths(record, name)])
+            n += 1
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('last', ?)", (head,))
+    lgr.debug("Added %i run(s) to container usage index", n)
+    return db
+
+
+def get_usage(db: sqlite3.Connection, name: str | None = None,
+              image_key: str | None = None) -> dict:
+    """Report the runs of a container, or of an image
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+      As returned by `update_usage_index`.
+    name: str, optional
+      Name of the container.
+    image_key: str, optional
+      Annex key of the container image.
+
+    Returns
+    -------
+    dict
+      With the number of 'runs', their total 'wall_time' (as far as
+      recorded), the 'last' date of use (seconds since the epoch), and a
+      list of 'commits' (newest first), each with the properties
+      'hexsha', 'date', 'container', 'image', 'image_key', 'cmdexec',
+      'cmd', 'wall_time', 'exit', 'inputs', and 'outputs'.
+    """
+    conditions, params = [], []
+    if name is not None:
+        conditions.append('container = ?')
+        params.append(name)
+    if image_key is not None:
+        conditions.append('image_key = ?')
+        params.append(image_key)
+    query = 'SELECT hexsha, date, container, image, image_key, cmdexec, ' \
+        'cmd, wall_time, exit FROM runs'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY date DESC, rowid DESC'
+    fields = ('hexsha', 'date', 'container', 'image', 'image_key',
+              'cmdexec', 'cmd', 'wall_time', 'exit')
+    commits = []
+    for row in db.execute(query, params).fetchall():
+        run = dict(zip(fields, row))
+        for kind in ('input', 'output'):
+            run[kind + 's'] = [
+                p for (p,) in db.execute(
+                    'SELECT path FROM paths WHERE hexsha = ? AND kind = ?',
+                    (run['hexsha'], kind))]
+        commits.append(run)
+    return dict(
+        runs=len(commits),
+        wall_time=sum(c['wall_time'] or 0 for c in commits),
+        last=commits[0]['date'] if commits else None,
+        commits=commits,
+    )
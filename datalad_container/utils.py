@@ -2,6 +2,8 @@
 
 from __future__ import annotations
 
+import logging
+import os.path as op
 # the pathlib equivalent is only available in PY3.12
 from os.path import lexists
 from pathlib import (
@@ -12,6 +14,10 @@ from pathlib import (
 
 from datalad.distribution.dataset import Dataset
 from datalad.support.external_versions import external_versions
+from datalad.utils import ensure_iter
+from fasteners import InterProcessLock
+
+lgr = logging.getLogger("datalad.containers.utils")
 
 
 def get_container_command():
@@ -23,6 +29,32 @@ def get_container_command():
         raise RuntimeError("Did not find apptainer or singularity")
 
 
+def get_dataset_lock(ds: Dataset, name: str) -> InterProcessLock:
+    """Return an inter-process lock for an operation on a dataset
+
+    Parameters
+    ----------
+    ds: Dataset
+      Dataset whose modification is to be serialized.
+    name: str
+      Name of the lock. Operations using the same name exclude each other.
+
+    Returns
+    -------
+    InterProcessLock
+      To be used as a context manager. The lock file is placed in
+      ``.git/datalad/containers/locks``.
+    """
+    lockdir = ds.repo.dot_git / 'datalad' / 'containers' / 'locks'
+    lockdir.mkdir(parents=True, exist_ok=True)
+    return InterProcessLock(str(lockdir / '{}.lck'.format(name)))
+
+
+# serializes changes of the container configuration, changes of the git index
+# (e.g., by git-annex adding images), and their commits
+REGISTRATION_LOCK = 'registration'
+
+
 def get_container_configuration(
     ds: Dataset,
     name: str | None = None,
@@ -91,6 +123,44 @@ def get_container_configuration(
     return containers if name is None else containers.get(name, {})
 
 
+def get_image_files(
+    ds: Dataset,
+    container: dict,
+    pwd: str | None = None,
+) -> list:
+    """Return the absolute paths of the image and extra inputs of a container
+
+    Parameters
+    ----------
+    ds: Dataset
+      Dataset the container was looked up in.
+    container: dict
+      Container record, as reported by containers-list.
+    pwd: str, optional
+      Directory that extra inputs without a placeholder are relative to.
+      Defaults to the root of `ds`.
+
+    Returns
+    -------
+    list
+      Extra inputs with unknown placeholders are not included.
+    """
+    image_path = container['path']
+    xi_kwargs = dict(
+        img_dspath=container.get('parentds', ds.path),
+        img_dirpath=op.dirname(image_path),
+    )
+    paths = [image_path]
+    for extra_input in ensure_iter(container.get('extra-input', []), set):
+        try:
+            paths.append(op.join(pwd or ds.path,
+                                 extra_input.format(**xi_kwargs)))
+        except KeyError as exc:
+            lgr.debug("Ignoring extra input %s with unknown placeholder %s",
+                      extra_input, exc)
+    return paths
+
+
 def _normalize_image_path(path: str, ds: Dataset) -> PurePath:
     """Helper to standardize container image path handling
 